@@ -5,8 +5,9 @@ import os
 import logging
 import torch
 from pytorch_lightning.callbacks import Callback
-from sklearn.metrics import roc_curve, auc, precision_recall_curve
+from sklearn.metrics import auc
 import matplotlib.pyplot as plt
+from LightningModules.utils.metric_utils import HistogramMetrics
 
 
 """Class-based Callback Inference for Integration with Pytorch Lightning"""
@@ -20,15 +21,15 @@ class GNNMetrics(Callback):
 
     def __init__(self):
         super().__init__()
-        self.preds, self.truth = None, None
+        self.histogram = None
         logging.info("CONSTRUCTING CALLBACK!")
 
     def on_test_start(self, trainer, pl_module):
 
         """This hook is automatically called when the model is tested
         after training. The best checkpoint is automatically loaded"""
-        self.preds = []
-        self.truth = []
+        n_bins = pl_module.hparams["metric_bins"] if "metric_bins" in pl_module.hparams else 10000
+        self.histogram = HistogramMetrics(n_bins=n_bins)
         
         print("Starting GNNMetrics...")
 
@@ -38,8 +39,7 @@ class GNNMetrics(Callback):
 
         """Get the relevant outputs from each batch"""
 
-        self.preds.append(outputs["score"].cpu())  # ADAK: preds to score
-        self.truth.append(outputs["truth"].cpu())
+        self.histogram.update(outputs["score"], outputs["truth"])  # ADAK: preds to score
 
     def on_test_end(self, trainer, pl_module):
 
@@ -56,14 +56,13 @@ class GNNMetrics(Callback):
         output_dir = pl_module.hparams.output_dir
         os.makedirs(output_dir, exist_ok=True)
                 
-        # Aggregate 'truth' and 'pred' from all batches.
-        preds = torch.cat(self.preds)
-        truth = torch.cat(self.truth)
-        print("preds: {}, truth: {}".format(preds.shape, truth.shape))
+        # 'truth' and 'pred' of all batches, aggregated as histograms of scores
+        histogram = self.histogram
+        print("true edges: {}, fake edges: {}".format(histogram.n_true, histogram.n_fake))
 
         # ----- ROC Metric
         # fpr, tpr, threshold = roc_curve(truth, preds)
-        roc_fpr, roc_tpr, roc_thr = roc_curve(truth, preds)
+        roc_fpr, roc_tpr, roc_thr = histogram.roc_curve()
         roc_auc = auc(roc_fpr, roc_tpr)
         logging.info("ROC AUC: %s", roc_auc)
         
@@ -82,7 +81,7 @@ class GNNMetrics(Callback):
 
         # ----- PRC Metric
         # ppv, tpr, thr = precision_recall_curve(truth, preds)
-        pre, recall, thr = precision_recall_curve(truth, preds)
+        pre, recall, thr = histogram.precision_recall_curve()
         prc_auc = auc(recall, pre)
         logging.info("PRC AUC: %s", prc_auc)
 
@@ -126,15 +125,15 @@ class GNNMetrics_V2(Callback):
 
     def __init__(self):
         super().__init__()
-        self.preds, self.truth = None, None
+        self.histogram = None
         logging.info("Constructing GNNMetrics Callback !")
 
     def on_test_start(self, trainer, pl_module):
 
         """This hook is automatically called when the model is tested
         after training. The best checkpoint is automatically loaded"""
-        self.preds = []
-        self.truth = []
+        n_bins = pl_module.hparams["metric_bins"] if "metric_bins" in pl_module.hparams else 10000
+        self.histogram = HistogramMetrics(n_bins=n_bins)
         
         print("Starting GNNMetrics...")
 
@@ -144,8 +143,7 @@ class GNNMetrics_V2(Callback):
 
         """Get the relevant outputs from each batch"""
 
-        self.preds.append(outputs["score"])  # ADAK: preds to score
-        self.truth.append(outputs["truth"])
+        self.histogram.update(outputs["score"], outputs["truth"])  # ADAK: preds to score
 
     def on_test_end(self, trainer, pl_module):
 
@@ -162,14 +160,13 @@ class GNNMetrics_V2(Callback):
         output_dir = pl_module.hparams.output_dir
         os.makedirs(output_dir, exist_ok=True)
         
-        # Aggregate 'truth' and 'pred' from all batches.
-        preds = torch.cat(self.preds)
-        truth = torch.cat(self.truth)
-        print("preds: {}, truth: {}".format(preds.shape, truth.shape))
+        # 'truth' and 'pred' of all batches, aggregated as histograms of scores
+        histogram = self.histogram
+        print("true edges: {}, fake edges: {}".format(histogram.n_true, histogram.n_fake))
         
         # ----- ROC Metric
         # fpr, tpr, threshold = roc_curve(truth, preds)
-        roc_fpr, roc_tpr, roc_thr = roc_curve(truth, preds)
+        roc_fpr, roc_tpr, roc_thr = histogram.roc_curve()
         roc_auc = auc(roc_fpr, roc_tpr)
         logging.info("ROC AUC: %s", roc_auc)
         
@@ -189,7 +186,7 @@ class GNNMetrics_V2(Callback):
         
         # ----- PRC Metric
         # ppv, tpr, thr = precision_recall_curve(truth, preds)
-        pre, recall, thr = precision_recall_curve(truth, preds)
+        pre, recall, thr = histogram.precision_recall_curve()
         prc_auc = auc(recall, pre)
         logging.info("PRC AUC: %s", prc_auc)
         
@@ -255,7 +252,7 @@ class GNNTelemetry(Callback):
 
     def __init__(self):
         super().__init__()
-        self.preds, self.truth = None, None
+        self.histogram = None
         logging.info("CONSTRUCTING CALLBACK!")
 
     def on_test_start(self, trainer, pl_module):
@@ -263,8 +260,8 @@ class GNNTelemetry(Callback):
         """This hook is automatically called when the model is tested 
         after training. The best checkpoint is automatically loaded"""
 
-        self.preds = []
-        self.truth = []
+        n_bins = pl_module.hparams["metric_bins"] if "metric_bins" in pl_module.hparams else 10000
+        self.histogram = HistogramMetrics(n_bins=n_bins)
 
     def on_test_batch_end(
         self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
@@ -272,8 +269,7 @@ class GNNTelemetry(Callback):
 
         """Get the relevant outputs from each batch"""
 
-        self.preds.append(outputs["score"])  # ADAK: preds to score
-        self.truth.append(outputs["truth"])
+        self.histogram.update(outputs["score"], outputs["truth"])  # ADAK: preds to score
 
     def on_test_end(self, trainer, pl_module):
 
@@ -290,14 +286,13 @@ class GNNTelemetry(Callback):
         output_dir = pl_module.hparams.output_dir
         os.makedirs(output_dir, exist_ok=True)
 
-        # Aggregate 'truth' and 'pred' from all batches.
-        preds = torch.cat(self.preds)
-        truth = torch.cat(self.truth)
-        print("preds: {}, truth: {}".format(preds.shape, truth.shape))
+        # 'truth' and 'pred' of all batches, aggregated as histograms of scores
+        histogram = self.histogram
+        print("true edges: {}, fake edges: {}".format(histogram.n_true, histogram.n_fake))
 
 
         # ------------------------ ROC Curve: FPR vs TPR
-        roc_fpr, roc_tpr, roc_thresholds = roc_curve(truth, preds)
+        roc_fpr, roc_tpr, roc_thresholds = histogram.roc_curve()
         roc_auc = auc(roc_fpr, roc_tpr)
         logging.info("ROC AUC: %s", roc_auc)
 
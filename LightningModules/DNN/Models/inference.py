@@ -4,11 +4,17 @@
 import os
 import sys
 import copy
+import time
+import queue
 import logging
+import threading
 import torch
+from torch.utils.data import DataLoader
 from pytorch_lightning.callbacks import Callback
-from sklearn.metrics import roc_curve
 import matplotlib.pyplot as plt
+from LightningModules.utils.shard_utils import event_exists, save_event
+from ..utils.data_utils import collate_events, compact_event
+from LightningModules.utils.metric_utils import HistogramMetrics
 
 
 """Class-based Callback Inference for Integration with Pytorch Lightning"""
@@ -23,7 +29,7 @@ class GNNTelemetry(Callback):
 
     def __init__(self):
         super().__init__()
-        self.preds, self.truth = None, None
+        self.histogram = None
         logging.info("Constructing GNNTelemetry Callback!")
 
     def on_test_start(self, trainer, pl_module):
@@ -31,8 +37,8 @@ class GNNTelemetry(Callback):
         """This hook is automatically called when the model is tested
         after training. The best checkpoint is automatically loaded"""
 
-        self.preds = []
-        self.truth = []
+        n_bins = pl_module.hparams["metric_bins"] if "metric_bins" in pl_module.hparams else 10000
+        self.histogram = HistogramMetrics(n_bins=n_bins)
 
         print("Starting GNNTelemetry...")
 
@@ -42,8 +48,7 @@ class GNNTelemetry(Callback):
 
         """Get the relevant outputs from each batch"""
 
-        self.preds.append(outputs["score"].cpu())  # ADAK: preds to score
-        self.truth.append(outputs["truth"].cpu())
+        self.histogram.update(outputs["score"], outputs["truth"])  # ADAK: preds to score
 
     def on_test_end(self, trainer, pl_module):
 
@@ -62,10 +67,7 @@ class GNNTelemetry(Callback):
 
     def get_eff_pur_metrics(self):
 
-        self.truth = torch.cat(self.truth)
-        self.preds = torch.cat(self.preds)
-
-        fpr, eff, score_cuts = roc_curve(self.truth, self.preds)
+        fpr, eff, score_cuts = self.histogram.roc_curve()
         pur = 1 - fpr
 
         eff, pur, score_cuts = (
@@ -139,6 +141,40 @@ class GNNTelemetry(Callback):
             fig.savefig(os.path.join(output_dir, f"metrics_{metric}.pdf"), format="pdf")
 
 
+class EventWriter(object):
+    """Save events from a background thread, so that serialization overlaps with inference.
+    The queue is bounded, hence at most queue_size events wait in memory to be written."""
+
+    def __init__(self, queue_size=16):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    save_event(*item)
+                    logging.info("Saved event {}".format(item[2]))
+                except Exception as inst:
+                    self.error = inst
+
+    def put(self, event, output_dir, evtid, shard_size=0):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((event, output_dir, evtid, shard_size))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
 # ADAK: To get the output files as integers change batch.event_file[-4:] to str(int(batch.event_file[-4:])). 
 # Note that the one needs string type for torch.save(), so from 'str' to 'int' followed by 'str'. The event_file
 # is of the format e.g. path/to/event0000000001, so event_file[-10:] will return 0000000001 (last 10 str) and 
@@ -161,6 +197,9 @@ class GNNBuilder(Callback):
         self.datatypes = None
         self.output_dir = None
         self.overwrite = False
+        self.shard_size = 0
+        self.batch_size = 1
+        self.writer = None
 
     def on_test_end(self, trainer, pl_module):
 
@@ -171,27 +210,39 @@ class GNNBuilder(Callback):
         total_length = sum([len(dataset) for dataset in datasets.values()])
 
         pl_module.eval()
+        self.writer = EventWriter(self.queue_size)
+        start_time, n_events = time.time(), 0
         with torch.no_grad():
             batch_incr = 0
             for set_idx, (datatype, dataset) in enumerate(datasets.items()):
-                for batch_idx, batch in enumerate(dataset):
+                for batch_idx, events in enumerate(
+                    DataLoader(dataset, batch_size=self.batch_size, collate_fn=list)
+                ):
                     percent = (batch_incr / total_length) * 100
                     sys.stdout.flush()
                     sys.stdout.write(f"{percent:.01f}% inference complete \r")
-                    if (
-                        not os.path.exists(
-                            os.path.join(
-                                self.output_dir, datatype, str(int(batch.event_file[-10:]))  # ADAK [:] to str(int([:]))
+                    batch_incr += len(events)
+
+                    events = [
+                        event for event in events
+                        if (
+                            not event_exists(
+                                os.path.join(self.output_dir, datatype),
+                                int(event.event_file[-10:]),  # ADAK [:] to str(int([:]))
+                                self.shard_size,
                             )
-                        )
-                    ) or self.overwrite:
-                        batch_to_save = copy.deepcopy(batch)
-                        batch_to_save = batch_to_save.to(
-                            pl_module.device
-                        )  # Is this step necessary??
-                        self.construct_downstream(batch_to_save, pl_module, datatype)
+                        ) or self.overwrite
+                    ]
+                    if len(events) > 0:
+                        self.construct_downstream(events, pl_module, datatype)
+                        n_events += len(events)
+
+        # Wait for the pending writes
+        self.writer.close()
 
-                    batch_incr += 1
+        elapsed = time.time() - start_time
+        print("Inference on {} events in {:.1f} s, {:.1f} events/sec".format(
+            n_events, elapsed, n_events / max(elapsed, 1e-9)))
 
     def prepare_datastructure(self, pl_module):
         # Prep the directory to produce inference data to
@@ -209,6 +260,20 @@ class GNNBuilder(Callback):
             pl_module.hparams.overwrite if "overwrite" in pl_module.hparams else False
         )
 
+        # Pack events into shards of shard_size events, if it is in config
+        self.shard_size = (
+            pl_module.hparams.shard_size if "shard_size" in pl_module.hparams else 0
+        )
+
+        # Number of events per forward pass, and of events waiting to be written
+        self.batch_size = (
+            pl_module.hparams.inference_batchsize if "inference_batchsize" in pl_module.hparams
+            else pl_module.batch_size
+        )
+        self.queue_size = (
+            pl_module.hparams.writer_queue if "writer_queue" in pl_module.hparams else 16
+        )
+
         # By default, the set of examples propagated through the pipeline will be train+val+test set
         datasets = {
             "train": pl_module.trainset,
@@ -218,21 +283,33 @@ class GNNBuilder(Callback):
 
         return datasets
 
-    def construct_downstream(self, batch, pl_module, datatype):
+    def construct_downstream(self, events, pl_module, datatype):
 
+        # One forward pass over a batch of events
+        batch = collate_events(events).to(pl_module.device)
         output = pl_module(
             pl_module.get_input_data(batch),
             torch.cat([batch.edge_index, batch.edge_index.flip(0)], dim=-1),
-        ).squeeze()
-        batch.scores = torch.sigmoid(output)
+        ).squeeze(-1)
+        scores = torch.sigmoid(output).cpu()
 
-        self.save_downstream(batch, pl_module, datatype)
+        # Scores of each event, for its edges and then its flipped edges (as for a single event)
+        n_edges = batch.edge_index.shape[1]
+        edge_start = 0
+        for event in events:
+            edge_end = edge_start + event.edge_index.shape[1]
 
-    def save_downstream(self, batch, pl_module, datatype):
+            # Compact copy, tensors of the dataset may be views of memory-mapped flat arrays
+            event = compact_event(event)
+            event.scores = torch.cat(
+                [scores[edge_start:edge_end], scores[n_edges + edge_start:n_edges + edge_end]]
+            )
+            edge_start = edge_end
 
-        with open(
-            os.path.join(self.output_dir, datatype, str(int(batch.event_file[-10:]))), "wb"  # ADAK [:] to str(int([:]))
-        ) as pickle_file:
-            torch.save(batch, pickle_file)
+            self.save_downstream(event, pl_module, datatype)
 
-        logging.info("Saved event {}".format(batch.event_file[-10:]))
+    def save_downstream(self, batch, pl_module, datatype):
+
+        self.writer.put(
+            batch, os.path.join(self.output_dir, datatype), int(batch.event_file[-10:]), self.shard_size  # ADAK [:] to str(int([:]))
+        )
@@ -14,6 +14,7 @@ import torch
 import numpy as np
 
 from ..utils import build_edges, graph_intersection
+from LightningModules.utils.metric_utils import HistogramMetrics
 
 """
 Class-based Callback inference for integration with Lightning
@@ -35,15 +36,17 @@ class EmbeddingTelemetry(Callback):
         """
         This hook is automatically called when the model is tested after training. The best checkpoint is automatically loaded
         """
-        self.preds = []
-        self.truth = []
-        self.truth_graph = []
-        self.pt_true_pos = []
-        self.pt_true = []
-        self.distances = []
-
         self.hparams = pl_module.hparams
 
+        # Only histograms are kept over the test set, of distances at the radius cuts and of pT
+        self.r_cuts = np.arange(0.01, self.hparams["r_test"], 0.01)
+        self.distances = HistogramMetrics(edges=self.r_cuts**2)
+        self.n_truth_graph = 0
+
+        self.pt_bins = np.logspace(0, 1.5, 10)
+        self.pt_true_pos = np.zeros(len(self.pt_bins) - 1, dtype=np.int64)
+        self.pt_true = np.zeros(len(self.pt_bins) - 1, dtype=np.int64)
+
     def on_test_batch_end(
         self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
     ):
@@ -55,14 +58,13 @@ class EmbeddingTelemetry(Callback):
         true_positives = outputs["preds"][:, outputs["truth"]]
         true = outputs["truth_graph"]
 
-        if "pt" in batch.__dict__.keys():
+        if "pt" in batch:
             pts = batch.pt
-            self.pt_true_pos.append(pts[true_positives].cpu())
-            self.pt_true.append(pts[true].cpu())
+            self.pt_true_pos += self.pt_histogram(pts[true_positives])
+            self.pt_true += self.pt_histogram(pts[true])
 
-        self.truth.append(outputs["truth"].cpu())
-        self.distances.append(outputs["distances"].cpu())
-        self.truth_graph.append(outputs["truth_graph"].cpu())
+        self.distances.update(outputs["distances"], outputs["truth"])
+        self.n_truth_graph += outputs["truth_graph"].shape[1]
 
     def on_test_end(self, trainer, pl_module):
 
@@ -79,45 +81,35 @@ class EmbeddingTelemetry(Callback):
 
         self.save_metrics(metrics_plots, pl_module.hparams.output_dir)
 
-    def get_pt_metrics(self):
+    def pt_histogram(self, pts):
+
+        # average pT of the two hits of every edge
+        pt_av = ((pts[0] + pts[1]) / 2).cpu().numpy()
 
-        pt_true_pos = np.concatenate(self.pt_true_pos, axis=1)
-        pt_true = np.concatenate(self.pt_true, axis=1)
+        return np.histogram(pt_av, bins=self.pt_bins)[0]
 
-        pt_true_pos_av = (pt_true_pos[0] + pt_true_pos[1]) / 2
-        pt_true_av = (pt_true[0] + pt_true[1]) / 2
+    def get_pt_metrics(self):
 
         # bins = np.arange(pl_module.hparams["pt_min"], np.ceil(pt_true_av.max()), 0.5)
         # bins = np.logspace(np.log(np.floor(pt_true_av.min())), np.log(np.ceil(pt_true_av.max())), 10)
-        bins = np.logspace(0, 1.5, 10)
+        bins = self.pt_bins
         centers = [(bins[i] + bins[i + 1]) / 2 for i in range(len(bins) - 1)]
 
-        tp_hist = np.histogram(pt_true_pos_av, bins=bins)[0]
-        t_hist = np.histogram(pt_true_av, bins=bins)[0]
-        ratio_hist = tp_hist / t_hist
+        ratio_hist = self.pt_true_pos / self.pt_true
 
         return centers, ratio_hist
 
     def get_eff_pur_metrics(self):
 
-        self.distances = torch.cat(self.distances)
-        self.truth = torch.cat(self.truth)
-        self.truth_graph = torch.cat(self.truth_graph, axis=1)
-
-        r_cuts = np.arange(0.01, self.hparams["r_test"], 0.01)
-
-        print(r_cuts)
-
-        positives = np.array([(self.distances < r_cut**2).sum() for r_cut in r_cuts])
-        true_positives = np.array(
-            [self.truth[self.distances < r_cut**2].sum() for r_cut in r_cuts]
-        )
+        # edges with distance < r_cut**2, true and fake
+        _, true_positives, false_positives = self.distances.below()
+        positives = true_positives + false_positives
 
         print(positives, true_positives)
-        eff = true_positives / self.truth_graph.shape[1]
+        eff = true_positives / self.n_truth_graph
         pur = true_positives / positives
 
-        return eff, pur, r_cuts
+        return eff, pur, self.r_cuts
 
     def calculate_metrics(self):
 
@@ -296,7 +288,8 @@ class EmbeddingBuilder(Callback):
 
         # Build the radius graph with radius < r_test
         e_spatial = build_edges(
-            spatial, spatial, indices=None, r_max=pl_module.hparams.r_test, k_max=1000
+            spatial, spatial, indices=None, r_max=pl_module.hparams.r_test, k_max=1000,
+            backend=pl_module.radius_backend,
         )  # This step should remove reliance on r_val, and instead compute an r_build based on the EXACT r required to reach target eff/pur
 
         # Arbitrary ordering to remove half of the duplicate edges
@@ -12,6 +12,7 @@ Todo:
 # System imports
 import sys
 import os
+import time
 import logging
 
 # 3rd party imports
@@ -19,12 +20,13 @@ import pytorch_lightning as pl
 from pytorch_lightning import LightningModule
 import torch
 from torch.nn import Linear
-from torch_geometric.data import DataLoader
+from torch.utils.data import DataLoader
 from torch_cluster import radius_graph
 import numpy as np
 
 # Local Imports
-from .utils import graph_intersection, split_datasets, build_edges
+from .utils import graph_intersection, split_datasets, build_edges, collate_events
+from .utils import get_signal_bidir_edges, label_pairs
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -38,6 +40,12 @@ class EmbeddingBase(LightningModule):
         Initialise the Lightning Module that can scan over different embedding training regimes
         """
         self.save_hyperparameters(hparams)
+
+        # Number of events per batch, collated into one graph of disjoint events
+        self.batch_size = self.hparams["batchsize"] if "batchsize" in self.hparams else 1
+
+        # Radius graph backend: 'auto', 'faiss' or 'kdtree' (see radius_utils.py)
+        self.radius_backend = self.hparams["radius_backend"] if "radius_backend" in self.hparams else "auto"
     
     # LightningModule Hooks: To skip a separate LightningDataModule
     def setup(self, stage):
@@ -46,19 +54,28 @@ class EmbeddingBase(LightningModule):
     
     def train_dataloader(self):
         if len(self.trainset) > 0:
-            return DataLoader(self.trainset, batch_size=1, num_workers=self.hparams['n_workers'])
+            return DataLoader(
+                self.trainset, batch_size=self.batch_size, num_workers=self.hparams['n_workers'],
+                collate_fn=collate_events
+            )
         else:
             return None
     
     def val_dataloader(self):
         if len(self.valset) > 0:
-            return DataLoader(self.valset, batch_size=1, num_workers=self.hparams['n_workers'])
+            return DataLoader(
+                self.valset, batch_size=self.batch_size, num_workers=self.hparams['n_workers'],
+                collate_fn=collate_events
+            )
         else:
             return None
 
     def test_dataloader(self):
         if len(self.testset) > 0:
-            return DataLoader(self.testset, batch_size=1, num_workers=self.hparams['n_workers'])
+            return DataLoader(
+                self.testset, batch_size=self.batch_size, num_workers=self.hparams['n_workers'],
+                collate_fn=collate_events
+            )
         else:
             return None
     
@@ -108,14 +125,18 @@ class EmbeddingBase(LightningModule):
 
         query_indices, query = self.get_query_points(batch, spatial)
 
-        # Append Hard Negative Mining (hnm) with KNN graph
+        # Append Hard Negative Mining (hnm) with KNN graph, neighbours are searched within each event
         if "hnm" in self.hparams["regime"]:
-            e_spatial = self.append_hnm_pairs(e_spatial, query, query_indices, spatial)
+            separated = self.separate_events(batch, spatial, self.hparams["r_train"])
+            e_spatial = self.append_hnm_pairs(e_spatial, separated[query_indices], query_indices, separated)
 
         # Append random edges pairs (rp) for stability
         if "rp" in self.hparams["regime"]:
             e_spatial = self.append_random_pairs(e_spatial, query_indices, spatial)
 
+        # Pairs are only formed within an event
+        e_spatial = self.remove_cross_event_pairs(batch, e_spatial)
+
         # Instantiate bidirectional truth (since KNN prediction will be bidirectional)
         e_bidir = torch.cat(
             [batch.signal_true_edges, batch.signal_true_edges.flip(0)], axis=-1
@@ -148,13 +169,13 @@ class EmbeddingBase(LightningModule):
         positive_loss = torch.nn.functional.hinge_embedding_loss(
             d[hinge == 1],
             hinge[hinge == 1],
-            margin=self.hparams["margin"]**2],
+            margin=self.hparams["margin"]**2,
             reduction="mean",
         )
 
         loss = negative_loss + self.hparams["weight"] * positive_loss
 
-        self.log("train_loss", loss)
+        self.log("train_loss", loss, batch_size=batch.num_graphs)
 
         return loss
 
@@ -168,10 +189,12 @@ class EmbeddingBase(LightningModule):
             [batch.signal_true_edges, batch.signal_true_edges.flip(0)], axis=-1
         )
 
-        # Build whole KNN graph
+        # Build whole KNN graph, neighbours are searched within each event
+        separated = self.separate_events(batch, spatial, knn_radius)
         e_spatial = build_edges(
-            spatial, spatial, indices=None, r_max=knn_radius, k_max=knn_num
+            separated, separated, indices=None, r_max=knn_radius, k_max=knn_num, backend=self.radius_backend
         )
+        e_spatial = self.remove_cross_event_pairs(batch, e_spatial)
 
         e_spatial, y_cluster = self.get_truth(batch, e_spatial, e_bidir)
         new_weights = y_cluster.to(self.device) * self.hparams["weight"]
@@ -197,7 +220,8 @@ class EmbeddingBase(LightningModule):
         if log:
             current_lr = self.optimizers().param_groups[0]["lr"]
             self.log_dict(
-                {"val_loss": loss, "eff": eff, "pur": pur, "current_lr": current_lr}
+                {"val_loss": loss, "eff": eff, "pur": pur, "current_lr": current_lr},
+                batch_size=batch.num_graphs
             )
         logging.info("Efficiency: {}".format(eff))
         logging.info("Purity: {}".format(pur))
@@ -233,6 +257,24 @@ class EmbeddingBase(LightningModule):
         
         return outputs
 
+    # Training Throughput (events/sec), e.g. to choose the batch size
+    def on_train_epoch_start(self):
+        self.train_events, self.train_time = 0, 0.
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, outputs, batch, batch_idx, *args):
+        step_end = time.perf_counter()
+        self.train_events += batch.num_graphs
+        self.train_time += step_end - self.step_start
+        self.step_start = step_end
+
+    def on_validation_end(self):
+        # time spent in validation is not training time
+        self.step_start = time.perf_counter()
+
+    def on_train_epoch_end(self, *args):
+        self.log("events_per_sec", self.train_events / max(self.train_time, 1e-9))
+
     def optimizer_step(
         self,
         epoch,
@@ -291,7 +333,8 @@ class EmbeddingBase(LightningModule):
 
             )
         else:
-            query_indices = batch.signal_true_edges.unique()
+            # hits of the signal true edges, the cached edges are sorted by source
+            query_indices = torch.unique_consecutive(get_signal_bidir_edges(batch)[0])
 
         query_indices = query_indices[torch.randperm(len(query_indices))][
 
@@ -307,7 +350,7 @@ class EmbeddingBase(LightningModule):
 
         if "low_purity" in self.hparams["regime"]:
             knn_edges = build_edges(
-                query, spatial, query_indices, self.hparams["r_train"], 500
+                query, spatial, query_indices, self.hparams["r_train"], 500, backend=self.radius_backend
             )
             knn_edges = knn_edges[
                 :,
@@ -323,6 +366,7 @@ class EmbeddingBase(LightningModule):
                 query_indices,
                 self.hparams["r_train"],
                 self.hparams["knn"],
+                backend=self.radius_backend,
             )
 
         e_spatial = torch.cat(
@@ -350,6 +394,26 @@ class EmbeddingBase(LightningModule):
         )
         return e_spatial
 
+    def separate_events(self, batch, spatial, r_max):
+        """Embedding with one more coordinate, shifting every event of a batch by 2 * r_max from
+        the previous one. A radius search then never pairs hits of different events, and the k_max
+        nearest neighbours of a hit are all from its event, the same as searching event by event."""
+
+        if batch.num_graphs > 1:
+            shift = 2 * r_max * batch.batch.to(device=spatial.device, dtype=spatial.dtype)
+            spatial = torch.cat([spatial, shift.unsqueeze(1)], dim=-1)
+
+        return spatial
+
+    def remove_cross_event_pairs(self, batch, e_spatial):
+        """Drop pairs between hits of different events, when a batch holds several events."""
+
+        if batch.num_graphs > 1:
+            event_idx = batch.batch.to(e_spatial.device)
+            e_spatial = e_spatial[:, event_idx[e_spatial[0]] == event_idx[e_spatial[1]]]
+
+        return e_spatial
+
     def get_true_pairs(self, e_spatial, y_cluster, new_weights, e_bidir):
     
         e_spatial = torch.cat(
@@ -382,6 +446,8 @@ class EmbeddingBase(LightningModule):
 
     def get_truth(self, batch, e_spatial, e_bidir):
 
-        e_spatial, y_cluster = graph_intersection(e_spatial, e_bidir)
+        # Lookup in the sorted bidirectional true edges cached per event, same as
+        # graph_intersection(e_spatial, e_bidir) without building the truth keys every step
+        e_spatial, y_cluster = label_pairs(e_spatial, get_signal_bidir_edges(batch), batch.num_nodes)
 
         return e_spatial, y_cluster
@@ -4,10 +4,13 @@ import logging
 import torch
 from torch.utils.data import random_split
 from torch import nn
+from torch_geometric.data import Batch, Data
 import scipy as sp
 import numpy as np
 import pandas as pd
 import trackml.dataset
+from LightningModules.utils.shard_utils import list_events, load_event
+from LightningModules.utils.cache_utils import SelectCache
 
 """
 Ideally, we would be using FRNN and the GPU. But in the case of a user not having a GPU, or not having FRNN, we import FAISS as the 
@@ -16,6 +19,7 @@ nearest neighbor library
 
 import faiss
 import faiss.contrib.torch_utils
+from .radius_utils import RadiusIndex
 
 try:
     import frnn
@@ -33,6 +37,26 @@ else:
 FRNN_AVAILABLE = False
 
 
+class EventData(Data):
+    """Data with the true edge lists (e.g. signal_true_edges) batched like edge_index, i.e.
+    concatenated along the last dimension and shifted by the number of nodes of previous events."""
+
+    def __cat_dim__(self, key, value, *args, **kwargs):
+        if "edges" in key:
+            return -1
+        return super().__cat_dim__(key, value, *args, **kwargs)
+
+    def __inc__(self, key, value, *args, **kwargs):
+        if "edges" in key:
+            return self.num_nodes
+        return super().__inc__(key, value, *args, **kwargs)
+
+
+def collate_events(events):
+    """Collate events into a single Batch, a graph of disjoint events."""
+    return Batch.from_data_list([EventData(**dict(event)) for event in events])
+
+
 def load_dataset(
     input_dir,
     num,
@@ -42,23 +66,35 @@ def load_dataset(
     primary_only,
     true_edges,
     noise,
+    select_cache_dir=None,
 ):
     if input_dir is not None:
     
         # Get a List of Event Files
-        all_events = os.listdir(input_dir)
+        all_events = list_events(input_dir)
         all_events = sorted([os.path.join(input_dir, event) for event in all_events])
-        loaded_events = []
+        loaded_events, loaded_files = [], []
         
         # Load Events
         for event in all_events[:num]:
             try:
-                loaded_event = torch.load(event, map_location=torch.device("cpu"))
+                loaded_event = load_event(event, map_location=torch.device("cpu"))
                 loaded_events.append(loaded_event)
+                loaded_files.append(event)
                 logging.info("Loaded event: {}".format(loaded_event.event_file))
             except:
                 logging.info("Corrupted event file: {}".format(event))
         
+        # Derived data of previous launches with the same cuts
+        if select_cache_dir is not None:
+            selection = dict(
+                pt_background_cut=pt_background_cut, pt_signal_cut=pt_signal_cut, nhits=nhits,
+                primary_only=primary_only, true_edges=true_edges, noise=noise,
+            )
+            return select_data_cached(
+                loaded_events, loaded_files, SelectCache(select_cache_dir, input_dir, **selection), **selection
+            )
+        
         # Select Data (Very Important !!!)
         loaded_events = select_data(
             loaded_events,
@@ -85,6 +121,7 @@ def split_datasets(
     true_edges=None,
     noise=True,
     seed=1,
+    select_cache_dir=None,
     **kwargs
 ):
     """
@@ -105,6 +142,7 @@ def split_datasets(
         primary_only,
         true_edges,
         noise,
+        select_cache_dir,
     )
     
     # split data by using random_split() from torch.utils.data
@@ -123,6 +161,42 @@ def get_edge_subset(edges, mask_where, inverse_mask):
     return included_edges, included_edges_mask
 
 
+# Node features cut by the background pt cut, and event attributes set by select_data(),
+# hence stored in the select cache
+SELECT_NODE_FEATURES = ["x", "hid", "pid", "pt", "nhits", "primary"]
+SELECT_KEYS = ["signal_true_edges", "signal_bidir_edges"]
+
+
+def select_data_cached(
+    events, event_files, cache, pt_background_cut, pt_signal_cut, nhits, primary_only, true_edges, noise
+):
+    """Same as select_data(), with the outputs of events found in the cache set as they are.
+    The others are selected, then added to the cache."""
+
+    missed = []
+    for event, event_file in zip(events, event_files):
+        cached = cache.get(event_file)
+        if cached is None:
+            missed.append((event, event_file))
+            continue
+        for key in cached:
+            event[key] = cached[key]
+
+    select_data(
+        [event for event, _ in missed], pt_background_cut, pt_signal_cut, nhits, primary_only, true_edges, noise
+    )
+
+    keys = SELECT_KEYS + [true_edges]
+    if pt_background_cut > 0 or not noise:
+        keys += SELECT_NODE_FEATURES
+    for event, event_file in missed:
+        cache.put(event_file, event, keys)
+    cache.save()
+
+    logging.info("Select cache: {} events cached, {} selected".format(len(events) - len(missed), len(missed)))
+    return events
+
+
 def select_data(
     events, pt_background_cut, pt_signal_cut, nhits_min, primary_only, true_edges, noise
 ):  
@@ -146,9 +220,8 @@ def select_data(
                 event[true_edges], pt_where, inverse_mask
             )
 
-            node_features = ["x", "hid", "pid", "pt", "nhits", "primary"]
-            for feature in node_features:
-                if feature in event.keys:
+            for feature in SELECT_NODE_FEATURES:
+                if feature in event:
                     event[feature] = event[feature][pt_mask]
     
     # Loop over all events
@@ -157,20 +230,66 @@ def select_data(
         event.signal_true_edges = event[true_edges]
         edge_subset = torch.ones(event.signal_true_edges.shape[1]).bool()
         
-        if "pt" in event.keys:
+        if "pt" in event:
             edge_subset &= (event.pt[event[true_edges]] > pt_signal_cut).all(0)
         
-        if "primary" in event.keys:
+        if "primary" in event:
             edge_subset &= (event.nhits[event[true_edges]] >= nhits_min).all(0)
             
-        if "nhits" in event.keys:
+        if "nhits" in event:
             edge_subset &= ((event.primary[event[true_edges]].bool().all(0) | (not primary_only)))
         
         event.signal_true_edges = event.signal_true_edges[:, edge_subset]
 
+        # Truth lookup of training pairs, computed once per event
+        get_signal_bidir_edges(event)
+
     return events
 
 
+def get_signal_bidir_edges(event):
+    """Sorted (by source, then target) and unique bidirectional signal_true_edges of an event,
+    cached on the event as 'signal_bidir_edges'. It is batched by collate_events() like the other
+    true edges, and the batch stays sorted, as the nodes of every event come after the previous one."""
+
+    if "signal_bidir_edges" not in event:
+        num_nodes = event.num_nodes
+        edges = torch.cat([event.signal_true_edges, event.signal_true_edges.flip(0)], axis=-1)
+        keys = torch.unique(edges[0].long() * num_nodes + edges[1].long())
+        event.signal_bidir_edges = torch.stack([keys // num_nodes, keys % num_nodes])
+
+    return event.signal_bidir_edges
+
+
+def label_pairs(pred_graph, truth_edges, num_nodes):
+    """Same as graph_intersection(pred_graph, truth_edges), for truth edges already sorted and
+    unique (see get_signal_bidir_edges()), so the truth keys need neither a sort nor the max of
+    the node indices. Outputs are returned on the CPU."""
+
+    pred_graph = pred_graph.long()
+    truth_edges = truth_edges.long().to(pred_graph.device)
+
+    pred_keys = pred_graph[0] * num_nodes + pred_graph[1]
+    truth_keys = truth_edges[0] * num_nodes + truth_edges[1]
+
+    # Unique predicted edges, looked up in sorted order (much faster than unsorted queries)
+    sorted_keys, perm = torch.sort(pred_keys, stable=True)
+    is_first = torch.ones_like(sorted_keys, dtype=torch.bool)
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    unique_keys = sorted_keys[is_first]
+
+    position = torch.searchsorted(truth_keys, unique_keys).clamp(max=max(len(truth_keys) - 1, 0))
+    if len(truth_keys) > 0:
+        y = truth_keys[position] == unique_keys
+    else:
+        y = torch.zeros_like(unique_keys, dtype=torch.bool)
+
+    # back in order of first occurrence
+    first, order = torch.sort(perm[is_first])
+
+    return pred_graph[:, first].cpu(), y[order].cpu()
+
+
 def reset_edge_id(subset, graph):
     subset_ind = np.where(subset)[0]
     filler = -np.ones((graph.max() + 1,))
@@ -185,60 +304,65 @@ def reset_edge_id(subset, graph):
 def graph_intersection(
     pred_graph, truth_graph, using_weights=False, weights_bidir=None
 ):
-
-    array_size = max(pred_graph.max().item(), truth_graph.max().item()) + 1
-
-    if torch.is_tensor(pred_graph):
-        l1 = pred_graph.cpu().numpy()
+    """Label each predicted edge as true/false. Edges are encoded as int64 keys (src * N + dst),
+    duplicated predicted edges are dropped keeping their first occurrence, and the order of the
+    predicted edges is preserved. Outputs are returned on the CPU."""
+
+    if not torch.is_tensor(pred_graph):
+        pred_graph = torch.from_numpy(np.asarray(pred_graph))
+    if not torch.is_tensor(truth_graph):
+        truth_graph = torch.from_numpy(np.asarray(truth_graph))
+
+    pred_graph = pred_graph.long()
+    truth_graph = truth_graph.long().to(pred_graph.device)
+
+    array_size = max(
+        pred_graph.max().item() if pred_graph.numel() > 0 else 0,
+        truth_graph.max().item() if truth_graph.numel() > 0 else 0,
+    ) + 1
+
+    pred_keys = pred_graph[0] * array_size + pred_graph[1]
+    truth_keys = truth_graph[0] * array_size + truth_graph[1]
+
+    # Unique predicted edges, in order of first occurrence
+    sorted_keys, perm = torch.sort(pred_keys, stable=True)
+    is_first = torch.ones_like(sorted_keys, dtype=torch.bool)
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    first = torch.sort(perm[is_first])[0]
+    pred_keys = pred_keys[first]
+
+    # Sorted unique truth keys for the lookup
+    truth_keys, truth_inverse = torch.unique(truth_keys, sorted=True, return_inverse=True)
+    position = torch.searchsorted(truth_keys, pred_keys).clamp(max=max(len(truth_keys) - 1, 0))
+    if len(truth_keys) > 0:
+        y = truth_keys[position] == pred_keys
     else:
-        l1 = pred_graph
-    if torch.is_tensor(truth_graph):
-        l2 = truth_graph.cpu().numpy()
-    else:
-        l2 = truth_graph
-    e_1 = sp.sparse.coo_matrix(
-        (np.ones(l1.shape[1]), l1), shape=(array_size, array_size)
-    ).tocsr()
-    e_2 = sp.sparse.coo_matrix(
-        (np.ones(l2.shape[1]), l2), shape=(array_size, array_size)
-    ).tocsr()
-    del l1
-
-    e_intersection = e_1.multiply(e_2) - ((e_1 - e_2) > 0)
-    del e_1
-    del e_2
+        y = torch.zeros_like(pred_keys, dtype=torch.bool)
 
-    if using_weights:
-        weights_list = weights_bidir.cpu().numpy()
-        weights_sparse = sp.sparse.coo_matrix(
-            (weights_list, l2), shape=(array_size, array_size)
-        ).tocsr()
-        del weights_list
-        del l2
-        new_weights = weights_sparse[e_intersection.astype("bool")]
-        del weights_sparse
-        new_weights = torch.from_numpy(np.array(new_weights)[0])
-
-    e_intersection = e_intersection.tocoo()
-    new_pred_graph = torch.from_numpy(
-        np.vstack([e_intersection.row, e_intersection.col])
-    ).long()  # .to(device)
-    y = torch.from_numpy(e_intersection.data > 0)  # .to(device)
-    del e_intersection
+    new_pred_graph = pred_graph[:, first].cpu()  # .to(device)
 
     if using_weights:
-        return new_pred_graph, y, new_weights
+        # Duplicated truth edges have their weights summed
+        weights_unique = torch.zeros(
+            len(truth_keys), dtype=weights_bidir.dtype, device=truth_keys.device
+        ).index_add_(0, truth_inverse, weights_bidir.to(truth_keys.device))
+        new_weights = torch.zeros(len(pred_keys), dtype=weights_bidir.dtype, device=y.device)
+        new_weights[y] = weights_unique[position[y]]
+        return new_pred_graph, y.cpu(), new_weights.cpu()
     else:
-        return new_pred_graph, y
+        return new_pred_graph, y.cpu()
 
 
 def build_edges(
-    query, database, indices=None, r_max=1.0, k_max=10, return_indices=False
+    query, database, indices=None, r_max=1.0, k_max=10, return_indices=False, backend="auto", index=None
 ):
     """
     NOTE: These KNN/FRNN algorithms return the distances**2. Therefore we need 
     to be careful when comparing them to the target distances (r_val, r_test), and 
     to the margin parameter (which is L1 distance)
+
+    The radius search runs with the given backend ('auto', 'faiss' or 'kdtree', see radius_utils.py),
+    or on a RadiusIndex of the database built beforehand, e.g. to query the same event several times.
     """
     
     if FRNN_AVAILABLE:
@@ -262,15 +386,10 @@ def build_edges(
         positive_idxs = I >= 0
         edge_list = torch.stack([ind[positive_idxs], I[positive_idxs]]).long()
 
-    else:
+    elif return_indices:
 
-        if device == "cuda":
-            res = faiss.StandardGpuResources()
-            Dsq, I = faiss.knn_gpu(res, database, query, k_max)
-        elif device == "cpu":
-            index = faiss.IndexFlatL2(database.shape[1])
-            index.add(database)
-            Dsq, I = index.search(query, k_max)
+        # the dense (n_query, k_max) outputs only exist with faiss
+        Dsq, I = RadiusIndex(database, backend="faiss").knn(query, k_max)
 
         ind = torch.Tensor.repeat(
             torch.arange(I.shape[0], device=device), (I.shape[1], 1), 1
@@ -278,6 +397,11 @@ def build_edges(
 
         edge_list = torch.stack([ind[Dsq <= r_max**2], I[Dsq <= r_max**2]])
 
+    else:
+
+        index = index if index is not None else RadiusIndex(database, backend)
+        edge_list, _ = index.search(query, r_max, k_max)
+
     # Reset indices subset to correct global index
     if indices is not None:
         edge_list[0] = indices[edge_list[0]]
@@ -293,13 +417,7 @@ def build_edges(
 
 def build_knn(spatial, k):
 
-    if device == "cuda":
-        res = faiss.StandardGpuResources()
-        _, I = faiss.knn_gpu(res, spatial, spatial, k_max)
-    elif device == "cpu":
-        index = faiss.IndexFlatL2(spatial.shape[1])
-        index.add(spatial)
-        _, I = index.search(spatial, k_max)
+    _, I = RadiusIndex(spatial, backend="faiss").knn(spatial, k)
 
     ind = torch.Tensor.repeat(
         torch.arange(I.shape[0], device=device), (I.shape[1], 1), 1
@@ -3,7 +3,7 @@
 
 import torch
 from torch.nn import Linear
-from torch_scatter import scatter_add, scatter_mean, scatter_max
+from torch_scatter import segment_csr
 from torch.utils.checkpoint import checkpoint
 
 from ..gnn_base import GNNBase
@@ -30,6 +30,13 @@ class InteractionGNN(GNNBase):
             False if "batchnorm" not in hparams else hparams["batchnorm"]
         )
         
+        # Gradient checkpointing: none, iteration (message steps) or full
+        self.checkpointing = (
+            "full" if "checkpointing" not in hparams else hparams["checkpointing"]
+        )
+        if self.checkpointing not in ["none", "iteration", "full"]:
+            raise ValueError("Unknown checkpointing policy: {}".format(self.checkpointing))
+        
         # Setup input network
         self.node_encoder = make_mlp(
             hparams["spatial_channels"] + hparams["cell_channels"],
@@ -87,46 +94,41 @@ class InteractionGNN(GNNBase):
                 eval(self.hparams["initialization"])(layer.weight)
                 layer.bias.data.fill_(0)
 
-    def message_step(self, x, start, end, e):
+    def aggregate(self, e, ptr):
+        
+        # Edges are sorted by receiver, so each node reduces a contiguous segment of edges
+        # (no atomics). Sum and max share the segments, mean is derived from the sum.
+        aggregation = self.hparams["aggregation"]
+        
+        edge_sum, edge_max = None, None
+        if aggregation in ["sum", "mean", "sum_max", "mean_max", "mean_sum"]:
+            edge_sum = segment_csr(e, ptr, reduce="sum")
+        if aggregation in ["max", "sum_max", "mean_max"]:
+            edge_max = segment_csr(e, ptr, reduce="max")
+        
+        if aggregation in ["mean", "mean_max", "mean_sum"]:
+            degree = (ptr[1:] - ptr[:-1]).clamp(min=1).unsqueeze(-1)
+            edge_mean = edge_sum / degree
+        
+        if aggregation == "sum":
+            return edge_sum
+        elif aggregation == "max":
+            return edge_max
+        elif aggregation == "sum_max":
+            return torch.cat([edge_max, edge_sum], dim=-1)
+        elif aggregation == "mean":
+            return edge_mean
+        elif aggregation == "mean_sum":
+            return torch.cat([edge_mean, edge_sum], dim=-1)
+        elif aggregation == "mean_max":
+            return torch.cat([edge_max, edge_mean], dim=-1)
+        
+        raise ValueError("Unknown aggregation: {}".format(aggregation))
+
+    def message_step(self, x, start, end, e, ptr):
         
         # Compute new node features
-        edge_messages = None
-        if self.hparams["aggregation"] == "sum":
-            edge_messages = scatter_add(
-                e, end, dim=0, dim_size=x.shape[0]
-            )
-        elif self.hparams["aggregation"] == "max":
-            edge_messages = scatter_max(
-                e, end, dim=0, dim_size=x.shape[0]
-            )[0]
-        elif self.hparams["aggregation"] == "sum_max":
-            edge_messages = torch.cat(
-                [
-                    scatter_max(e, end, dim=0, dim_size=x.shape[0])[0],
-                    scatter_add(e, end, dim=0, dim_size=x.shape[0]),
-                ],
-                dim=-1,
-            )
-        elif self.hparams["aggregation"] == "mean":
-            edge_messages = scatter_mean(
-                e, end, dim=0, dim_size=x.shape[0]
-            )
-        elif self.hparams["aggregation"] == "mean_sum":
-            edge_messages = torch.cat(
-                [
-                    scatter_mean(e, end, dim=0, dim_size=x.shape[0]),
-                    scatter_add(e, end, dim=0, dim_size=x.shape[0]),
-                ],
-                dim=-1,
-            )            
-        elif self.hparams["aggregation"] == "mean_max":
-            edge_messages = torch.cat(
-                [
-                    scatter_max(e, end, dim=0, dim_size=x.shape[0])[0],
-                    scatter_mean(e, end, dim=0, dim_size=x.shape[0]),
-                ],
-                dim=-1,
-            )    
+        edge_messages = self.aggregate(e, ptr)
         
         node_inputs = torch.cat([x, edge_messages], dim=-1)
         x_out = self.node_network(node_inputs)
@@ -145,20 +147,32 @@ class InteractionGNN(GNNBase):
 
         return self.output_edge_classifier(classifier_inputs).squeeze(-1)
 
+    def checkpoint_step(self, policies, function, *args):
+        
+        # Checkpointing only saves memory for the backward pass, never under torch.no_grad()
+        if torch.is_grad_enabled() and self.checkpointing in policies:
+            return checkpoint(function, *args)
+        return function(*args)
+
     def forward(self, x, edge_index):
         
-        # Senders and receivers
-        start, end = edge_index
+        # Senders and receivers, sorted by receiver for the segment aggregation
+        order = torch.argsort(edge_index[1])
+        start, end = edge_index[:, order]
+        ptr = torch.cat([end.new_zeros(1), torch.bincount(end, minlength=x.shape[0]).cumsum(0)])
         
-        # Encode the graph features into the hidden space
-        x.requires_grad = True
-        x = checkpoint(self.node_encoder, x)
-        e = checkpoint(self.edge_encoder, torch.cat([x[start], x[end]], dim=1))
+        # Encode the graph features into the hidden space. The node encoder is never
+        # checkpointed, as its input does not require grad.
+        x = self.node_encoder(x)
+        e = self.checkpoint_step(["full"], self.edge_encoder, torch.cat([x[start], x[end]], dim=1))
 
         # Loop over iterations of edge and node networks
         for i in range(self.hparams["n_graph_iters"]):
 
-            x, e = checkpoint(self.message_step, x, start, end, e)
+            x, e = self.checkpoint_step(["iteration", "full"], self.message_step, x, start, end, e, ptr)
 
         # Compute final edge scores; use original edge directions only
-        return checkpoint(self.output_step, x, start, end, e)
+        output = self.checkpoint_step(["full"], self.output_step, x, start, end, e)
+        
+        # Back to the order of edge_index
+        return torch.empty_like(output).index_copy(0, order, output)
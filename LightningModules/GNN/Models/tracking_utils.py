@@ -1,57 +1,142 @@
 import os
 import numpy as np
 import pandas as pd
+from LightningModules.utils.matching_utils import match_pairs, match_reco_tracks
 
 def get_tracking_metrics():
     pass
 
+def union_edges(parent, senders, receivers):
+    """Add edges to a union-find forest kept as a compressed parent array, every node
+    points to the root of its component, i.e. the smallest node index of the component."""
+
+    while True:
+
+        # Hook, the root of the larger label points to the root of the smaller label
+        sender_roots, receiver_roots = parent[senders], parent[receivers]
+        unmerged = sender_roots != receiver_roots
+        if not unmerged.any():
+            break
+        low = np.minimum(sender_roots[unmerged], receiver_roots[unmerged])
+        high = np.maximum(sender_roots[unmerged], receiver_roots[unmerged])
+        np.minimum.at(parent, high, low)
+
+        # Compress, point every node to its root
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+    return parent
+
+
+def count_track_matches(
+    labels,
+    hit_pids,
+    track_length_range,
+    min_hits_truth=9,
+    frac_reco_matched=0.5,
+    frac_truth_matched=0.5,
+):
+    """Match the track candidates (labels of hits) to particles as match_reco_tracks(), for every
+    minimum track length at once. Returns an array of (n_trackable_particles, n_matched_particles,
+    n_selected_tracks, n_matched_tracks) per track length.
+
+    Unlike match_reco_tracks(), which counts every (track, particle) pair at frac_reco_matched, a
+    matched track is counted once here (e.g. a track half of two particles), so that the fake rate
+    1 - n_matched_tracks / n_selected_tracks stays within [0, 1]. Particle counters are the same."""
+
+    track_length_range = np.asarray(track_length_range)[:, None]
+    label_sizes = np.bincount(labels)
+    track_sizes = label_sizes[label_sizes > 0]
+
+    # number of spacepoints in each particle, noise hits have particle_id == 0
+    signal = hit_pids > 0
+    pids, pid_idx, n_true_hits = np.unique(
+        hit_pids[signal], return_inverse=True, return_counts=True
+    )
+
+    pair_track, pair_pid, purity_reco, purity_reco_max, combined_match = match_pairs(
+        labels[signal], pid_idx, label_sizes, n_true_hits, frac_reco_matched, frac_truth_matched
+    )
+    pair_size = label_sizes[pair_track]
+
+    # a particle stays matched down to the size of its largest matched track
+    best_size = np.zeros(len(pids), dtype=np.int64)
+    np.maximum.at(best_size, pair_pid[combined_match], pair_size[combined_match])
+    is_trackable = n_true_hits >= min_hits_truth
+    is_reco_matched = (purity_reco >= frac_reco_matched) & (purity_reco == purity_reco_max)
+    is_reco_matched[is_reco_matched] = np.diff(pair_track[is_reco_matched], prepend=-1) != 0
+
+    return np.stack(
+        [
+            np.full(len(track_length_range), is_trackable.sum()),
+            ((best_size >= track_length_range) & is_trackable).sum(axis=1),
+            (track_sizes >= track_length_range).sum(axis=1),
+            ((pair_size >= track_length_range) & is_reco_matched).sum(axis=1),
+        ],
+        axis=1,
+    )
+
+
+def scan_edge_cuts(
+    edge_index, scores, hit_pids, edge_cut_range, track_length_range, **kwargs
+):
+    """Track matching counts of one event for every (edge_cut, track_length), see count_track_matches().
+    Edges are sorted by score once, and added to the union-find in score order as the cut is lowered,
+    so the connected components (CCL track candidates) of every cut come from one pass."""
+
+    edge_cut_range = np.asarray(edge_cut_range)
+    num_nodes = len(hit_pids)
+
+    # edges passing each cut (score > edge_cut), highest scores first
+    order = np.argsort(-scores, kind="stable")
+    senders, receivers = edge_index[0][order], edge_index[1][order]
+    n_passing = len(scores) - np.searchsorted(np.sort(scores), edge_cut_range, side="right")
+
+    counts = np.zeros((len(edge_cut_range), len(track_length_range), 4), dtype=np.int64)
+    parent = np.arange(num_nodes)
+    n_added = 0
+    for i in np.argsort(-edge_cut_range, kind="stable"):
+        parent = union_edges(
+            parent, senders[n_added:n_passing[i]], receivers[n_added:n_passing[i]]
+        )
+        n_added = max(n_added, n_passing[i])
+        counts[i] = count_track_matches(parent, hit_pids, track_length_range, **kwargs)
+
+    return counts
+
+
 def get_metrics_matrices(
-    edge_scores,
-    particles_df,
-    truth_df,
+    events,
     edge_cut_range=None,
     track_length_range=None,
-    ROI=None,
+    **kwargs
 ):
+    """Efficiency and fake rate of the CCL track candidates over scored events (e.g. gnn_processed),
+    for every edge_cut x track_length. Events need edge_index, scores and pid (particle id per hit)."""
 
     if edge_cut_range is None:
         edge_cut_range = np.arange(0.1, 0.9, 0.1)
     if track_length_range is None:
         track_length_range = np.arange(1, 12)
-    if ROI is None:
-        ROI = {"pt": {"min": 1}}
-
-    efficiency_matrix = np.zero((len(edge_cut_range), len(track_length_range)))
-    fake_rate_matrix = np.zero((len(edge_cut_range), len(track_length_range)))
-
-    for i, edge_cut in enumerate(edge_cut_range):
-        for j, track_length in enumerate(track_length_range):
 
-            track_candidates = get_track_candidates(edge_scores, edge_cut)
-            # TODO
-            # track_candidates = clean_track_candidates(track_candidates)
+    counts = np.zeros((len(edge_cut_range), len(track_length_range), 4), dtype=np.int64)
+    for event in events:
+        edge_index = event.edge_index.cpu().numpy()
 
-            selected_tracks = get_selected_tracks(track_candidates, track_length)
-            n_selected_tracks = len(selected_tracks)
+        # half the length, gnn gives scores for bidirected graphs
+        scores = event.scores[: edge_index.shape[1]].cpu().numpy()
 
-            (
-                n_matched_tracks,
-                n_trackable_particles,
-                n_matched_tracks_ROI,
-                n_trackable_particles_ROI,
-            ) = evaluate_tracks(
-                truth,
-                particles,
-                tracks,
-                frac_reco_matched=0.5,
-                frac_truth_matched=0.5,
-                ROI=ROI,
-            )
-
-            # IGNORE ROI (Region of Interest) FOR NOW...
+        counts += scan_edge_cuts(
+            edge_index, scores, event.pid.cpu().numpy().astype(np.int64),
+            edge_cut_range, track_length_range, **kwargs
+        )
 
-            efficiency_matrix[i, j] = n_matched_tracks / n_trackable_particles
-            fake_rate_matrix[i, j] = n_matched_tracks / n_selected_tracks
+    n_trackable, n_matched_particles, n_selected_tracks, n_matched_tracks = np.moveaxis(counts, -1, 0)
+    efficiency_matrix = n_matched_particles / np.maximum(n_trackable, 1)
+    fake_rate_matrix = 1 - n_matched_tracks / np.maximum(n_selected_tracks, 1)
 
     return efficiency_matrix, fake_rate_matrix, edge_cut_range, track_length_range
 
@@ -65,7 +150,7 @@ def obtain_target_fake_rate(
 ):
 
     edge_cut_matrix = np.tile(edge_cut_range, (len(track_length_range), 1)).T
-    track_length_matrix = np.tile(track_length_range, (len_edge_cut_range), 1)
+    track_length_matrix = np.tile(track_length_range, (len(edge_cut_range), 1))
 
     assert (
         fake_rate_matrix < target_fake_rate
@@ -77,7 +162,7 @@ def obtain_target_fake_rate(
     )
 
     best_fake_rate = fake_rate_matrix[fake_rates_passing_cut][best_fake_rate_arg]
-    best_efficiency = edge_cut_matrix[fake_rates_passing_cut][best_fake_rate_arg]
+    best_efficiency = efficiency_matrix[fake_rates_passing_cut][best_fake_rate_arg]
     best_edge_cut = edge_cut_matrix[fake_rates_passing_cut][best_fake_rate_arg]
     best_track_length = track_length_matrix[fake_rates_passing_cut][best_fake_rate_arg]
 
@@ -118,140 +203,27 @@ def evaluate_reco_tracks(
                 by reconstructed tracks
         )
     """
-    # just in case particle_id == 0 included in truth.
-    if "particle_id" in truth.columns:
-        truth = truth[truth.particle_id > 0]
-
-    # get number of spacepoints in each reconstructed tracks
-    n_reco_hits = (
-        reconstructed.track_id.value_counts(sort=False)
-        .reset_index()
-        .rename(columns={"index": "track_id", "track_id": "n_reco_hits"})
+    results = match_reco_tracks(
+        truth.hit_id.values,
+        truth.particle_id.values,
+        reconstructed.hit_id.values,
+        reconstructed.track_id.values,
+        particles.particle_id.values,
+        min_hits_truth=min_hits_truth,
+        min_hits_reco=min_hits_reco,
+        frac_reco_matched=frac_reco_matched,
+        frac_truth_matched=frac_truth_matched,
     )
 
-    # only tracks with a minimum number of spacepoints are considered
-    n_reco_hits = n_reco_hits[n_reco_hits.n_reco_hits >= min_hits_reco]
-    reconstructed = reconstructed[
-        reconstructed.track_id.isin(n_reco_hits.track_id.values)
-    ]
-
-    # get number of spacepoints in each particle
-    hits = truth.merge(particles, on="particle_id", how="left")
-    n_true_hits = (
-        hits.particle_id.value_counts(sort=False)
-        .reset_index()
-        .rename(columns={"index": "particle_id", "particle_id": "n_true_hits"})
+    n_true_hits, is_matched, is_trackable = results[-3:]
+    if not np.isnan(n_true_hits).any():
+        n_true_hits = n_true_hits.astype(np.int64)
+    particles = particles.reset_index(drop=True).assign(
+        n_true_hits=n_true_hits, is_matched=is_matched, is_trackable=is_trackable
     )
 
-    # only particles leaves at least min_hits_truth spacepoints
-    # and with pT >= min_pt are considered.
-    particles = particles.merge(n_true_hits, on=["particle_id"], how="left")
-
-    is_trackable = particles.n_true_hits >= min_hits_truth
-
-    # event has 3 columnes [track_id, particle_id, hit_id]
-    event = pd.merge(reconstructed, truth, on=["hit_id"], how="left")
-
-    # n_common_hits and n_shared should be exactly the same
-    # for a specific track id and particle id
-
-    # Each track_id will be assigned to multiple particles.
-    # To determine which particle the track candidate is matched to,
-    # we use the particle id that yields a maximum value of n_common_hits / n_reco_hits,
-    # which means the majority of the spacepoints associated with the reconstructed
-    # track candidate comes from that true track.
-    # However, the other way may not be true.
-    reco_matching = (
-        event.groupby(["track_id", "particle_id"])
-        .size()
-        .reset_index()
-        .rename(columns={0: "n_common_hits"})
-    )
-
-    # Each particle will be assigned to multiple reconstructed tracks
-    truth_matching = (
-        event.groupby(["particle_id", "track_id"])
-        .size()
-        .reset_index()
-        .rename(columns={0: "n_shared"})
-    )
-
-    # add number of hits to each of the maching dataframe
-    reco_matching = reco_matching.merge(n_reco_hits, on=["track_id"], how="left")
-    truth_matching = truth_matching.merge(n_true_hits, on=["particle_id"], how="left")
-
-    # calculate matching fraction
-    reco_matching = reco_matching.assign(
-        purity_reco=np.true_divide(
-            reco_matching.n_common_hits, reco_matching.n_reco_hits
-        )
-    )
-    truth_matching = truth_matching.assign(
-        purity_true=np.true_divide(truth_matching.n_shared, truth_matching.n_true_hits)
-    )
-
-    # select the best match
-    reco_matching["purity_reco_max"] = reco_matching.groupby("track_id")[
-        "purity_reco"
-    ].transform(max)
-    truth_matching["purity_true_max"] = truth_matching.groupby("track_id")[
-        "purity_true"
-    ].transform(max)
-
-    matched_reco_tracks = reco_matching[
-        (reco_matching.purity_reco_max >= frac_reco_matched)
-        & (reco_matching.purity_reco == reco_matching.purity_reco_max)
-    ]
-
-    matched_true_particles = truth_matching[
-        (truth_matching.purity_true_max >= frac_truth_matched)
-        & (truth_matching.purity_true == truth_matching.purity_true_max)
-    ]
-
-    # now, let's combine the two majority criteria
-    # reconstructed tracks must be in both matched dataframe
-    # and the so matched particle should be the same
-    # in this way, each track should be only assigned
-    combined_match = matched_true_particles.merge(
-        matched_reco_tracks, on=["track_id", "particle_id"], how="inner"
-    )
-
-    n_reco_tracks = n_reco_hits.shape[0]
-    n_true_tracks = particles.shape[0]
-
-    # For GNN, there are non-negaliable cases where GNN-based
-    # track candidates are matched to particles not considered as interesting.
-    # which means there are paticles in matched_pids that do not exist in particles.
-    matched_pids = np.unique(combined_match.particle_id)
-
-    is_matched = particles.particle_id.isin(matched_pids).values
-    n_matched_particles = np.sum(is_matched)
-
-    n_matched_tracks = reco_matching[
-        reco_matching.purity_reco >= frac_reco_matched
-    ].shape[0]
-    n_matched_tracks_poi = reco_matching[
-        (reco_matching.purity_reco >= frac_reco_matched)
-        & (reco_matching.particle_id.isin(particles.particle_id.values))
-    ].shape[0]
-    # print(n_matched_tracks_poi, n_matched_tracks)
-
-    # num_particles_matched_to = reco_matched.groupby("particle_id")['track_id']\
-    #     .count().reset_index().rename(columns={"track_id": "n_tracks_matched"})
-    # n_duplicated_tracks = num_particles_matched_to.shape[0]
-    n_duplicated_tracks = n_matched_tracks_poi - n_matched_particles
-
-    particles = particles.assign(is_matched=is_matched, is_trackable=is_trackable)
-
-    return (
-        n_true_tracks,
-        n_reco_tracks,
-        n_matched_particles,
-        n_matched_tracks,
-        n_duplicated_tracks,
-        n_matched_tracks_poi,
-        particles,
-    )
+    # the six counters up to n_matched_tracks_poi
+    return results[:6] + (particles,)
 
 
 def run_one_evt(evtid, csv_reader, recotrkx_reader, **kwargs):
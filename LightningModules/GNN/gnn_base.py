@@ -4,21 +4,14 @@
 # NOTE: gnn_base is exactly same as gnn_base (from ctd2022p repo).
 
 import os
+import time
 import torch
 import numpy as np
 import torch.nn.functional as F
-from torch_geometric.loader import DataLoader
+from torch.utils.data import DataLoader
 import pytorch_lightning as pl
-from .utils.data_utils import split_datasets
-from sklearn.metrics import roc_auc_score, accuracy_score
-
-
-def roc_auc_score_robust(y_true, y_pred):
-    # Handle if y_true holds only one class
-    if len(np.unique(y_true)) == 1:
-        return accuracy_score(y_true, np.rint(y_pred))
-    else:
-        return roc_auc_score(y_true, y_pred)
+from .utils.data_utils import split_datasets, collate_events
+from LightningModules.utils.metric_utils import HistogramMetrics, roc_auc_score_robust
 
 
 class GNNBase(pl.LightningModule):
@@ -36,6 +29,16 @@ class GNNBase(pl.LightningModule):
             else len(os.sched_getaffinity(0))
         )
 
+        # Prefetch depth of each worker, workers are kept alive across epochs
+        self.loader_kwargs = (
+            {"prefetch_factor": self.hparams["prefetch_factor"], "persistent_workers": True}
+            if "prefetch_factor" in self.hparams and self.n_workers > 0
+            else {}
+        )
+
+        # Number of events per batch, collated into one graph of disjoint events
+        self.batch_size = self.hparams["batchsize"] if "batchsize" in self.hparams else 1
+
         # Instance Variables
         self.trainset, self.valset, self.testset = None, None, None
 
@@ -47,7 +50,8 @@ class GNNBase(pl.LightningModule):
     def train_dataloader(self):
         if self.trainset is not None:
             return DataLoader(
-                self.trainset, batch_size=1, num_workers=self.n_workers
+                self.trainset, batch_size=self.batch_size, num_workers=self.n_workers,
+                collate_fn=collate_events, **self.loader_kwargs
             )  # , pin_memory=True, persistent_workers=True)
         else:
             return None
@@ -55,7 +59,8 @@ class GNNBase(pl.LightningModule):
     def val_dataloader(self):
         if self.valset is not None:
             return DataLoader(
-                self.valset, batch_size=1, num_workers=self.n_workers
+                self.valset, batch_size=self.batch_size, num_workers=self.n_workers,
+                collate_fn=collate_events, **self.loader_kwargs
             )  # , pin_memory=True, persistent_workers=True)
         else:
             return None
@@ -63,7 +68,8 @@ class GNNBase(pl.LightningModule):
     def test_dataloader(self):
         if self.testset is not None:
             return DataLoader(
-                self.testset, batch_size=1, num_workers=self.n_workers
+                self.testset, batch_size=self.batch_size, num_workers=self.n_workers,
+                collate_fn=collate_events, **self.loader_kwargs
             )  # , pin_memory=True, persistent_workers=True)
         else:
             return None
@@ -108,19 +114,33 @@ class GNNBase(pl.LightningModule):
         return input_data
 
     # 2 - Helper Function
-    def handle_directed(self, batch, edge_sample, truth_sample):
+    def handle_directed(self, batch, edge_sample, truth_sample, weight_sample=None):
 
         edge_sample = torch.cat([edge_sample, edge_sample.flip(0)], dim=-1)
         truth_sample = truth_sample.repeat(2)
+        if weight_sample is not None:
+            weight_sample = weight_sample.repeat(2)
 
         if ("directed" in self.hparams.keys()) and self.hparams["directed"]:
             direction_mask = batch.x[edge_sample[0], 0] < batch.x[edge_sample[1], 0]
             edge_sample = edge_sample[:, direction_mask]
             truth_sample = truth_sample[direction_mask]
+            if weight_sample is not None:
+                weight_sample = weight_sample[direction_mask]
 
-        return edge_sample, truth_sample
+        return edge_sample, truth_sample, weight_sample
 
     # 3 - Helper Function
+    def get_pos_weight(self, batch):
+
+        if "weight" in self.hparams:
+            return torch.tensor(self.hparams["weight"], device=self.device)
+
+        # ratio of fake to true edges, over all events of the batch
+        y_pid = batch.y_pid.bool()
+        return (~y_pid).sum() / y_pid.sum().clamp(min=1)
+
+    # 4 - Helper Function
     def log_metrics(self, score, preds, truth, batch, loss):
 
         edge_positive = preds.sum().float()
@@ -132,8 +152,9 @@ class GNNBase(pl.LightningModule):
         eff = edge_true_positive.clone().detach() / max(1, edge_true)
         pur = edge_true_positive.clone().detach() / max(1, edge_positive)
 
-        # special function to handle classes in y_true
-        auc = roc_auc_score_robust(truth.bool().cpu().detach(), score.cpu().detach())
+        # special function to handle classes in y_true, on the device of the scores
+        auc = roc_auc_score_robust(truth, score)
+        self.val_histogram.update(score, truth)
 
         current_lr = self.optimizers().param_groups[0]["lr"]
         self.log_dict(
@@ -143,61 +164,57 @@ class GNNBase(pl.LightningModule):
                 "eff": eff,
                 "pur": pur,
                 "current_lr": current_lr,
-            }, on_step=False, on_epoch=True, prog_bar=False, batch_size=10240
+            }, on_step=False, on_epoch=True, prog_bar=False, batch_size=batch.num_graphs
         )
 
     # Train Step
     def training_step(self, batch, batch_idx):
 
-        weight = (
-            torch.tensor(self.hparams["weight"])
-            if ("weight" in self.hparams)
-            else torch.tensor((~batch.y_pid.bool()).sum() / batch.y_pid.sum())
-        )
+        weight = self.get_pos_weight(batch)
 
         truth = (
             batch.y_pid.bool() if "pid" in self.hparams["regime"] else batch.y.bool()
         )
 
-        edge_sample, truth_sample = self.handle_directed(batch, batch.edge_index, truth)
-        input_data = self.get_input_data(batch)
-        output = self(input_data, edge_sample).squeeze()
-
         if "weighting" in self.hparams["regime"]:
             manual_weights = batch.weights
         else:
             manual_weights = None
 
+        edge_sample, truth_sample, manual_weights = self.handle_directed(
+            batch, batch.edge_index, truth, manual_weights
+        )
+        input_data = self.get_input_data(batch)
+        output = self(input_data, edge_sample).squeeze()
+
         loss = F.binary_cross_entropy_with_logits(
             output, truth_sample.float(), weight=manual_weights, pos_weight=weight
         )
 
-        self.log("train_loss", loss, on_step=False, on_epoch=True, prog_bar=False, batch_size=10240)
+        self.log("train_loss", loss, on_step=False, on_epoch=True, prog_bar=False, batch_size=batch.num_graphs)
 
         return loss
 
     # Shared Evaluation for Validation and Test Steps
     def shared_evaluation(self, batch, batch_idx, log=False):
 
-        weight = (
-            torch.tensor(self.hparams["weight"])
-            if ("weight" in self.hparams)
-            else torch.tensor((~batch.y_pid.bool()).sum() / batch.y_pid.sum())
-        )
+        weight = self.get_pos_weight(batch)
 
         truth = (
             batch.y_pid.bool() if "pid" in self.hparams["regime"] else batch.y.bool()
         )
 
-        edge_sample, truth_sample = self.handle_directed(batch, batch.edge_index, truth)
-        input_data = self.get_input_data(batch)
-        output = self(input_data, edge_sample).squeeze()
-
         if "weighting" in self.hparams["regime"]:
             manual_weights = batch.weights
         else:
             manual_weights = None
 
+        edge_sample, truth_sample, manual_weights = self.handle_directed(
+            batch, batch.edge_index, truth, manual_weights
+        )
+        input_data = self.get_input_data(batch)
+        output = self(input_data, edge_sample).squeeze()
+
         loss = F.binary_cross_entropy_with_logits(
             output, truth_sample.float(), weight=manual_weights, pos_weight=weight
         )
@@ -218,6 +235,20 @@ class GNNBase(pl.LightningModule):
 
         return outputs["loss"]
 
+    # Epoch-level AUC, from the score histograms of all validation batches (and processes)
+    def on_validation_epoch_start(self):
+        n_bins = self.hparams["metric_bins"] if "metric_bins" in self.hparams else 10000
+        self.val_histogram = HistogramMetrics(n_bins=n_bins)
+
+    def on_validation_epoch_end(self):
+        histogram = self.val_histogram
+        for key in ["true_counts", "fake_counts"]:
+            counts = getattr(histogram, key)
+            setattr(histogram, key, self.all_gather(counts).view(-1, counts.shape[0]).sum(0))
+
+        if histogram.n_true + histogram.n_fake > 0:
+            self.log("epoch_auc", float(histogram.roc_auc()))
+
     # Test Step
     def test_step(self, batch, batch_idx):
 
@@ -225,6 +256,24 @@ class GNNBase(pl.LightningModule):
 
         return outputs
 
+    # Training Throughput (events/sec), e.g. to choose the batch size
+    def on_train_epoch_start(self):
+        self.train_events, self.train_time = 0, 0.
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, outputs, batch, batch_idx, *args):
+        step_end = time.perf_counter()
+        self.train_events += batch.num_graphs
+        self.train_time += step_end - self.step_start
+        self.step_start = step_end
+
+    def on_validation_end(self):
+        # time spent in validation is not training time
+        self.step_start = time.perf_counter()
+
+    def on_train_epoch_end(self, *args):
+        self.log("events_per_sec", self.train_events / max(self.train_time, 1e-9))
+
     # Optimizer Step
     def optimizer_step(
             self,
@@ -10,15 +10,7 @@ import torch.nn.functional as F
 from torch_geometric.loader import DataLoader
 import pytorch_lightning as pl
 from .utils.gnn_utils import load_dataset
-from sklearn.metrics import roc_auc_score, accuracy_score
-
-
-def roc_auc_score_robust(y_true, y_pred):
-    # Handle if y_true holds only one class
-    if len(np.unique(y_true)) == 1:
-        return accuracy_score(y_true, np.rint(y_pred))
-    else:
-        return roc_auc_score(y_true, y_pred)
+from LightningModules.utils.metric_utils import HistogramMetrics, roc_auc_score_robust
 
 
 class GNNBase(pl.LightningModule):
@@ -148,8 +140,9 @@ class GNNBase(pl.LightningModule):
         eff = edge_true_positive.clone().detach() / max(1, edge_true)
         pur = edge_true_positive.clone().detach() / max(1, edge_positive)
         
-        # special function to handle classes in y_true
-        auc = roc_auc_score_robust(truth.bool().cpu().detach(), score.cpu().detach())
+        # special function to handle classes in y_true, on the device of the scores
+        auc = roc_auc_score_robust(truth, score)
+        self.val_histogram.update(score, truth)
         
         current_lr = self.optimizers().param_groups[0]["lr"]
         self.log_dict(
@@ -234,6 +227,20 @@ class GNNBase(pl.LightningModule):
 
         return outputs["loss"]
 
+    # Epoch-level AUC, from the score histograms of all validation batches (and processes)
+    def on_validation_epoch_start(self):
+        n_bins = self.hparams["metric_bins"] if "metric_bins" in self.hparams else 10000
+        self.val_histogram = HistogramMetrics(n_bins=n_bins)
+
+    def on_validation_epoch_end(self):
+        histogram = self.val_histogram
+        for key in ["true_counts", "fake_counts"]:
+            counts = getattr(histogram, key)
+            setattr(histogram, key, self.all_gather(counts).view(-1, counts.shape[0]).sum(0))
+
+        if histogram.n_true + histogram.n_fake > 0:
+            self.log("epoch_auc", float(histogram.roc_auc()))
+
     # Test Step
     def test_step(self, batch, batch_idx):
 
@@ -2,9 +2,15 @@
 # coding: utf-8
 
 import os
+import copy
 import random
 import torch
+from functools import partial
 from torch.utils.data import random_split
+from torch_geometric.data import Batch, Data, Dataset
+from LightningModules.utils.shard_utils import list_events, load_event
+from LightningModules.utils.flat_utils import is_flat, build_flat_dataset, FlatEventDataset
+from LightningModules.utils.cache_utils import SelectCache
 
 # Find the current device.
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -33,15 +39,30 @@ def split_datasets(
         train_split = kwargs["datatype_split"]
     torch.manual_seed(seed)
     
-    # load data
-    loaded_events = load_dataset(
-        input_dir,
-        sum(train_split),
-        pt_background_cut,
-        pt_signal_cut,
-        noise,
-        **kwargs
-    )
+    # memory-mapped flat copy of input_dir, built once
+    if "flat_dir" in kwargs and kwargs["flat_dir"] is not None:
+        input_dir = build_flat_dataset(input_dir, kwargs["flat_dir"])
+    
+    # load data, or only list it when events are streamed from disk
+    if "lazy_loading" in kwargs and kwargs["lazy_loading"] and not is_flat(input_dir):
+        loaded_events = load_lazy_dataset(
+            input_dir,
+            sum(train_split),
+            pt_background_cut,
+            pt_signal_cut,
+            noise,
+            seed,
+            **kwargs
+        )
+    else:
+        loaded_events = load_dataset(
+            input_dir,
+            sum(train_split),
+            pt_background_cut,
+            pt_signal_cut,
+            noise,
+            **kwargs
+        )
     
     # split data
     train_events, val_events, test_events = random_split(loaded_events, train_split)
@@ -51,6 +72,37 @@ def split_datasets(
     return train_events, val_events, test_events
   
 
+class EventData(Data):
+    """Data with the true edge lists (e.g. signal_true_edges) batched like edge_index, i.e.
+    concatenated along the last dimension and shifted by the number of nodes of previous events."""
+
+    def __cat_dim__(self, key, value, *args, **kwargs):
+        if "edges" in key:
+            return -1
+        return super().__cat_dim__(key, value, *args, **kwargs)
+
+    def __inc__(self, key, value, *args, **kwargs):
+        if "edges" in key:
+            return self.num_nodes
+        return super().__inc__(key, value, *args, **kwargs)
+
+
+def collate_events(events):
+    """Collate events into a single Batch, a graph of disjoint events."""
+    return Batch.from_data_list([EventData(**dict(event)) for event in events])
+
+
+def compact_event(event):
+    """Shallow copy of an event with a compact copy of every tensor. Tensors of a FlatEventDataset
+    are views of the memory-mapped arrays of all events, and torch.save() writes the whole storage
+    of a view, i.e. every event would be saved with the flat arrays of the dataset."""
+    event = copy.copy(event)
+    for key, value in event:
+        if torch.is_tensor(value):
+            event[key] = value.clone(memory_format=torch.contiguous_format)
+    return event
+
+
 def load_dataset(
         input_subdir="",
         num_events=10,
@@ -60,9 +112,15 @@ def load_dataset(
         **kwargs
 ):
     
+    # Memory-mapped events, selection is applied when an event is accessed
+    if is_flat(input_subdir):
+        return load_flat_dataset(
+            input_subdir, num_events, pt_background_cut, pt_signal_cut, noise, **kwargs
+        )
+
     # Load dataset from a subdir
     if input_subdir is not None:
-        all_events = os.listdir(input_subdir)
+        all_events = list_events(input_subdir)
 
         if "sorted_events" in kwargs.keys() and kwargs["sorted_events"]:
             all_events = sorted(all_events)
@@ -71,10 +129,20 @@ def load_dataset(
 
         all_events = [os.path.join(input_subdir, event) for event in all_events]
         loaded_events = [
-            torch.load(event, map_location=torch.device("cpu"))
+            load_event(event, map_location=torch.device("cpu"))
             for event in all_events[:num_events]
         ]
         
+        # Derived data of previous launches with the same cuts
+        if "select_cache_dir" in kwargs.keys() and kwargs["select_cache_dir"] is not None:
+            cache = SelectCache(
+                kwargs["select_cache_dir"], input_subdir,
+                pt_background_cut=pt_background_cut, pt_signal_cut=pt_signal_cut, noise=noise,
+            )
+            return select_data_cached(
+                loaded_events, all_events[:num_events], cache, pt_background_cut, pt_signal_cut, noise
+            )
+        
         loaded_events = select_data(
             loaded_events, pt_background_cut, pt_signal_cut, noise
         )
@@ -83,6 +151,106 @@ def load_dataset(
         return None
 
 
+def load_flat_dataset(
+        input_subdir="",
+        num_events=10,
+        pt_background_cut=0,
+        pt_signal_cut=0,
+        noise=False,
+        **kwargs
+):
+    
+    # Dataset with zero-copy event slices of the flat-tensor files
+    dataset = FlatEventDataset(
+        input_subdir,
+        transform=partial(
+            select_event,
+            pt_background_cut=pt_background_cut,
+            pt_signal_cut=pt_signal_cut,
+            noise=noise,
+        ),
+    )
+    
+    # Events are stored sorted by event id
+    indices = list(range(len(dataset)))
+    if not ("sorted_events" in kwargs.keys() and kwargs["sorted_events"]):
+        random.shuffle(indices)
+    
+    return dataset.index_select(indices[:num_events])
+
+
+def load_lazy_dataset(
+        input_subdir="",
+        num_events=10,
+        pt_background_cut=0,
+        pt_signal_cut=0,
+        noise=False,
+        seed=1,
+        **kwargs
+):
+    
+    # Events sorted by event id, and shuffled with the seed, so the split only depends on event ids
+    all_events = sorted(list_events(input_subdir))
+    if not ("sorted_events" in kwargs.keys() and kwargs["sorted_events"]):
+        order = torch.randperm(len(all_events), generator=torch.Generator().manual_seed(seed))
+        all_events = [all_events[i] for i in order]
+    
+    all_events = [os.path.join(input_subdir, event) for event in all_events]
+    return LazyEventDataset(
+        all_events[:num_events], pt_background_cut, pt_signal_cut, noise
+    )
+
+
+class LazyEventDataset(Dataset):
+    """Streaming version of hetero_gnn_utils.LargeDataset, an event is only loaded when
+    accessed (e.g. by a DataLoader worker) and the select_data() cuts are applied on the fly."""
+
+    def __init__(self, input_paths, pt_background_cut=0, pt_signal_cut=0, noise=False, transform=None):
+        super().__init__(None, transform)
+
+        self.input_paths = input_paths
+        self.pt_background_cut = pt_background_cut
+        self.pt_signal_cut = pt_signal_cut
+        self.noise = noise
+
+    def len(self):
+        return len(self.input_paths)
+
+    def get(self, idx):
+        event = load_event(self.input_paths[idx], map_location=torch.device("cpu"))
+        return select_event(event, self.pt_background_cut, self.pt_signal_cut, self.noise)
+
+
+def select_event(event, pt_background_cut, pt_signal_cut, noise):
+    return select_data(event, pt_background_cut, pt_signal_cut, noise)[0]
+
+
+# Event attributes set by select_data(), hence stored in the select cache
+SELECT_KEYS = ["edge_index", "y", "weights", "y_pid", "signal_true_edges"]
+
+
+def select_data_cached(events, event_files, cache, pt_background_cut, pt_signal_cut, noise):
+    """Same as select_data(), with the outputs of events found in the cache set as they are.
+    The others are selected, then added to the cache."""
+
+    missed = []
+    for event, event_file in zip(events, event_files):
+        cached = cache.get(event_file)
+        if cached is None:
+            missed.append((event, event_file))
+            continue
+        for key in cached:
+            event[key] = cached[key]
+
+    select_data([event for event, _ in missed], pt_background_cut, pt_signal_cut, noise)
+    for event, event_file in missed:
+        cache.put(event_file, event, SELECT_KEYS)
+    cache.save()
+
+    print("Select cache: {} events cached, {} selected".format(len(events) - len(missed), len(missed)))
+    return events
+
+
 def select_data(events, pt_background_cut, pt_signal_cut, noise):
 
     # Handle event in batched form
@@ -100,22 +268,22 @@ def select_data(events, pt_background_cut, pt_signal_cut, noise):
             # Apply Mask on "edge_index, y, weights, y_pid"
             event.edge_index = event.edge_index[:, edge_mask]
             
-            if "y" in event.__dict__.keys():
+            if "y" in event:
                 event.y = event.y[edge_mask]
             
-            if "weights" in event.__dict__.keys():
+            if "weights" in event:
                 if event.weights.shape[0] == edge_mask.shape[0]:
                     event.weights = event.weights[edge_mask]
 
-            if "y_pid" in event.__dict__.keys():
+            if "y_pid" in event:
                 event.y_pid = event.y_pid[edge_mask]
 
     for event in events:
-        if "y_pid" not in event.__dict__.keys():
+        if "y_pid" not in event:
             event.y_pid = (event.pid[event.edge_index[0]] == event.pid[event.edge_index[1]]) & \
                           event.pid[event.edge_index[0]].bool()
 
-        if "signal_true_edges" in event.__dict__.keys() and event.signal_true_edges is not None:
+        if "signal_true_edges" in event and event.signal_true_edges is not None:
             signal_mask = (event.pt[event.signal_true_edges] > pt_signal_cut).all(0)
             event.signal_true_edges = event.signal_true_edges[:, signal_mask]
 
@@ -103,22 +103,22 @@ def select_data(events, pt_background_cut, pt_signal_cut, noise):
             # Apply Mask on "edge_index, y, weights, y_pid"
             event.edge_index = event.edge_index[:, edge_mask]
             
-            if "y" in event.__dict__.keys():
+            if "y" in event:
                 event.y = event.y[edge_mask]
 
-            if "weights" in event.__dict__.keys():
+            if "weights" in event:
                 if event.weights.shape[0] == edge_mask.shape[0]:
                     event.weights = event.weights[edge_mask]
 
-            if "y_pid" in event.__dict__.keys():
+            if "y_pid" in event:
                 event.y_pid = event.y_pid[edge_mask]
 
     for event in events:
-        if "y_pid" not in event.__dict__.keys():
+        if "y_pid" not in event:
             event.y_pid = (event.pid[event.edge_index[0]] == event.pid[event.edge_index[1]]) & event.pid[
                 event.edge_index[0]].bool()
 
-        if "signal_true_edges" in event.__dict__.keys() and event.signal_true_edges is not None:
+        if "signal_true_edges" in event and event.signal_true_edges is not None:
             signal_mask = (event.pt[event.signal_true_edges] > pt_signal_cut).all(0)
             event.signal_true_edges = event.signal_true_edges[:, signal_mask]
 
@@ -78,7 +78,7 @@ def process_data(events, pt_background_cut, pt_signal_cut, noise, triplets, inpu
 
         event.pid_signal = torch.isin(event.edge_index, event.signal_true_edges).all(0) & event.y_pid
 
-        if (input_cut is not None) and "scores" in event.keys:
+        if (input_cut is not None) and "scores" in event:
             score_mask = event.scores > input_cut
             for edge_attr in ["edge_index", "y", "y_pid", "pid_signal", "scores"]:
                 event[edge_attr] = event[edge_attr][..., score_mask]
@@ -92,15 +92,15 @@ def background_cut_event(event, pt_background_cut=0, pt_signal_cut=0):
     event.edge_index = event.edge_index[:, edge_mask]
     event.y = event.y[edge_mask]
 
-    if "y_pid" in event.__dict__.keys():
+    if "y_pid" in event:
         event.y_pid = event.y_pid[edge_mask]
 
-    if "weights" in event.__dict__.keys():
+    if "weights" in event:
         if event.weights.shape[0] == edge_mask.shape[0]:
             event.weights = event.weights[edge_mask]
 
     if (
-            "signal_true_edges" in event.__dict__.keys()
+            "signal_true_edges" in event
             and event.signal_true_edges is not None
     ):
         signal_mask = (
@@ -147,13 +147,13 @@ class LargeDataset(Dataset):
         if "delta_eta" in self.hparams.keys():
             eta_mask = hard_eta_edge_slice(self.hparams["delta_eta"], event)
             for edge_attr in ["edge_index", "y", "y_pid", "pid_signal", "scores"]:
-                if edge_attr in event.keys:
+                if edge_attr in event:
                     event[edge_attr] = event[edge_attr][..., eta_mask]
 
-        if ("input_cut" in self.hparams.keys()) and (self.hparams["input_cut"] is not None) and "scores" in event.keys:
+        if ("input_cut" in self.hparams.keys()) and (self.hparams["input_cut"] is not None) and "scores" in event:
             score_mask = event.scores > self.hparams["input_cut"]
             for edge_attr in ["edge_index", "y", "y_pid", "pid_signal", "scores"]:
-                if edge_attr in event.keys:
+                if edge_attr in event:
                     event[edge_attr] = event[edge_attr][..., score_mask]
 
         return event
@@ -4,10 +4,12 @@
 import os
 import numpy as np
 from functools import partial
-from tqdm.contrib.concurrent import process_map
 
 from ..feature_store_base import FeatureStoreBase
 from ..utils.event_utils import prepare_event
+from ..utils.store_utils import build_event_store, list_store_events, count_store_hits
+from ..utils.manifest_utils import get_event_sizes, balance_events, process_events
+from LightningModules.utils.geometry_utils import DETECTOR_PATH, get_geometry
 # from ..utils.detector_utils import load_detector
 
 
@@ -15,17 +17,29 @@ class TrackMLFeatureStore(FeatureStoreBase):
     def __init__(self, hparams):
         super().__init__(hparams)
         
-        # self.detector_path = self.hparams["detector_path"]
+        self.detector_path = (
+            self.hparams["detector_path"] if "detector_path" in self.hparams else DETECTOR_PATH
+        )
 
     def prepare_data(self):
-        # Find the input files
-        all_files = os.listdir(self.input_dir)
-        all_events = sorted(
-            np.unique([os.path.join(self.input_dir, event[:15]) for event in all_files])
-        )[: self.n_files]
-
-        # Split the input files by number of tasks and select my chunk only
-        all_events = np.array_split(all_events, self.n_tasks)[self.task]
+        # Find the input files, from the columnar event store if one is used (built once from CSV)
+        if self.event_store is not None:
+            build_event_store(self.input_dir, self.event_store, show_progress=self.show_progress)
+            all_events = [
+                os.path.join(self.input_dir, "event{:010d}".format(evtid))
+                for evtid in list_store_events(self.event_store)
+            ][: self.n_files]
+            n_hits = count_store_hits(self.event_store)
+            sizes = {event_file: n_hits.get(int(event_file[-10:]), 0) for event_file in all_events}
+        else:
+            all_files = os.listdir(self.input_dir)
+            all_events = sorted(
+                np.unique([os.path.join(self.input_dir, event[:15]) for event in all_files])
+            )[: self.n_files]
+            sizes = get_event_sizes(all_events)
+
+        # Split the input files by number of tasks, balanced by event size, and select my chunk only
+        all_events = balance_events(all_events, sizes, self.n_tasks)[self.task]
         
         # ADAK: I have remove cell_features and detector path (Adeel)
         # TODO: Reomve or make such a info for STT as well.
@@ -38,7 +52,14 @@ class TrackMLFeatureStore(FeatureStoreBase):
         os.makedirs(self.output_dir, exist_ok=True)
         print("Writing outputs to " + self.output_dir)
 
-        # Process input files with a worker pool and progress bar
-        # Use process_mp() from tqdm instead of mp.Pool from multiprocessing.
+        # Compile the geometry table once, forked workers share it
+        get_geometry(self.detector_path)
+
+        # Process input files with a worker pool and progress bar, largest first. Every event
+        # is recorded in the manifest, events done are skipped on resume and failed ones retried.
         process_func = partial(prepare_event, **self.hparams)
-        process_map(process_func, all_events, max_workers=self.n_workers, chunksize=self.chunksize)
+        process_events(
+            process_func, all_events, self.manifest_dir, sizes=sizes, n_workers=self.n_workers,
+            chunksize=self.chunksize, max_retries=self.max_retries, resume=self.resume,
+            show_progress=self.show_progress,
+        )
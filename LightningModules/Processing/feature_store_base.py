@@ -3,6 +3,7 @@
 
 import os
 from pytorch_lightning import LightningDataModule
+from .utils.manifest_utils import get_manifest_dir
 
 
 class FeatureStoreBase(LightningDataModule):
@@ -30,3 +31,21 @@ class FeatureStoreBase(LightningDataModule):
         self.show_progress = (
             self.hparams["show_progress"] if "show_progress" in self.hparams else True
         )
+        self.event_store = (
+            self.hparams["event_store"] if "event_store" in self.hparams else None
+        )
+
+        # Manifest of processed events, to resume a preempted job and retry failed events
+        self.manifest_dir = (
+            self.hparams["manifest_dir"]
+            if "manifest_dir" in self.hparams
+            else get_manifest_dir(self.output_dir)
+        )
+        self.resume = (
+            self.hparams["resume"]
+            if "resume" in self.hparams
+            else not (self.hparams["overwrite"] if "overwrite" in self.hparams else False)
+        )
+        self.max_retries = (
+            self.hparams["max_retries"] if "max_retries" in self.hparams else 1
+        )
@@ -7,6 +7,7 @@ import os
 import glob
 import torch
 from typing import Any
+from LightningModules.utils.shard_utils import list_events, load_event
 
 
 # PyTorch Geometric Data Reader
@@ -17,14 +18,14 @@ class SttTorchDataReader(object):
         """Initialize Instance Variables in Constructor"""
         
         self.path = input_dir
-        all_files = sorted(glob.glob(os.path.join(input_dir, "*")))
+        all_files = sorted(list_events(input_dir))
         self.nevts = len(all_files)
         self.all_evtids = [os.path.basename(x) for x in all_files]
     
     def read(self, evtid: int = None):
         """Read an Event from the Input Directory."""
         event_fname = os.path.join(self.path, "{}".format(evtid))
-        event = torch.load(event_fname)
+        event = load_event(event_fname, map_location=None)
         return event
     
     def __call__(self, evtid: int, *args: Any, **kwds: Any) -> Any:
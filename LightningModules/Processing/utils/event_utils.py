@@ -12,7 +12,6 @@ More fine-grained utilities are reserved for `detector_utils` and `cell_utils`.
 
 import os
 import logging
-import itertools
 
 import scipy as sp
 import numpy as np
@@ -21,12 +20,26 @@ import trackml.dataset
 
 import torch
 from torch_geometric.data import Data
-from .graph_utils import get_input_edges, graph_intersection
+from .graph_utils import get_input_edges, graph_intersection, ragged_arange
+from .store_utils import load_event_from_store
+from LightningModules.utils.geometry_utils import DETECTOR_PATH, get_geometry
+from LightningModules.utils.shard_utils import event_exists, save_event
 
 # Device
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
+def get_particle_runs(pid):
+    """Order hits such that every particle is a contiguous run. Particles appear in order of their
+    first hit, and hits of a particle keep their relative order. Returns the order and a boolean
+    mask marking the consecutive (ordered) pairs of hits that belong to the same particle."""
+
+    _, first, inverse = np.unique(pid, return_index=True, return_inverse=True)
+    order = np.lexsort((np.arange(len(pid)), first[inverse]))
+    same_particle = pid[order][1:] == pid[order][:-1]
+    return order, same_particle
+
+
 def get_layerwise_edges(hits):
     """Get layerwise true edge list. Here 'hits' represent complete event."""
     
@@ -38,19 +51,39 @@ def get_layerwise_edges(hits):
     )
     hits = hits.sort_values("R").reset_index(drop=True).reset_index(drop=False)
     hits.loc[hits["particle_id"] == 0, "particle_id"] = np.nan
-    hit_list = (
-        hits.groupby(["particle_id", "layer_id"], sort=False)["index"]  # ADAK: layer >> layer_id
-        .agg(lambda x: list(x))
-        .groupby(level=0)
-        .agg(lambda x: list(x))
+
+    # Signal hits, their position in R order, particle and layer
+    pid = hits.particle_id.to_numpy(dtype=np.float64)
+    signal = np.flatnonzero(~np.isnan(pid))
+    pid, layer = pid[signal], hits.layer_id.to_numpy()[signal]  # ADAK: layer >> layer_id
+    if len(signal) == 0:
+        return np.empty((2, 0), dtype=np.int64), hits
+
+    # Label (particle, layer) groups and find the first hit (in R) of every group
+    _, group_first, group = np.unique(
+        np.stack([pid, layer]), axis=1, return_index=True, return_inverse=True
     )
+    group = group.reshape(-1)
 
-    true_edges = []
-    for row in hit_list.values:
-        for i, j in zip(row[0:-1], row[1:]):
-            true_edges.extend(list(itertools.product(i, j)))
-            
-    true_edges = np.array(true_edges).T
+    # Stable lexsort on (particle, first hit of layer group, R)
+    order = np.lexsort((signal, group_first[group], pid))
+    signal, pid, group = signal[order], pid[order], group[order]
+
+    # Run-length boundaries of the (particle, layer) groups
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    sizes = np.diff(np.r_[starts, len(group)])
+
+    # Every group is connected to the next group of the same particle (all hit pairs)
+    has_next = np.r_[pid[starts[1:]] == pid[starts[:-1]], False]
+    next_start = np.r_[starts[1:], len(group)]
+    next_size = np.r_[sizes[1:], 0]
+
+    src_group = np.repeat(np.arange(len(starts)), sizes)
+    counts = np.where(has_next, next_size, 0)[src_group]
+    src = np.repeat(np.arange(len(group)), counts)
+    dst = ragged_arange(next_start[src_group], counts)
+
+    true_edges = np.stack([signal[src], signal[dst]]).astype(np.int64)
     return true_edges, hits
 
     
@@ -78,22 +111,12 @@ def get_modulewise_edges(hits):
 
     # Handle re-indexing
     signal = signal.rename(columns={"index": "unsorted_index"}).reset_index(drop=False)
-    
-    # Handle noise (particle_id == 0)
-    signal.loc[signal["particle_id"] == 0, "particle_id"] = np.nan
 
-    # Group by particle ID
-    signal_list = signal.groupby(["particle_id"], sort=False)["index"].agg(
-        lambda x: list(x)
-    )
+    # Group hits by particle ID, keeping the R order within particles
+    order, same_particle = get_particle_runs(signal.particle_id.to_numpy())
     
-    # Build true edges from particle groups
-    true_edges = []
-    for row in signal_list.values:
-        for i, j in zip(row[:-1], row[1:]):
-            true_edges.append([i, j])
-
-    true_edges = np.array(true_edges).T
+    # Build true edges between consecutive hits of a particle
+    true_edges = np.stack([order[:-1][same_particle], order[1:][same_particle]])
     
     # Restore order
     true_edges = signal.unsorted_index.values[true_edges]
@@ -112,31 +135,14 @@ def get_orderwise_edges(hits):
         subset=["particle_id", "volume_id", "layer_id", "module_id"]
     )
     
-    # Reset index to get 'index' column
-    signal = signal.reset_index(drop=False)
-    
-    # Preserve the Order
-    # signal = signal.rename(columns={"index": "unsorted_index"}).reset_index(drop=False)
-
-    # Handle Particle_id 0
-    signal.loc[signal["particle_id"] == 0, "particle_id"] = np.nan
-        
-    # Group by particle ID and get list of indices of every particle (series of series).
-    signal_list = signal.groupby(["particle_id"], sort=False)["index"].agg(
-        lambda x: list(x)
-    )
-        
-    # Generate Edges
-    true_edges = []
-    for row in signal_list.values:
-        for i, j in zip(row[:-1], row[1:]):
-            true_edges.append([i, j])
+    # Group hits by particle ID, keeping the order of occurence within particles
+    order, same_particle = get_particle_runs(signal.particle_id.to_numpy())
         
-    # Return Edges
-    true_edges = np.array(true_edges).T
+    # Generate Edges between consecutive hits of a particle
+    true_edges = np.stack([order[:-1][same_particle], order[1:][same_particle]])
     
-    # Restore the Order
-    # true_edges = signal.unsorted_index.values[true_edges]
+    # Return Edges, using the original index of the hits
+    true_edges = signal.index.values[true_edges]
 
     return true_edges
 
@@ -155,11 +161,34 @@ def process_particles(particles, selection=False):
     return particles
 
 
+def join_tube_features(hits, tubes, detector_path=DETECTOR_PATH):
+    """Add isochrone (per hit, from tubes), skewed and sector_id (per tube, from the geometry table)
+    to the hits by integer indexing. Same as merging tubes on hit_id, i.e. hits without a row in
+    tubes are dropped, and the index is reset."""
+    
+    # tubes are usually in the order of hits, else look up rows by hit_id
+    if np.array_equal(tubes.hit_id.to_numpy(), hits.hit_id.to_numpy()):
+        rows = np.arange(len(hits))
+    else:
+        rows = pd.Index(tubes.hit_id).get_indexer(hits.hit_id)
+        hits, rows = hits[rows >= 0], rows[rows >= 0]
+    
+    geometry = get_geometry(detector_path)[hits.module_id.to_numpy()]
+    return hits.assign(
+        isochrone=tubes.isochrone.to_numpy()[rows],
+        skewed=geometry["skewed"].astype(np.int64),
+        sector_id=geometry["sector"].astype(np.int64),
+    ).reset_index(drop=True)
+
+
 def select_hits(event_file=None, noise=False, skewed=False, **kwargs):
     """Hit selection method from Exa.TrkX. Build a full event, select hits based on certain criteria."""
     
-    # load data using event_prefix (e.g. path/to/event0000000001)
-    hits, tubes, particles, truth = trackml.dataset.load_event(event_file)
+    # load data from the columnar event store if given, else using event_prefix (e.g. path/to/event0000000001)
+    if "event_store" in kwargs and kwargs["event_store"] is not None:
+        hits, tubes, particles, truth = load_event_from_store(kwargs["event_store"], int(event_file[-10:]))
+    else:
+        hits, tubes, particles, truth = trackml.dataset.load_event(event_file)
 
     # FIXME: Add an index column to preserve the original order of hits
     hits['original_order'] = hits.index
@@ -198,8 +227,9 @@ def select_hits(event_file=None, noise=False, skewed=False, **kwargs):
     # FIXME: Check if Order is Changed
     # assert (hits['original_order'] == hits.index).all(), "Order disturbed after merging with tubes"
     
-    # merge some columns of tubes to the hits, I need isochrone, skewed & sector_id
-    hits = hits.merge(tubes[["hit_id", "isochrone", "skewed", "sector_id"]], on="hit_id")
+    # join isochrone of tubes, skewed & sector_id of the geometry table to the hits
+    detector_path = kwargs["detector_path"] if "detector_path" in kwargs and kwargs["detector_path"] is not None else DETECTOR_PATH
+    hits = join_tube_features(hits, tubes, detector_path)
 
     # FIXME: Check if Order is Changed
     # assert (hits['original_order'] == hits.index).all(), "Order disturbed after merging with tubes"
@@ -374,12 +404,13 @@ def prepare_event(
     **kwargs
 ):
 
-    """Prepare an event when called in FeatureStore Module"""
+    """Prepare an event when called in FeatureStore Module, returns its number of hits and edges.
+    Exceptions are raised again, to be recorded in the manifest (see manifest_utils.py)."""
     try:
         evtid = int(event_file[-10:])
-        filename = os.path.join(output_dir, str(evtid))
+        shard_size = kwargs["shard_size"] if "shard_size" in kwargs else 0
 
-        if not os.path.exists(filename) or overwrite:
+        if not event_exists(output_dir, evtid, shard_size) or overwrite:
             logging.info("Preparing event {}".format(evtid))
             
             # feature scale for X=[r,phi,z]
@@ -488,10 +519,16 @@ def prepare_event(
             #        data, cell_features, detector_orig, detector_proc, endcaps, noise
             #    )
 
-            with open(filename, "wb") as pickle_file:
-                torch.save(data, pickle_file)
+            # one file per event, or packed into shards of shard_size events
+            save_event(data, output_dir, evtid, shard_size)
+
+            return {
+                "n_hits": data.x.shape[0],
+                "n_edges": data.edge_index.shape[1] if data.edge_index is not None else 0,
+            }
 
         else:
             logging.info("{} already exists".format(evtid))
     except Exception as inst:
         print("File:", event_file, "had exception", inst)
+        raise
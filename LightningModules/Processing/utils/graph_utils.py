@@ -8,6 +8,7 @@ import scipy as sp
 import numpy as np
 import pandas as pd
 import torch
+from .stt_utils import STT_SECTORS, SttHitIndex, ragged_arange
 
 # Device
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -23,7 +24,7 @@ def select_edges(hits1, hits2, filtering=True):
     
     if filtering:
         dSector = (hit_pairs['sector_id_1'] - hit_pairs['sector_id_2'])
-        sector_mask = ((dSector.abs() < 2) | (dSector.abs() == 5))
+        sector_mask = ((dSector.abs() < 2) | (dSector.abs() == STT_SECTORS - 1))
         edges = hit_pairs[['index_1', 'index_2']][sector_mask]
     else:
         edges = hit_pairs[['index_1', 'index_2']]
@@ -57,55 +58,82 @@ def construct_edges(hits, layer_pairs, filtering=True):
     return edges
 
 
+def construct_edges_csr(hits, layer_pairs, filtering=True):
+    """Construct edges between hit pairs in adjacent layers. Same edges as construct_edges(),
+    but hits are indexed by (layer, sector) in a SttHitIndex so that only hits in neighbouring
+    sectors are enumerated instead of building the full cartesian product for every layer pair."""
+
+    index = hits.index.to_numpy()
+    sector = hits.sector_id.to_numpy() if filtering else None
+    hit_index = SttHitIndex(hits.layer.to_numpy(), sector, hits.phi.to_numpy())
+
+    # Loop over layer pairs and construct edges
+    edges = []
+    for (layer1, layer2) in layer_pairs:
+
+        # If an event has no hits on a layer, skip to the next layer pair
+        if hit_index.count(layer1) == 0 or hit_index.count(layer2) == 0:
+            logging.info('skipping empty layer pair: (%s, %s)' % (layer1, layer2))
+            continue
+
+        # Expand every hit on layer1 over its neighbouring (layer2, sector) buckets
+        src = hit_index.layer_hits(layer1)
+        src_idx, starts, counts = hit_index.neighbour_ranges(layer2, hit_index.sector[src])
+        edge_src = np.repeat(src[src_idx], counts)
+        edge_dst = hit_index.order[ragged_arange(starts, counts)]
+
+        # Restore the hit order of the cartesian product in select_edges(), one sort of pair keys
+        pair_keys = np.sort(edge_src * len(hits) + edge_dst)
+        edges.append(np.stack([pair_keys // len(hits), pair_keys % len(hits)]))
+
+    # Combine edges from all layer pairs
+    if len(edges) == 0:
+        return np.empty((2, 0), dtype=index.dtype)
+
+    return index[np.concatenate(edges, axis=1)]
+
+
 def get_input_edges(hits, filtering=True):
     """Build edge_index list for GNN stage."""
     n_layers = hits.layer.unique().shape[0]
     layers = np.arange(n_layers)
     layer_pairs = np.stack([layers[:-1], layers[1:]], axis=1)
-    edges = construct_edges(hits, layer_pairs, filtering)
-    edge_index = edges.to_numpy().T
+    edge_index = construct_edges_csr(hits, layer_pairs, filtering)
     return edge_index
 
 
 def graph_intersection(pred_graph, truth_graph):
-    """Get truth information about edge_index (function is from both Embedding/Filtering)"""
-    
-    array_size = max(pred_graph.max().item(), truth_graph.max().item()) + 1
-    
-    if torch.is_tensor(pred_graph):
-        l1 = pred_graph.cpu().numpy()
-    else:
-        l1 = pred_graph
-        
-    if torch.is_tensor(truth_graph):
-        l2 = truth_graph.cpu().numpy()
-    else:
-        l2 = truth_graph
-        
-    e_1 = sp.sparse.coo_matrix(
-        (np.ones(l1.shape[1]), l1), shape=(array_size, array_size)
-    ).tocsr()
+    """Get truth information about edge_index (function is from both Embedding/Filtering). Each edge
+    is encoded as a single int64 key (src * N + dst), duplicated predicted edges are dropped keeping
+    their first occurrence, and the order of the predicted edges is preserved."""
+
+    if not torch.is_tensor(pred_graph):
+        pred_graph = torch.from_numpy(np.asarray(pred_graph))
+
+    if not torch.is_tensor(truth_graph):
+        truth_graph = torch.from_numpy(np.asarray(truth_graph))
+
+    pred_graph = pred_graph.long()
+    truth_graph = truth_graph.long().to(pred_graph.device)
+
+    array_size = max(
+        pred_graph.max().item() if pred_graph.numel() > 0 else 0,
+        truth_graph.max().item() if truth_graph.numel() > 0 else 0,
+    ) + 1
+
+    # encode edges as keys
+    pred_keys = pred_graph[0] * array_size + pred_graph[1]
+    truth_keys = truth_graph[0] * array_size + truth_graph[1]
+
+    # keep first occurrence of each predicted edge, in the original order
+    sorted_keys, perm = torch.sort(pred_keys, stable=True)
+    is_first = torch.ones_like(sorted_keys, dtype=torch.bool)
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    first = torch.sort(perm[is_first])[0]
+
+    new_pred_graph = pred_graph[:, first].to(device)
+
+    # label edges by a lookup of their keys in the truth keys
+    y = torch.isin(pred_keys[first], truth_keys).to(device)
 
-    e_2 = sp.sparse.coo_matrix(
-        (np.ones(l2.shape[1]), l2), shape=(array_size, array_size)
-    ).tocsr()
-    
-    del l1
-    del l2
-    
-    e_intersection = (e_1.multiply(e_2) - ((e_1 - e_2) > 0)).tocoo()
-    
-    del e_1
-    del e_2
-    
-    new_pred_graph = (
-        torch.from_numpy(np.vstack([e_intersection.row, e_intersection.col]))
-        .long()
-        .to(device)
-    )
-    
-    y = torch.from_numpy(e_intersection.data > 0).to(device)
-    
-    del e_intersection
-    
     return new_pred_graph, y
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for the Processing Manifest:
+
+Every processed event gets a one-line record 'evtid status seconds n_hits n_edges attempts [error]'
+in a manifest file 'manifest-<host>-<pid>.log', appended by the main process of each task, so SLURM
+tasks never write to the same file. The manifest files live next to the output directory (e.g.
+feature_store.manifest/), never inside it, as later stages list the output directory for events.
+Reading all manifest files back tells which events are done, hence skipped when a preempted job is
+restarted, and which ones failed, to be retried. Events are balanced over tasks by size (bytes of
+the raw event files, or hits in the event store) instead of by number of files, and handed out to
+workers largest first, so that a few large events do not end up on the same task or at the tail.
+"""
+
+import os
+import glob
+import time
+import heapq
+import socket
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from tqdm import tqdm
+
+MANIFEST_PREFIX = "manifest-"
+MANIFEST_SUFFIX = ".log"
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def get_manifest_dir(output_dir):
+    """Default manifest directory of an output directory, e.g. path/to/feature_store.manifest"""
+    return output_dir.rstrip("/") + ".manifest"
+
+
+class Manifest(object):
+    """Status of the events of an output directory, from all its manifest files. An event done
+    once stays done, otherwise the last record of an event wins."""
+
+    def __init__(self, manifest_dir: str):
+        self.path = manifest_dir
+        self.records = {}
+
+        for manifest_file in sorted(glob.glob(os.path.join(manifest_dir, MANIFEST_PREFIX + "*" + MANIFEST_SUFFIX))):
+            with open(manifest_file, "r") as f:
+                for line in f:
+                    fields = line.split(maxsplit=6)
+                    if len(fields) < 6:
+                        continue
+                    record = {
+                        "status": fields[1], "time": float(fields[2]), "n_hits": int(fields[3]),
+                        "n_edges": int(fields[4]), "attempts": int(fields[5]),
+                        "error": fields[6].strip() if len(fields) > 6 else "",
+                    }
+                    if not self.is_done(fields[0]):
+                        self.records[fields[0]] = record
+
+        self.manifest_file = os.path.join(
+            manifest_dir, "{}{}-{}{}".format(MANIFEST_PREFIX, socket.gethostname(), os.getpid(), MANIFEST_SUFFIX)
+        )
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, evtid):
+        return str(evtid) in self.records
+
+    def is_done(self, evtid):
+        return str(evtid) in self.records and self.records[str(evtid)]["status"] == STATUS_DONE
+
+    def attempts(self, evtid):
+        return self.records[str(evtid)]["attempts"] if str(evtid) in self.records else 0
+
+    def write(self, evtid, status, elapsed, n_hits=-1, n_edges=-1, error=""):
+        """Append the record of an event to the manifest file of this process."""
+        record = {
+            "status": status, "time": elapsed, "n_hits": n_hits, "n_edges": n_edges,
+            "attempts": self.attempts(evtid) + 1, "error": " ".join(str(error).split()),
+        }
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.manifest_file, "a") as f:
+            f.write("{} {} {:.3f} {} {} {} {}\n".format(
+                evtid, record["status"], record["time"], record["n_hits"],
+                record["n_edges"], record["attempts"], record["error"]).rstrip() + "\n")
+
+        if not self.is_done(evtid):
+            self.records[str(evtid)] = record
+
+    def summary(self):
+        """Number of events and processing time per status."""
+        summary = {}
+        for record in self.records.values():
+            count, elapsed = summary.get(record["status"], (0, 0.))
+            summary[record["status"]] = (count + 1, elapsed + record["time"])
+        return summary
+
+
+def get_event_sizes(event_files):
+    """Size in bytes of every raw event (e.g. path/to/event0000000001), summed over its CSV
+    files. Each input directory is scanned once."""
+    sizes = dict.fromkeys(event_files, 0)
+    for input_dir in set(os.path.dirname(event_file) for event_file in event_files):
+        for entry in os.scandir(input_dir):
+            event_file = os.path.join(input_dir, entry.name[:15])
+            if event_file in sizes:
+                sizes[event_file] += entry.stat().st_size
+    return sizes
+
+
+def balance_events(event_files, sizes, n_parts):
+    """Split events into n_parts of about the same total size (largest event to the smallest
+    part first), each part sorted by decreasing size. Same split in every task."""
+
+    parts = [[] for _ in range(n_parts)]
+    totals = [(0, part) for part in range(n_parts)]
+    for event_file in sorted(event_files, key=lambda event_file: (-sizes[event_file], event_file)):
+        total, part = heapq.heappop(totals)
+        parts[part].append(event_file)
+        heapq.heappush(totals, (total + sizes[event_file], part))
+
+    return parts
+
+
+def run_event(event_file, process_func):
+    """Process an event, returns its record for the manifest instead of raising."""
+    start = time.perf_counter()
+    try:
+        summary = process_func(event_file) or {}
+        status, error = STATUS_DONE, ""
+    except Exception as inst:
+        summary, status, error = {}, STATUS_FAILED, "{}: {}".format(type(inst).__name__, inst)
+
+    return {
+        "event_file": event_file, "status": status, "elapsed": time.perf_counter() - start,
+        "n_hits": summary["n_hits"] if "n_hits" in summary else -1,
+        "n_edges": summary["n_edges"] if "n_edges" in summary else -1,
+        "error": error,
+    }
+
+
+def run_events(event_files, process_func):
+    """Process a chunk of events in a worker, see run_event()."""
+    return [run_event(event_file, process_func) for event_file in event_files]
+
+
+def process_events(process_func, event_files, manifest_dir, sizes=None, n_workers=1, chunksize=1,
+                   max_retries=1, resume=True, show_progress=True):
+    """Process events with a worker pool, largest first, recording every event in the manifest.
+    With resume, events already done are skipped. Failed events are retried max_retries times.
+    If a worker dies (e.g. OOM killer, segfault), the pool breaks and all events still in it are
+    recorded as failed, a new pool is started for the next attempt."""
+
+    manifest = Manifest(manifest_dir)
+    sizes = sizes if sizes is not None else dict.fromkeys(event_files, 0)
+
+    pending = sorted(event_files, key=lambda event_file: (-sizes[event_file], event_file))
+    if resume:
+        pending = [event_file for event_file in pending if not manifest.is_done(int(event_file[-10:]))]
+    print("Processing {} events, {} already done".format(len(pending), len(event_files) - len(pending)))
+
+    for attempt in range(max_retries + 1):
+        if len(pending) == 0:
+            break
+        if attempt > 0:
+            print("Retrying {} failed events, attempt {} of {}".format(len(pending), attempt, max_retries))
+
+        failed = []
+        chunks = [pending[i:i + chunksize] for i in range(0, len(pending), chunksize)]
+        with ProcessPoolExecutor(n_workers) as pool, tqdm(total=len(pending), disable=not show_progress) as pbar:
+            futures = {pool.submit(run_events, chunk, process_func): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                try:
+                    records = future.result()
+                except BrokenProcessPool as inst:
+                    records = [
+                        {"event_file": event_file, "status": STATUS_FAILED, "elapsed": 0., "n_hits": -1,
+                         "n_edges": -1, "error": "{}: {}".format(type(inst).__name__, inst)}
+                        for event_file in futures[future]
+                    ]
+
+                for record in records:
+                    manifest.write(int(record["event_file"][-10:]), record["status"], record["elapsed"],
+                                   record["n_hits"], record["n_edges"], record["error"])
+                    if record["status"] == STATUS_FAILED:
+                        failed.append(record["event_file"])
+                pbar.update(len(records))
+
+        # retry in the same order, largest first
+        failed = set(failed)
+        pending = [event_file for event_file in pending if event_file in failed]
+
+    for status, (count, elapsed) in sorted(manifest.summary().items()):
+        logging.info("{} events {}, {:.1f} s".format(count, status, elapsed))
+    if len(pending) > 0:
+        logging.warning("{} events failed after {} attempts, see {}".format(
+            len(pending), max_retries + 1, manifest.manifest_file))
+
+    return manifest
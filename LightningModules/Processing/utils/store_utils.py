@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for the Columnar Event Store:
+
+The raw event directory (event*-hits.csv, event*-cells.csv, event*-particles.csv and
+event*-truth.csv) is converted once into a single HDF5 store, holding one table per CSV
+type with an indexed 'event_id' column. An event is then read back by an indexed selection
+on 'event_id', and only the needed columns are read e.g. for the tubes. Re-processing with
+different 'noise', 'skewed' or 'selection' flags never touches the CSV files again.
+"""
+
+import os
+import time
+import socket
+import logging
+import numpy as np
+import pandas as pd
+import trackml.dataset
+from tqdm import tqdm
+
+# Tables in the store, same order as returned by trackml.dataset.load_event()
+STORE_TABLES = ["hits", "tubes", "particles", "truth"]
+
+# Columns needed from each table by select_hits(), None means all columns
+STORE_COLUMNS = {
+    "hits": None,
+    "tubes": ["hit_id", "isochrone"],
+    "particles": None,
+    "truth": None,
+}
+
+# Open stores of the current process, see get_store()
+_stores = {}
+
+
+def list_raw_events(input_dir):
+    """List event prefixes (e.g. path/to/event0000000001) in a raw event directory."""
+    all_files = os.listdir(input_dir)
+    return sorted(np.unique([os.path.join(input_dir, event[:15]) for event in all_files]))
+
+
+def acquire_lock(lock_path):
+    """Create lock_path atomically (O_CREAT | O_EXCL), returns False if it already exists."""
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write("{} {}\n".format(socket.gethostname(), os.getpid()))
+    return True
+
+
+def wait_for_lock(lock_path, poll_interval=10, stale_after=600):
+    """Wait until lock_path is removed. The owner touches the lock after every event, a lock
+    left untouched for stale_after seconds (e.g. killed job) is removed."""
+    while os.path.exists(lock_path):
+        try:
+            if time.time() - os.path.getmtime(lock_path) > stale_after:
+                logging.warning("Removing stale lock {}".format(lock_path))
+                os.remove(lock_path)
+                break
+        except FileNotFoundError:
+            break
+        time.sleep(poll_interval)
+
+
+def build_event_store(input_dir, store_path, overwrite=False, complevel=5, show_progress=True):
+    """Convert all raw events of input_dir into a columnar HDF5 store, one time only. Of the
+    tasks calling it at the same time (e.g. SLURM array), the one holding '<store>.lock'
+    converts the events, the other ones wait for the store."""
+
+    lock_path = store_path + ".lock"
+    while True:
+        if os.path.exists(store_path) and not overwrite:
+            logging.info("{} already exists".format(store_path))
+            return store_path
+        if acquire_lock(lock_path):
+            break
+
+        print("Waiting for {} to be built by another task".format(store_path))
+        wait_for_lock(lock_path)
+        if os.path.exists(store_path):
+            return store_path
+
+    all_events = list_raw_events(input_dir)
+    print("Converting {} events from {} to {}".format(len(all_events), input_dir, store_path))
+
+    # Write to a temporary file, so an interrupted conversion is never mistaken for a store
+    tmp_path = "{}.tmp-{}-{}".format(store_path, socket.gethostname(), os.getpid())
+    try:
+        with pd.HDFStore(tmp_path, mode="w", complevel=complevel, complib="blosc") as store:
+            for event_file in tqdm(all_events, disable=not show_progress):
+                evtid = int(event_file[-10:])
+                for name, df in zip(STORE_TABLES, trackml.dataset.load_event(event_file)):
+                    store.append(
+                        name, df.assign(event_id=evtid), format="table",
+                        data_columns=["event_id"], index=False
+                    )
+                os.utime(lock_path)
+
+            # Index 'event_id' once all events are written
+            for name in STORE_TABLES:
+                store.create_table_index(name, columns=["event_id"], optlevel=9, kind="full")
+
+        os.replace(tmp_path, store_path)
+    finally:
+        for path in [tmp_path, lock_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return store_path
+
+
+def get_store(store_path):
+    """Open store once per process. HDF5 handles are not shared across forked workers."""
+    key = (store_path, os.getpid())
+    if key not in _stores:
+        _stores[key] = pd.HDFStore(store_path, mode="r")
+    return _stores[key]
+
+
+def list_store_events(store_path):
+    """List event ids available in the store."""
+    event_ids = get_store(store_path).select_column("particles", "event_id")
+    return np.unique(event_ids.to_numpy())
+
+
+def count_store_hits(store_path):
+    """Number of hits of every event in the store, by event id."""
+    event_ids = get_store(store_path).select_column("hits", "event_id")
+    return event_ids.value_counts().to_dict()
+
+
+def load_event_from_store(store_path, evtid):
+    """Read an event from the store, same as trackml.dataset.load_event() for the CSV files,
+    except that only the columns in STORE_COLUMNS are read."""
+
+    store = get_store(store_path)
+
+    event = []
+    for name in STORE_TABLES:
+        columns = STORE_COLUMNS[name]
+        df = store.select(
+            name, where="event_id == {}".format(int(evtid)),
+            columns=None if columns is None else columns + ["event_id"]
+        )
+        event.append(df.drop(columns=["event_id"]).reset_index(drop=True))
+
+    return tuple(event)
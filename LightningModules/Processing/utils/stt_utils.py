@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for Neighbourhoods of STT Hits:
+
+The STT is divided into STT_SECTORS sectors in phi. A hit is paired with hits of its own sector and
+of the immediate sectors, the first and the last sector being neighbours as well. SttHitIndex sorts
+the hits of an event once by (layer, sector, phi) and keeps the offsets of every (layer, sector)
+bucket. Then all hits of a layer, of the sectors neighbouring a sector or within dphi of a phi on a
+layer are contiguous ranges of the sorted hits, found by an offset lookup or a binary search within
+each bucket, instead of a scan (or a cartesian product) over all the hits of the event.
+"""
+
+import numpy as np
+
+# Number of STT sectors
+STT_SECTORS = 6
+
+
+def ragged_arange(starts, counts):
+    """Concatenate np.arange(start, start + count) for all (start, count) pairs without a loop."""
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    shift = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.arange(counts.sum(), dtype=np.int64) + shift
+
+
+def sector_neighbours(n_sectors):
+    """Boolean (n_sectors, n_sectors) table of neighbouring sectors, i.e. a sector is paired with
+    itself and its immediate sectors, the first and the last of the STT_SECTORS ones included."""
+    sectors = np.arange(n_sectors)
+    dSector = np.abs(sectors[:, None] - sectors[None, :])
+    return (dSector < 2) | (dSector == STT_SECTORS - 1)
+
+
+def wrap_phi(phi):
+    """Wrap angles to [-pi, pi)."""
+    return (np.asarray(phi) + np.pi) % (2 * np.pi) - np.pi
+
+
+class SttHitIndex(object):
+    """Hits of an event sorted by (layer, sector, phi), with the offsets of every (layer, sector)
+    bucket. Queries return indices of hits in the input order, sorted by (sector, phi). Without
+    sectors, all hits of a layer are in a single bucket."""
+
+    def __init__(self, layer, sector=None, phi=None):
+        layer = np.asarray(layer, dtype=np.int64)
+        phi = np.zeros(len(layer)) if phi is None else wrap_phi(np.asarray(phi, dtype=np.float64))
+        if sector is None:
+            sector, self.n_sectors = np.zeros_like(layer), 1
+        else:
+            sector = np.asarray(sector, dtype=np.int64)
+            self.n_sectors = max(int(sector.max()) + 1 if len(sector) > 0 else 0, STT_SECTORS)
+
+        self.n_layers = int(layer.max()) + 1 if len(layer) > 0 else 0
+        self.neighbours = sector_neighbours(self.n_sectors)
+
+        self.layer, self.sector = layer, sector
+        self.order = np.lexsort((phi, sector, layer))
+        self.sorted_phi = phi[self.order]
+
+        bucket = layer * self.n_sectors + sector
+        self.offsets = np.zeros(self.n_layers * self.n_sectors + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(bucket, minlength=self.n_layers * self.n_sectors))
+
+    def __len__(self):
+        return len(self.order)
+
+    def count(self, layer):
+        """Number of hits on a layer."""
+        if layer < 0 or layer >= self.n_layers:
+            return 0
+        return int(self.offsets[(layer + 1) * self.n_sectors] - self.offsets[layer * self.n_sectors])
+
+    def layer_hits(self, layer):
+        """Hits on a layer."""
+        if self.count(layer) == 0:
+            return self.order[:0]
+        return self.order[self.offsets[layer * self.n_sectors]:self.offsets[(layer + 1) * self.n_sectors]]
+
+    def neighbour_ranges(self, layer, sectors):
+        """Ranges of sorted hits on a layer in the sectors neighbouring each of the given sectors,
+        returns (idx, starts, counts) with idx the position in sectors of every range."""
+        idx, dst_sector = np.nonzero(self.neighbours[np.asarray(sectors, dtype=np.int64)])
+        if layer < 0 or layer >= self.n_layers:
+            return idx[:0], idx[:0], idx[:0]
+        starts = self.offsets[layer * self.n_sectors + dst_sector]
+        counts = self.offsets[layer * self.n_sectors + dst_sector + 1] - starts
+        return idx, starts, counts
+
+    def neighbour_hits(self, layer, sector):
+        """Hits on a layer in the sectors neighbouring a sector (itself included)."""
+        _, starts, counts = self.neighbour_ranges(layer, [sector])
+        return self.order[ragged_arange(starts, counts)]
+
+    def phi_window(self, layer, phi0, dphi):
+        """Hits on a layer within dphi of phi0, i.e. |wrap_phi(phi - phi0)| <= dphi."""
+        if dphi >= np.pi:
+            return self.layer_hits(layer)
+        if self.count(layer) == 0:
+            return self.order[:0]
+
+        # [phi0 - dphi, phi0 + dphi], split in two intervals if it crosses -pi or pi
+        low, high = wrap_phi(phi0 - dphi), wrap_phi(phi0 + dphi)
+        intervals = [(low, high)] if low <= high else [(-np.pi, high), (low, np.pi)]
+
+        starts, counts = [], []
+        for bucket in range(layer * self.n_sectors, (layer + 1) * self.n_sectors):
+            start, stop = self.offsets[bucket], self.offsets[bucket + 1]
+            for (phi_low, phi_high) in intervals:
+                first = start + np.searchsorted(self.sorted_phi[start:stop], phi_low, side="left")
+                last = start + np.searchsorted(self.sorted_phi[start:stop], phi_high, side="right")
+                starts.append(first)
+                counts.append(last - first)
+
+        return self.order[ragged_arange(starts, counts)]
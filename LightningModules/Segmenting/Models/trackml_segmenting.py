@@ -10,6 +10,8 @@ from ..segment_base import SegmentBase
 from ..utils.ccl import ccl_labelling
 from ..utils.dbscan import dbscan_labelling
 from ..utils.wrangler import wrangler_labelling
+from ..utils.walkthrough import walkthrough_labelling
+from LightningModules.utils.shard_utils import list_events
 
 
 # Segmentation data module specific to the TrackML pipeline
@@ -22,7 +24,7 @@ class TrackMLSegment(SegmentBase):
 
         all_files = [
             os.path.join(self.hparams["input_dir"], file)
-            for file in os.listdir(self.hparams["input_dir"])
+            for file in list_events(self.hparams["input_dir"])
         ][: self.n_files]
         all_files = np.array_split(all_files, self.n_tasks)[self.task]
         
@@ -34,6 +36,8 @@ class TrackMLSegment(SegmentBase):
             label_graph = ccl_labelling
         elif self.method == 'dbscan':
             label_graph = dbscan_labelling
+        elif self.method == 'walkthrough':
+            label_graph = walkthrough_labelling
         else:
             label_graph = wrangler_labelling
         
@@ -11,5 +11,5 @@ from .utils.dbscan import dbscan_labelling
 from .utils.wrangler import wrangler_labelling
 
 # Walkthrough
-# from .utils.walkthrough import walkthrough_labelling
+from .utils.walkthrough import walkthrough_labelling
 
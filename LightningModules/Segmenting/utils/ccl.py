@@ -7,7 +7,8 @@ import logging
 import numpy as np
 import scipy.sparse as sps
 import scipy.sparse.csgraph as scigraph
-from torch_geometric.utils import to_scipy_sparse_matrix
+from LightningModules.utils.shard_utils import event_exists, load_event, save_event
+from LightningModules.utils.segment_utils import connected_components
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -15,15 +16,17 @@ device = 'cuda' if torch.cuda.is_available() else 'cpu'
 # Connected Component Labelling (CCL)
 def ccl_labelling(input_file, output_dir, edge_cut=0.5, **kwargs):
     """Loads an input_file and outputs a segmented (i.e. labelled) graph. Function
-    uses the to_scipy_sparse_matrix() from PyG library to build a sparse array."""
+    runs the tensor-native connected_components() on the device of the graph."""
 
     try:
 
-        output_file = os.path.join(output_dir, os.path.split(input_file)[-1])
-        if not os.path.exists(output_file) or kwargs["overwrite"]:
+        evtid = os.path.split(input_file)[-1]
+        output_file = os.path.join(output_dir, evtid)
+        shard_size = kwargs["shard_size"] if "shard_size" in kwargs else 0
+        if not event_exists(output_dir, evtid, shard_size) or kwargs["overwrite"]:
 
             logging.info("Preparing event {}".format(output_file))
-            graph = torch.load(input_file, map_location=device)
+            graph = load_event(input_file, map_location=device)
             
             # edge scores
             scores = graph.scores
@@ -36,23 +39,17 @@ def ccl_labelling(input_file, output_dir, edge_cut=0.5, **kwargs):
             
             # filter passing edges
             passing_edges = graph.edge_index[:, e_mask]
-
-            # convert to sparse matrix representation of the graph with elements 0/1
-            sparse_edges = to_scipy_sparse_matrix(passing_edges, num_nodes=graph.x.size(0))
             
-            # run connected components
-            n, labels = sps.csgraph.connected_components(
-                csgraph=sparse_edges, directed=False, return_labels=True
-            )
+            # run connected components, no conversion to a sparse matrix
+            n, labels = connected_components(passing_edges, num_nodes=graph.x.size(0))
             
-            print("Number Components: ", n)
+            logging.info("Number Components: {}".format(n))
             
             # attach labels to data
-            graph.labels = torch.from_numpy(labels).type_as(passing_edges)
+            graph.labels = labels.type_as(passing_edges)
             
             # save graph with labeled compononets
-            with open(output_file, "wb") as pickle_file:
-                torch.save(graph, pickle_file)
+            save_event(graph, output_dir, evtid, shard_size)
 
         else:
             logging.info("{} already exists".format(output_file))
@@ -67,11 +64,13 @@ def ccl_labelling_v2(input_file, output_dir, edge_cut=0.5, **kwargs):
 
     try:
 
-        output_file = os.path.join(output_dir, os.path.split(input_file)[-1])
-        if not os.path.exists(output_file) or kwargs["overwrite"]:
+        evtid = os.path.split(input_file)[-1]
+        output_file = os.path.join(output_dir, evtid)
+        shard_size = kwargs["shard_size"] if "shard_size" in kwargs else 0
+        if not event_exists(output_dir, evtid, shard_size) or kwargs["overwrite"]:
 
             logging.info("Preparing event {}".format(output_file))
-            graph = torch.load(input_file, map_location=device)
+            graph = load_event(input_file, map_location=device)
             
             # edge scores
             scores = graph.scores
@@ -99,14 +98,13 @@ def ccl_labelling_v2(input_file, output_dir, edge_cut=0.5, **kwargs):
                 csgraph=sparse_edges, directed=False, return_labels=True
             )
             
-            print("Number Components: ", n)
+            logging.info("Number Components: {}".format(n))
             
             # attach labels to data
             graph.labels = torch.from_numpy(labels).type_as(passing_edges)
             
             # save graph with labeled compononets
-            with open(output_file, "wb") as pickle_file:
-                torch.save(graph, pickle_file)
+            save_event(graph, output_dir, evtid, shard_size)
 
         else:
             logging.info("{} already exists".format(output_file))
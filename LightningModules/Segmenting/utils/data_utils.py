@@ -7,15 +7,16 @@ import torch
 import pandas as pd
 import numpy as np
 from .ccl.ccl import label_segments
+from LightningModules.utils.shard_utils import list_events, load_event
 
 
 def load_dataset(input_subdir="", num_events=10, **kwargs):
     if input_subdir is not None:
-        all_events = os.listdir(input_subdir)
+        all_events = list_events(input_subdir)
         all_events = sorted([os.path.join(input_subdir, event) for event in all_events])
         print("Loading events")
         loaded_events = [
-            torch.load(event, map_location=torch.device("cpu"))
+            load_event(event, map_location=torch.device("cpu"))
             for event in all_events[:num_events]
         ]
         print("Events loaded!")
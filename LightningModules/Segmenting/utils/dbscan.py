@@ -12,36 +12,56 @@ import numpy as np
 import pandas as pd
 import scipy.sparse as sps
 from sklearn.cluster import DBSCAN
+from LightningModules.utils.shard_utils import event_exists, load_event, save_event
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
 # Sparse Matrix
-def GetCOO_Matrix(senders, receivers, scores, num_nodes):
-    """Prepare Sparse Matrix in COO format for DBSCAN"""
+def build_affinity_matrix(senders, receivers, scores, n_nodes, dtype=np.float32):
+    """Prepare the symmetric sparse distance matrix (1 - score) for DBSCAN, shared with
+    eval/trkx_from_gnn.py.
+    
+    Duplicated edges (same sender and receiver) are summed, and sums above 1 are halved, as
+    in the former GetCOO_Matrix(). Both directions of every edge are added at once into a CSR
+    matrix, which DBSCAN with metric='precomputed' uses as is, instead of converting a COO
+    matrix itself."""
+    
+    senders, receivers, scores = [
+        v.cpu().numpy() if torch.is_tensor(v) else np.asarray(v) for v in (senders, receivers, scores)
+    ]
     
     # adjancy matrix with its value being the edge socre.
-    e_csr = sps.csr_matrix((scores, (senders, receivers)),
-                           shape=(num_nodes, num_nodes),
-                           dtype=np.float32)
+    e_csr = sps.csr_matrix((scores, (senders, receivers)), shape=(n_nodes, n_nodes), dtype=dtype)
     
     # rescale the duplicated edges
     e_csr.data[e_csr.data > 1] = e_csr.data[e_csr.data > 1]/2.
     
     # invert to treat score as an inverse distance
-    e_csr.data = 1 - e_csr.data
+    distances = 1 - e_csr.data
     
     # make it symmetric
-    e_csr_bi = sps.coo_matrix(
-        (np.hstack([e_csr.tocoo().data, e_csr.tocoo().data]),
-         np.hstack([np.vstack([e_csr.tocoo().row, e_csr.tocoo().col]),
-                    np.vstack([e_csr.tocoo().col, e_csr.tocoo().row])]
-                   )
-         )
+    rows = np.repeat(np.arange(n_nodes), np.diff(e_csr.indptr))
+    cols = e_csr.indices
+    e_csr_bi = sps.csr_matrix(
+        (np.concatenate([distances, distances]),
+         (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        shape=(n_nodes, n_nodes), dtype=dtype
     )
+    
     return e_csr_bi
 
 
+def get_connected_nodes(e_csr_bi):
+    """Nodes with at least one edge, i.e. the non-empty rows of the symmetric matrix"""
+    return np.flatnonzero(np.diff(e_csr_bi.indptr))
+
+
+def GetCOO_Matrix(senders, receivers, scores, num_nodes):
+    """Prepare Sparse Matrix for DBSCAN, see build_affinity_matrix()"""
+    return build_affinity_matrix(senders, receivers, scores, num_nodes)
+
+
 # DBSCAN Clustering
 def DBSCAN_Clustering(e_csr_bi, epsilon=0.25, min_samples=2):
     """"Track Candidates using DBSCAN Clustering"""
@@ -52,7 +72,7 @@ def DBSCAN_Clustering(e_csr_bi, epsilon=0.25, min_samples=2):
         min_samples=min_samples).fit_predict(e_csr_bi)
     
     # Get Labels
-    labels = clustering[np.unique(e_csr_bi.tocoo().row)]
+    labels = clustering[get_connected_nodes(e_csr_bi)]
     return labels
 
 
@@ -61,13 +81,15 @@ def dbscan_labelling(input_file, output_dir, edge_cut, **kwargs):
     """prepare a multiprocessing function for track building"""
     
     try:
-        output_file = os.path.join(output_dir, os.path.split(input_file)[-1])
-        if not os.path.exists(output_file) or kwargs["overwrite"]:
+        evtid = os.path.split(input_file)[-1]
+        output_file = os.path.join(output_dir, evtid)
+        shard_size = kwargs["shard_size"] if "shard_size" in kwargs else 0
+        if not event_exists(output_dir, evtid, shard_size) or kwargs["overwrite"]:
 
             logging.info("Preparing event {}".format(output_file))
             
             # load weighted graph
-            graph = torch.load(input_file, map_location=device)
+            graph = load_event(input_file, map_location=device)
 
             # get necessary data
             hit_id = graph.hid
@@ -94,29 +116,19 @@ def dbscan_labelling(input_file, output_dir, edge_cut, **kwargs):
                 eps=kwargs["epsilon"], metric='precomputed',
                 min_samples=kwargs["min_samples"]).fit_predict(e_csr_bi)
 
-            # Get Labels
-            graph.labels = clustering[np.unique(e_csr_bi.tocoo().row)]
+            # Get Labels of connected nodes
+            nodes = get_connected_nodes(e_csr_bi)
+            graph.labels = clustering[nodes]
             
-            # create DataFrame with {'hit_id', 'track_id'} columns          
-            track_labels = np.vstack(
-                [np.unique(e_csr_bi.tocoo().row),
-                 graph.labels])
-
-            track_labels = pd.DataFrame(track_labels.T)
-            track_labels.columns = ["hit_id", "track_id"]
-
-            new_hit_id = np.apply_along_axis(
-                lambda x: hit_id[x], 0, track_labels.hit_id.values)
-
+            # create DataFrame with {'hit_id', 'track_id'} columns
             predicted_tracks = pd.DataFrame.from_dict(
-                {"hit_id": new_hit_id, "track_id": track_labels.track_id})
+                {"hit_id": hit_id.cpu().numpy()[nodes], "track_id": graph.labels})
 
             # all columns with sampe dtype
             predicted_tracks = predicted_tracks.astype(np.int32)
             
             # save DataFrame (predicted tracks)
-            with open(output_file, "wb") as pickle_file:
-                torch.save(predicted_tracks, pickle_file)
+            save_event(predicted_tracks, output_dir, evtid, shard_size)
             
             # save predicted_tracks as torch tensor in the graph
             # labelled_graph.reco_tracks = torch.Tensor(predicted_tracks.values)
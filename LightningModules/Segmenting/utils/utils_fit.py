@@ -65,3 +65,27 @@ def poly_fit_phi(X, Y):
     f_y = np.polyval(pp, X)
     diff = np.sum(np.sqrt((f_y - Y) ** 2 / Y ** 2))
     return pp, f_y, diff
+
+
+def poly_fit_phi_batch(X, Y, lengths):
+    """Same as poly_fit_phi() for many (X, Y) segments of the given lengths at once, returns
+    diff of every segment. X is z, Y is phi, both concatenated over the segments."""
+    seg = np.repeat(np.arange(len(lengths)), lengths)
+    first = np.concatenate([[True], seg[1:] != seg[:-1]])
+
+    # phi is constrained to [-pi, pi], offsets of correct_phi() w.r.t the previous hit
+    offset = np.where(np.diff(Y, prepend=0.) > 1.5 * np.pi, -2 * np.pi, 2 * np.pi)
+    Y = np.where(first, Y, Y + offset)
+
+    # linear least squares per segment
+    n = np.bincount(seg, minlength=len(lengths))
+    x_mean = np.bincount(seg, weights=X, minlength=len(lengths)) / np.maximum(n, 1)
+    y_mean = np.bincount(seg, weights=Y, minlength=len(lengths)) / np.maximum(n, 1)
+    dx, dy = X - x_mean[seg], Y - y_mean[seg]
+    sxx = np.bincount(seg, weights=dx * dx, minlength=len(lengths))
+    sxy = np.bincount(seg, weights=dx * dy, minlength=len(lengths))
+    slope = np.divide(sxy, sxx, out=np.zeros_like(sxy), where=sxx > 0)
+
+    f_y = y_mean[seg] + slope[seg] * dx
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.bincount(seg, weights=np.sqrt((f_y - Y) ** 2 / Y ** 2), minlength=len(lengths))
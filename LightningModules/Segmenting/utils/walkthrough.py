@@ -18,102 +18,205 @@
 # 3rd party imports
 import os
 import logging
-import pandas as pd
 import numpy as np
 import torch
 import scipy.sparse as sps
-from tqdm import tqdm
-from multiprocessing import Pool
-from torch_geometric.utils import to_networkx
-import networkx as nx
-from itertools import chain
-from functools import partial
 
 # Local imports
-from torch_geometric.utils import to_scipy_sparse_matrix
+from LightningModules.utils.shard_utils import event_exists, load_event, save_event
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def find_all_paths(start, G=None, ending_nodes=None):
-    return list(chain.from_iterable([
-        list(nx.all_simple_paths(G, start, end))
-        for end in ending_nodes
-        if nx.has_path(G, start, end)
-    ]))
-
-
-def find_shortest_paths(start, G=None, ending_nodes=None):
-    return [
-        nx.shortest_path(G, start, end)
-        for end in ending_nodes
-        if nx.has_path(G, start, end)
-    ]
+def get_edge_ranges(indptr, nodes):
+    """Positions of the outgoing edges of nodes in a CSR layout, concatenated."""
+    starts, counts = indptr[nodes], indptr[nodes + 1] - indptr[nodes]
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.arange(counts.sum()) + offsets
+
+
+def get_topological_layers(indptr, receivers, num_nodes, active):
+    """Kahn's algorithm, one frontier of nodes at a time. Nodes on a cycle are never reached."""
+
+    in_degree = np.bincount(receivers, minlength=num_nodes)
+    frontier = np.flatnonzero(active & (in_degree == 0))
+
+    layers = []
+    while frontier.size > 0:
+        layers.append(frontier)
+        targets = receivers[get_edge_ranges(indptr, frontier)]
+        in_degree -= np.bincount(targets, minlength=num_nodes)
+        frontier = np.unique(targets[in_degree[targets] == 0])
+
+    return layers
+
+
+def walk_shortest_paths(edge_index, num_nodes):
+    """Label the nodes of a directed graph as the former networkx walkthrough: every starting
+    node (no incoming edge) gives a track, made of a shortest path to every ending node (no
+    outgoing edge) it reaches. Tracks are numbered in the order of their starting nodes, the
+    first track wins a shared node, nodes on no path are labelled -1. Of several shortest paths
+    to an ending node, the one through the smallest predecessors is taken, networkx could take
+    another one.
+
+    The shortest paths of all starting nodes come from one breadth-first search on a (starts,
+    nodes) frontier, then every ending node is walked back to its starting nodes at once."""
+
+    senders, receivers = edge_index
+    adjacency = sps.csr_matrix(
+        (np.ones(senders.shape[0]), (senders, receivers)), shape=(num_nodes, num_nodes)
+    )
+    adjacency.data[:] = 1
+    incoming = adjacency.tocsc()
+    incoming.sort_indices()
+
+    in_degree, out_degree = np.diff(incoming.indptr), np.diff(adjacency.indptr)
+    starts = np.flatnonzero((in_degree == 0) & (out_degree > 0))
+    is_end = (out_degree == 0) & (in_degree > 0)
+    n_starts = starts.shape[0]
+
+    # Distance of every node from every starting node, -1 if not reached
+    level = np.full((n_starts, num_nodes), -1, dtype=np.int32)
+    level[np.arange(n_starts), starts] = 0
+    frontier = sps.csr_matrix(
+        (np.ones(n_starts), (np.arange(n_starts), starts)), shape=(n_starts, num_nodes)
+    )
+    distance = 0
+    while frontier.nnz > 0:
+        distance += 1
+        reached = (frontier @ adjacency).tocoo()
+        new = level[reached.row, reached.col] < 0
+        rows, nodes = reached.row[new], reached.col[new]
+        level[rows, nodes] = distance
+        frontier = sps.csr_matrix(
+            (np.ones(rows.shape[0]), (rows, nodes)), shape=(n_starts, num_nodes)
+        )
+
+    # Walk back from the reached ending nodes, to the smallest predecessor one level closer
+    on_path = (level >= 0) & is_end
+    rows, nodes = np.nonzero(on_path)
+    while rows.size > 0:
+        keep = level[rows, nodes] > 0
+        rows, nodes = rows[keep], nodes[keep]
+
+        edges = get_edge_ranges(incoming.indptr, nodes)
+        pairs = np.repeat(np.arange(nodes.shape[0]), np.diff(incoming.indptr)[nodes])
+        preds = incoming.indices[edges]
+        closer = level[rows[pairs], preds] == level[rows[pairs], nodes[pairs]] - 1
+        pairs, preds = pairs[closer], preds[closer]
+        first = np.concatenate([[True], pairs[1:] != pairs[:-1]]) if pairs.size > 0 else pairs.astype(bool)
+
+        rows, nodes = rows[pairs[first]], preds[first]
+        new = ~on_path[rows, nodes]
+        rows, nodes = rows[new], nodes[new]
+        on_path[rows, nodes] = True
+
+    labels = np.full(num_nodes, -1, dtype=np.int64)
+    if n_starts > 0:
+        labelled = on_path.any(axis=0)
+        labels[labelled] = on_path.argmax(axis=0)[labelled]
+
+    return labels
+
+
+def walk_best_paths(edge_index, num_nodes, weights=None):
+    """Find the best path from every starting node (no incoming edge) of a directed graph
+    in one pass, with the longest path in hits or, given edge weights (e.g. scores), the
+    path with the largest sum of weights. Returns the track id of every node, a node on
+    several paths belongs to the first one, nodes on none (or on a cycle) are labelled -1."""
+
+    senders, receivers = edge_index
+    weights = np.ones(senders.shape[0]) if weights is None else weights.astype(np.float64)
+
+    # CSR layout of the outgoing edges
+    order = np.argsort(senders, kind="stable")
+    senders, receivers, weights = senders[order], receivers[order], weights[order]
+    out_degree = np.bincount(senders, minlength=num_nodes)
+    indptr = np.concatenate([[0], np.cumsum(out_degree)])
+
+    active = (out_degree > 0) | (np.bincount(receivers, minlength=num_nodes) > 0)
+    layers = get_topological_layers(indptr, receivers, num_nodes, active)
+
+    ordered = np.zeros(num_nodes, dtype=bool)
+    for layer in layers:
+        ordered[layer] = True
+    if (active & ~ordered).any():
+        logging.warning("{} nodes on cycles are not walked through".format((active & ~ordered).sum()))
+
+    # Best successor of every node, from the last layer to the first one
+    best = np.zeros(num_nodes)
+    successor = np.full(num_nodes, -1)
+    for layer in reversed(layers):
+        edges = get_edge_ranges(indptr, layer)
+        edges = edges[ordered[receivers[edges]]]
+        if edges.size == 0:
+            continue
+        gains = weights[edges] + best[receivers[edges]]
+
+        # first edge per sender by largest gain, then smallest receiver
+        edges = edges[np.lexsort((receivers[edges], -gains, senders[edges]))]
+        first = np.concatenate([[True], senders[edges][1:] != senders[edges][:-1]])
+        edges = edges[first]
+
+        best[senders[edges]] = weights[edges] + best[receivers[edges]]
+        successor[senders[edges]] = receivers[edges]
+
+    # Walk all paths at once, the smallest track id wins a shared node
+    labels = np.full(num_nodes, num_nodes, dtype=np.int64)
+    nodes = layers[0] if len(layers) > 0 else np.empty(0, dtype=np.int64)
+    track_ids = np.arange(nodes.shape[0])
+    while nodes.size > 0:
+        np.minimum.at(labels, nodes, track_ids)
+        nodes = successor[nodes]
+        track_ids = track_ids[nodes >= 0]
+        nodes = nodes[nodes >= 0]
+    labels[labels == num_nodes] = -1
+
+    return labels
+
+
+def walkthrough(edge_index, num_nodes, weights=None):
+    """Track id of every node, the shortest paths from every starting node to all the ending
+    nodes it reaches (see walk_shortest_paths()) or, given edge weights (e.g. scores), the
+    single path with the largest sum of weights from every starting node (see walk_best_paths())."""
+    if weights is None:
+        return walk_shortest_paths(edge_index, num_nodes)
+    return walk_best_paths(edge_index, num_nodes, weights)
 
 
 def walkthrough_labelling(input_file, output_dir, edge_cut=0.5, **kwargs):
     """
     Given a set of scored graphs, and a score cut, build tracks from graphs by:
     1. Applying the score cut to the graph
-    2. Running walkthrough path method as a partial method
+    2. Walking through the shortest paths from every starting node to every ending node,
+       or through the path with the largest sum of scores if score_weighted
     """
     try:
-        output_file = os.path.join(output_dir, os.path.split(input_file)[-1])
-        if not os.path.exists(output_file) or kwargs["overwrite"]:
+        evtid = os.path.split(input_file)[-1]
+        output_file = os.path.join(output_dir, evtid)
+        shard_size = kwargs["shard_size"] if "shard_size" in kwargs else 0
+        if not event_exists(output_dir, evtid, shard_size) or kwargs["overwrite"]:
 
             logging.info("Preparing event {}".format(output_file))
-            graph = torch.load(input_file, map_location="cpu")
-            
+            graph = load_event(input_file, map_location="cpu")
+
             # edge scores
             scores = graph.scores
-            
+
             # half the length, gnn gives scores for bidirected graphs
-            scores = scores[:graph.edge_index.shape[1]] 
-            
+            scores = scores[:graph.edge_index.shape[1]]
+
             # apply edge score cut
             edge_mask = scores > edge_cut
-            
-            # Convert to sparse scipy array
-            new_graph = graph.clone()
-            new_graph.edge_index = new_graph.edge_index[:, edge_mask]
-            new_graph.scores = new_graph.scores[edge_mask]
-    
-            # Convert to networkx graph
-            G = to_networkx(new_graph, to_undirected=False)
-            G.remove_nodes_from(list(nx.isolates(G)))
-
-            starting_nodes = [n for n in G.nodes() if G.in_degree(n) == 0]
-            ending_nodes = [n for n in G.nodes() if G.out_degree(n) == 0]
-
-            workers = 8  # TODO: Remove this hardcoded value
-
-            # Make partial method for multiprocessing
-            find_paths_partial = partial(find_shortest_paths, G=G, ending_nodes=ending_nodes)
-
-            # Run multiprocessing
-            with Pool(workers) as p:
-                paths = list(p.map(find_paths_partial, starting_nodes))
-
-            track_df = pd.DataFrame(
-                {
-                    "hit_id": list(chain.from_iterable(paths)),
-                    "track_id": list(chain.from_iterable([[i] * len(p) for i, p in enumerate(paths)])),
-                }
-            )
-
-            # Remove duplicates on hit_id: TODO: In very near future, handle multiple tracks through the same hit!
-            track_df = track_df.drop_duplicates(subset="hit_id")
-            
-            hit_id = track_df.hit_id
-            track_id = track_df.track_id
-
-            track_id_tensor = torch.ones(len(graph.x), dtype=torch.long) * -1
-            track_id_tensor[hit_id.values] = torch.from_numpy(track_id.values)
-
-            graph.labels = track_id_tensor
+
+            # passing edges, weighted by their scores if score_weighted
+            edge_index = graph.edge_index[:, edge_mask].numpy()
+            score_weighted = kwargs["score_weighted"] if "score_weighted" in kwargs else False
+            weights = scores[edge_mask].numpy() if score_weighted else None
+
+            graph.labels = torch.from_numpy(walkthrough(edge_index, len(graph.x), weights))
 
             # Save Files
-            with open(output_file, "wb") as pickle_file:
-                torch.save(graph, pickle_file)
+            save_event(graph, output_dir, evtid, shard_size)
 
         else:
             logging.info("{} already exists".format(output_file))
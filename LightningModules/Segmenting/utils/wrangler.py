@@ -6,51 +6,58 @@ import logging
 import torch
 import numpy as np
 import pandas as pd
-from torch_geometric.utils import to_networkx, from_networkx
-from itertools import chain
 from functools import partial
-from .utils_fit import pairwise, poly_fit_phi
+from .utils_fit import poly_fit_phi_batch
+from LightningModules.utils.shard_utils import event_exists, load_event, save_event
 
 
-def find_next_hits(G, pp, used_hits, th=0.1, th_re=0.8, feature_name='solution'):
-    """G is the graph, path is previous hits."""
+def build_adjacency(edge_index, scores, num_nodes):
+    """Adjacency of a directed graph from its CSR arrays, a (neighbours, weights) pair of lists
+    per node, sorted by decreasing score. Of duplicated edges the last one is kept, as in networkx."""
 
-    nbrs = list(set(G.neighbors(pp)).difference(set(used_hits)))
-    if len(nbrs) < 1:
-        return None
+    senders, receivers = edge_index
+    keys = senders.astype(np.int64) * num_nodes + receivers
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = keys.shape[0] - 1 - last
 
-    # weights = [G.edges[(pp, i)][feature_name][0] for i in nbrs]
+    senders, receivers, scores = senders[last], receivers[last], scores[last]
+    order = np.lexsort((-scores, senders))
 
-    # FIXME (done): In the DiGraph from PyD::to_networkx(PyG::Data,...), each
-    # edge has a score and truth (y_pid), which is interpretted as the
-    # weight of an edge. From this DiGraph structure one can find it as:
+    indptr = np.cumsum(np.bincount(senders, minlength=num_nodes))[:-1]
+    return list(zip(
+        [nbrs.tolist() for nbrs in np.split(receivers[order], indptr)],
+        [weights.tolist() for weights in np.split(scores[order], indptr)]
+    ))
 
-    weights = [G.edges[(pp, i)][feature_name] for i in nbrs]
 
-    if max(weights) < th:
-        return None
+def find_next_hits(adjacency, pp, used_hits, road=(), th=0.1, th_re=0.8):
+    """adjacency is the graph, pp is the last hit, used_hits a mask of used hits, road the previous hits."""
 
-    sorted_idx = list(reversed(np.argsort(weights)))
-    next_hits = [nbrs[sorted_idx[0]]]
+    next_hits = []
+    for hit, w in zip(*adjacency[pp]):
+        if used_hits[hit] or hit in road:
+            continue
 
-    if len(sorted_idx) > 1:
-        for ii in range(1, len(sorted_idx)):
-            idx = sorted_idx[ii]
-            w = weights[idx]
-            if w > th_re:
-                next_hits.append(nbrs[idx])
-            else:
-                break
+        # best hit, followed by the other hits above th_re (weights are sorted)
+        if len(next_hits) == 0:
+            if w < th:
+                return None
+        elif w <= th_re:
+            break
+        next_hits.append(hit)
+
+    if len(next_hits) < 1:
+        return None
 
     return next_hits
 
 
-def build_roads(G, ss, next_hit_fn, used_hits):
+def build_roads(adjacency, ss, next_hit_fn, used_hits):
     """
     next_hit_fn: a function return next hits, could be find_next_hits
     """
     # get started
-    next_hits = next_hit_fn(G, ss, used_hits)
+    next_hits = next_hit_fn(adjacency, ss, used_hits)
     if next_hits is None:
         return [(ss, None)]
     path = []
@@ -73,8 +80,7 @@ def build_roads(G, ss, next_hit_fn, used_hits):
                 new_path.append(pp)
                 continue
 
-            used_hits_cc = np.unique(used_hits + list(pp))
-            next_hits = next_hit_fn(G, pp[-1], used_hits_cc)
+            next_hits = next_hit_fn(adjacency, pp[-1], used_hits, pp)
             if next_hits is None:
                 new_path.append(pp + (None,))
             else:
@@ -85,19 +91,15 @@ def build_roads(G, ss, next_hit_fn, used_hits):
     return path
 
 
-def fit_road(G, road):
-    """use a linear function to fit phi as a function of z."""
-    road_chi2 = []
-    for path in road:
-        z = np.array([G.nodes[i]['x'][2] for i in path[:-1]])    # ADAK: G.node (v1.x) to G.nodes (v2.x)
-        phi = np.array([G.nodes[i]['x'][1] for i in path[:-1]])  # ADAK: 'pos' to 'x'
-        if len(z) > 1:
-            _, _, diff = poly_fit_phi(z, phi)
-            road_chi2.append(np.sum(diff) / len(z))
-        else:
-            road_chi2.append(1)
+def fit_road(x, road):
+    """use a linear function to fit phi as a function of z, all paths of the road at once."""
+    hits = np.concatenate([path[:-1] for path in road]).astype(np.int64)
+    lengths = np.array([len(path) - 1 for path in road])
+
+    z, phi = x[hits, 2], x[hits, 1]    # ADAK: 'pos' to 'x'
+    diff = poly_fit_phi_batch(z, phi, lengths)
 
-    return road_chi2
+    return np.where(lengths > 1, diff / lengths, 1).tolist()
 
 
 def chose_a_road(road, diff):
@@ -111,42 +113,40 @@ def chose_a_road(road, diff):
     return res
 
 
-def get_tracks(G, th=0.1, th_re=0.8, feature_name='scores', with_fit=True):
+def get_tracks(adjacency, x=None, th=0.1, th_re=0.8, with_fit=True):
     """
-    Don't use nx.MultiGraphs
+    Returns the tracks as arrays of sorted hits, x (phi at 1, z at 2) is needed with_fit
     """
-    used_nodes = []
-    sub_graphs = []
-    next_hit_fn = partial(find_next_hits, th=th, th_re=th_re, feature_name=feature_name)
-    for node in G.nodes():
-        if node in used_nodes:  #TODO: ADAK: remove this condition to allow shared hits
+    num_nodes = len(adjacency)
+    used_nodes = bytearray(num_nodes)
+    tracks = []
+    next_hit_fn = partial(find_next_hits, th=th, th_re=th_re)
+    for node in range(num_nodes):
+        if used_nodes[node]:  #TODO: ADAK: remove this condition to allow shared hits
             continue
-        road = build_roads(G, node, next_hit_fn, used_nodes)
-        diff = fit_road(G, road) if with_fit else [0.] * len(road)
+        road = build_roads(adjacency, node, next_hit_fn, used_nodes)
+        diff = fit_road(x, road) if with_fit else [0.] * len(road)
         a_road = chose_a_road(road, diff)
 
-        if len(a_road) < 3:
-            used_nodes.append(node)
-            sub_graphs.append(G.subgraph([node]))
-            continue
-
-        a_track = list(pairwise(a_road[:-1]))
-        sub = G.edge_subgraph(a_track)
-        sub_graphs.append(sub)
-        used_nodes += list(sub.nodes())
+        a_track = np.unique(a_road[:-1])
+        for hit in a_track.tolist():
+            used_nodes[hit] = True
+        tracks.append(a_track)
 
-    return sub_graphs
+    return tracks
 
 
 def wrangler_labelling(input_file, output_dir, edge_cut=0.5, **kwargs):
     """Find tracks using a Walktrhough method..."""
     
     try:
-        output_file = os.path.join(output_dir, os.path.split(input_file)[-1])
-        if not os.path.exists(output_file) or kwargs["overwrite"]:
+        evtid = os.path.split(input_file)[-1]
+        output_file = os.path.join(output_dir, evtid)
+        shard_size = kwargs["shard_size"] if "shard_size" in kwargs else 0
+        if not event_exists(output_dir, evtid, shard_size) or kwargs["overwrite"]:
 
             logging.info("Preparing event {}".format(output_file))
-            graph = torch.load(input_file, map_location="cpu")
+            graph = load_event(input_file, map_location="cpu")
 
             # edge scores
             scores = graph.scores
@@ -157,29 +157,22 @@ def wrangler_labelling(input_file, output_dir, edge_cut=0.5, **kwargs):
             # apply edge score cut
             edge_mask = scores > edge_cut
 
-            # Convert to sparse scipy array
-            new_graph = graph.clone()
-            new_graph.edge_index = new_graph.edge_index[:, edge_mask]
-            new_graph.scores = new_graph.scores[edge_mask]
-
-            # Convert to networkx graph
-            G = to_networkx(new_graph, node_attrs=['x'], edge_attrs=['scores', 'y_pid'], to_undirected=False)
+            # CSR adjacency of passing edges, sorted by score
+            adjacency = build_adjacency(
+                graph.edge_index[:, edge_mask].numpy(), scores[edge_mask].numpy(), len(graph.x)
+            )
 
             # Build tracks
-            paths = get_tracks(G, th=0.1, th_re=0.8, feature_name='scores', with_fit=False)
+            paths = get_tracks(adjacency, graph.x.numpy(), th=0.1, th_re=0.8, with_fit=False)
 
             track_df = pd.DataFrame(
                 {
-                    "hit_id": list(chain.from_iterable(paths)),
-                    "track_id": list(chain.from_iterable([[i] * len(p) for i, p in enumerate(paths)])),
+                    "hit_id": np.concatenate(paths),
+                    "track_id": np.repeat(np.arange(len(paths)), [len(p) for p in paths]),
                 }
             )
 
-            # list subgraphs as pyg data
-            # pyg_graph = [from_networkx(graph) for graph in paths]
-
-            with open(output_file, "wb") as pickle_file:
-                torch.save(track_df, pickle_file)
+            save_event(track_df, output_dir, evtid, shard_size)
 
         else:
             logging.info("{} already exists".format(output_file))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for the Select Cache:
+
+The cuts of select_data() only depend on an event and on the selection (pt cuts, noise flag, ...),
+yet the edge masks, y_pid and the signal edges were recomputed for every event at every setup().
+With a `select_cache_dir`, the tensors derived by select_data() (e.g. the filtered edge_index,
+y_pid and signal_true_edges) are saved once, in one cache file per input directory and selection
+'select-v<version>-<hash>.pt', and set on the loaded events as they are at the next launches.
+
+Every entry is keyed by the fingerprint of its event file (path, size and mtime, or the shard
+slice of a sharded event), so an event written again is selected again. CACHE_VERSION is part
+of the file name, and has to be bumped whenever select_data() changes.
+"""
+
+import os
+import hashlib
+import logging
+import torch
+
+from .shard_utils import get_event_reader
+
+CACHE_VERSION = 1
+
+
+def get_digest(obj):
+    """Short hash of the repr of an object, e.g. a tuple of paths and cuts."""
+    return hashlib.sha1(repr(obj).encode()).hexdigest()[:16]
+
+
+def get_event_fingerprint(event_file):
+    """Fingerprint of an event given as 'input_dir/evtid', for both one file per event and sharded
+    layouts. Shards are append-only, an event written again gets a new slice."""
+    if os.path.isfile(event_file):
+        stat = os.stat(event_file)
+        return get_digest((os.path.abspath(event_file), stat.st_size, stat.st_mtime_ns))
+
+    input_dir, evtid = os.path.split(event_file)
+    shard_file, offset, length = get_event_reader(input_dir, evtid).index[str(evtid)]
+    return get_digest((os.path.abspath(shard_file), os.stat(shard_file).st_ino, offset, length))
+
+
+class SelectCache(object):
+    """Tensors derived by select_data() for the events of an input directory, for one selection."""
+
+    def __init__(self, cache_dir: str, input_dir: str, **selection):
+        self.path = os.path.join(cache_dir, "select-v{}-{}.pt".format(
+            CACHE_VERSION, get_digest((os.path.abspath(input_dir), sorted(selection.items())))
+        ))
+        self.entries = {}
+        self.n_updates = 0
+
+        if os.path.isfile(self.path):
+            try:
+                self.entries = torch.load(self.path, map_location="cpu")
+            except Exception as inst:
+                logging.warning("Ignoring corrupted select cache {}: {}".format(self.path, inst))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, event_file):
+        """Cached tensors of an event, or None if missing or outdated."""
+        entry = self.entries.get(os.path.basename(event_file))
+        if entry is None or entry["fingerprint"] != get_event_fingerprint(event_file):
+            return None
+        return entry["data"]
+
+    def put(self, event_file, event, keys):
+        """Add the tensors of a selected event, those of keys missing in the event are skipped."""
+        self.entries[os.path.basename(event_file)] = {
+            "fingerprint": get_event_fingerprint(event_file),
+            "data": {key: event[key] for key in keys if key in event and event[key] is not None},
+        }
+        self.n_updates += 1
+
+    def save(self):
+        """Write the cache if it was updated, through a temporary file so readers never see a partial one."""
+        if self.n_updates == 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = "{}.tmp-{}".format(self.path, os.getpid())
+        torch.save(self.entries, tmp_path)
+        os.replace(tmp_path, self.path)
+        self.n_updates = 0
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for the Memory-Mapped Flat-Tensor Event Format:
+
+The events of a directory are converted once into flat arrays, one file '<key>.bin' per
+tensor attribute (x, edge_index, y, y_pid, pid, pt, etc.), holding the attribute of all
+events concatenated along its node/edge dimension. Per-event offsets of each attribute are
+kept in 'offsets.npz' and the dtypes, shapes and non-tensor attributes (e.g. event_file)
+in 'meta.json'. FlatEventDataset maps the '.bin' files with np.memmap() and hands out
+zero-copy slices per event, so memory usage no longer grows with the size of the dataset.
+
+'meta.json' also keeps a fingerprint of the input events (names, sizes and mtimes of their files),
+and the flat copy is built again when the input changes. Every process (e.g. DDP rank) builds into
+its own temporary directory, renamed to the output directory only if no up-to-date copy is there.
+"""
+
+import os
+import glob
+import json
+import socket
+import shutil
+import hashlib
+import logging
+import numpy as np
+import torch
+from tqdm import tqdm
+from torch_geometric.data import Data, Dataset
+from .shard_utils import list_events, load_event, is_sharded
+
+FLAT_VERSION = 1
+META_FILE = "meta.json"
+OFFSETS_FILE = "offsets.npz"
+
+
+def is_flat(input_dir):
+    """Check if a directory holds events in the flat-tensor format."""
+    return input_dir is not None and os.path.isfile(os.path.join(input_dir, META_FILE))
+
+
+def get_cat_dim(key, value):
+    """Events are concatenated along the last dimension for edge-like attributes
+    (edge_index, signal_true_edges, etc.), along the first dimension otherwise."""
+    if value.dim() == 2 and ("index" in key or "edges" in key):
+        return -1
+    return 0
+
+
+def get_input_fingerprint(input_dir, event_ids):
+    """Hash of the events of input_dir to convert, their names, and the sizes and mtimes of
+    their files (of the shard and index files for a sharded directory)."""
+    if is_sharded(input_dir):
+        paths = sorted(glob.glob(os.path.join(input_dir, "shard-*")))
+    else:
+        paths = [os.path.join(input_dir, evtid) for evtid in event_ids]
+
+    stats = [(os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+    content = json.dumps([os.path.abspath(input_dir), list(event_ids), stats])
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def get_flat_fingerprint(output_dir):
+    """Fingerprint of the input of a flat-tensor directory, None if missing."""
+    if not is_flat(output_dir):
+        return None
+    with open(os.path.join(output_dir, META_FILE), "r") as f:
+        return json.load(f).get("fingerprint")
+
+
+def build_flat_dataset(input_dir, output_dir, num_events=None, overwrite=False, show_progress=True):
+    """Convert the events of input_dir into the flat-tensor format, one event at a time."""
+
+    all_events = sorted(list_events(input_dir))[:num_events]
+    fingerprint = get_input_fingerprint(input_dir, all_events)
+
+    if get_flat_fingerprint(output_dir) == fingerprint and not overwrite:
+        logging.info("{} already exists".format(output_dir))
+        return output_dir
+
+    print("Converting {} events from {} to {}".format(len(all_events), input_dir, output_dir))
+
+    # Write to a temporary directory of this process, so an interrupted conversion is never
+    # mistaken for a dataset, and processes building at the same time never share files
+    tmp_dir = "{}.tmp-{}-{}".format(output_dir.rstrip("/"), socket.gethostname(), os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    tensors, objects, lengths, files = {}, {}, {}, {}
+    for idx, evtid in enumerate(tqdm(all_events, disable=not show_progress)):
+        event = load_event(os.path.join(input_dir, evtid), map_location="cpu")
+
+        for key, value in event:
+            if not torch.is_tensor(value):
+                if isinstance(value, (str, int, float, bool)):
+                    objects.setdefault(key, [None] * len(all_events))[idx] = value
+                else:
+                    logging.warning("Skipping '{}' of type {}".format(key, type(value).__name__))
+                continue
+
+            cat_dim = get_cat_dim(key, value)
+            value = value.reshape(1) if value.dim() == 0 else value
+            value = value.t() if cat_dim == -1 else value
+            tail = list(value.shape[1:])
+
+            if key not in tensors:
+                tensors[key] = {"dtype": str(value.dtype).split(".")[-1], "shape": tail,
+                                "cat_dim": cat_dim, "scalar": event[key].dim() == 0}
+                lengths[key] = np.full(len(all_events), -1, dtype=np.int64)
+                files[key] = open(os.path.join(tmp_dir, key + ".bin"), "wb")
+            elif tensors[key]["shape"] != tail or tensors[key]["dtype"] != str(value.dtype).split(".")[-1]:
+                raise ValueError("Event {}: '{}' of shape {} and {} does not match other events".format(
+                    evtid, key, list(event[key].shape), value.dtype))
+
+            files[key].write(value.contiguous().numpy().tobytes())
+            lengths[key][idx] = value.shape[0]
+
+    for f in files.values():
+        f.close()
+
+    # Offsets of each attribute per event, absent attributes have a length of -1
+    offsets = {}
+    for key, length in lengths.items():
+        offsets[key] = np.concatenate([[0], np.cumsum(np.maximum(length, 0))])
+        offsets[key + ".present"] = length >= 0
+    np.savez(os.path.join(tmp_dir, OFFSETS_FILE), **offsets)
+
+    with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+        json.dump({"version": FLAT_VERSION, "event_ids": all_events, "fingerprint": fingerprint,
+                   "tensors": tensors, "objects": objects}, f)
+
+    swap_flat_dataset(tmp_dir, output_dir, None if overwrite else fingerprint)
+    return output_dir
+
+
+def swap_flat_dataset(tmp_dir, output_dir, fingerprint):
+    """Rename tmp_dir to output_dir. An up-to-date copy built by another process is kept, unless
+    fingerprint is None. An outdated one is moved aside first, as a directory cannot be replaced
+    by a rename."""
+
+    if fingerprint is not None and get_flat_fingerprint(output_dir) == fingerprint:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    old_dir = tmp_dir.replace(".tmp-", ".old-")
+    try:
+        os.rename(output_dir, old_dir)
+    except FileNotFoundError:
+        old_dir = None
+
+    try:
+        os.rename(tmp_dir, output_dir)
+    except OSError:
+        # another process renamed its copy first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class FlatEventDataset(Dataset):
+    """PyG Dataset on top of the flat-tensor format. Tensors of an event are zero-copy
+    slices of the memory-mapped '.bin' files, so only the events in use are paged in."""
+
+    def __init__(self, input_dir, transform=None):
+        super().__init__(None, transform)
+
+        self.path = input_dir
+        with open(os.path.join(input_dir, META_FILE), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != FLAT_VERSION:
+            raise ValueError("{} has flat format version {}, expected {}".format(
+                input_dir, meta["version"], FLAT_VERSION))
+
+        self.event_ids = meta["event_ids"]
+        self.tensors = meta["tensors"]
+        self.objects = meta["objects"]
+
+        with np.load(os.path.join(input_dir, OFFSETS_FILE)) as offsets:
+            self.offsets = {key: offsets[key] for key in offsets.files}
+
+        # Mapped per process on first access, see __getstate__()
+        self._arrays = None
+
+    def _map_arrays(self):
+        """Map every '.bin' file as a tensor (private, copy-on-write mapping)."""
+        arrays = {}
+        for key, spec in self.tensors.items():
+            shape = (int(self.offsets[key][-1]), *spec["shape"])
+            if np.prod(shape) > 0:
+                array = np.memmap(
+                    os.path.join(self.path, key + ".bin"), dtype=np.dtype(spec["dtype"]), mode="c", shape=shape
+                )
+            else:
+                array = np.empty(shape, dtype=np.dtype(spec["dtype"]))
+            arrays[key] = torch.from_numpy(array)
+        return arrays
+
+    def __getstate__(self):
+        # Never pickle the mapped tensors to DataLoader workers, they map the files themselves
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def len(self):
+        return len(self.event_ids)
+
+    def get(self, idx):
+        if self._arrays is None:
+            self._arrays = self._map_arrays()
+
+        event = Data()
+        for key, spec in self.tensors.items():
+            if not self.offsets[key + ".present"][idx]:
+                continue
+            start, end = self.offsets[key][idx], self.offsets[key][idx + 1]
+            value = self._arrays[key][start:end]
+            if spec["cat_dim"] == -1:
+                value = value.t()
+            elif spec["scalar"]:
+                value = value[0]
+            event[key] = value
+
+        for key, values in self.objects.items():
+            if values[idx] is not None:
+                event[key] = values[idx]
+
+        return event
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for the STT Geometry Table:
+
+The detector geometry file (stt.csv, one row per straw tube) is compiled once into a NumPy table
+'stt.npy' next to it, with row i holding tube_id i (the module_id of hits), and derived features
+(r, phi) precomputed. The table is memory-mapped, loaded once per process, so the features of the
+hits of an event are joined by integer indexing e.g. `geometry[hits.module_id]["sector"]` instead
+of merging dataframes. The table is compiled again if the geometry file is newer, or if the columns
+of GEOMETRY_DTYPE change.
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+# Geometry file of this repository (src/stt.csv)
+DETECTOR_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "stt.csv")
+)
+
+# Columns of the geometry table, tube_id of 0 marks rows without a tube
+GEOMETRY_DTYPE = np.dtype([
+    ("tube_id", np.int32),
+    ("layer", np.int32),
+    ("sector", np.int32),
+    ("skewed", np.int32),
+    ("x", np.float64),
+    ("y", np.float64),
+    ("z", np.float64),
+    ("r", np.float64),
+    ("phi", np.float64),
+    ("angle", np.float64),
+    ("inner_radius", np.float64),
+    ("outer_radius", np.float64),
+    ("tube_length", np.float64),
+])
+
+# Geometry tables of the current process, see get_geometry()
+_geometries = {}
+
+
+def get_table_path(detector_path):
+    """Path of the compiled geometry table, e.g. path/to/stt.npy"""
+    return os.path.splitext(detector_path)[0] + ".npy"
+
+
+def compile_geometry(detector_path=DETECTOR_PATH):
+    """Geometry table of a geometry file, indexed by tube_id."""
+    tubes = pd.read_csv(detector_path)
+    tube_id = tubes.tube_id.to_numpy()
+
+    table = np.zeros(tube_id.max() + 1, dtype=GEOMETRY_DTYPE)
+    table["layer"] = -1
+    table["sector"] = -1
+
+    table["tube_id"][tube_id] = tube_id
+    table["layer"][tube_id] = tubes.layer_id.to_numpy()
+    table["sector"][tube_id] = tubes.sector_id.to_numpy()
+    table["skewed"][tube_id] = tubes.skewed.to_numpy()
+    for column in ["x", "y", "z", "angle", "inner_radius", "outer_radius", "tube_length"]:
+        table[column][tube_id] = tubes[column].to_numpy()
+    table["r"][tube_id] = np.sqrt(tubes.x.to_numpy()**2 + tubes.y.to_numpy()**2)
+    table["phi"][tube_id] = np.arctan2(tubes.y.to_numpy(), tubes.x.to_numpy())
+
+    return table
+
+
+def build_geometry_table(detector_path=DETECTOR_PATH, overwrite=False):
+    """Compile the geometry table of a geometry file, if missing or outdated, returns its path."""
+    table_path = get_table_path(detector_path)
+
+    if os.path.exists(table_path) and not overwrite:
+        table = np.load(table_path, mmap_mode="r")
+        if table.dtype == GEOMETRY_DTYPE and os.path.getmtime(table_path) >= os.path.getmtime(detector_path):
+            return table_path
+
+    # Write to a temporary file, so readers never see a partial table
+    tmp_path = "{}.tmp-{}.npy".format(os.path.splitext(table_path)[0], os.getpid())
+    np.save(tmp_path, compile_geometry(detector_path))
+    os.replace(tmp_path, table_path)
+    return table_path
+
+
+def get_geometry(detector_path=DETECTOR_PATH):
+    """Get the geometry table of a geometry file, memory-mapped and loaded once per process.
+    If the table cannot be written (e.g. read-only directory), it is compiled in memory."""
+    if detector_path not in _geometries:
+        try:
+            _geometries[detector_path] = np.load(build_geometry_table(detector_path), mmap_mode="r")
+        except OSError as inst:
+            logging.warning("Geometry table not written ({}), compiled in memory".format(inst))
+            _geometries[detector_path] = compile_geometry(detector_path)
+    return _geometries[detector_path]
+
+
+def get_tubes(detector_path=DETECTOR_PATH):
+    """Rows of the geometry table holding a tube."""
+    geometry = get_geometry(detector_path)
+    return geometry[geometry["tube_id"] > 0]
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for Track Matching:
+
+Reconstructed tracks are matched to particles with NumPy arrays instead of DataFrame merges. The
+(track, particle) contingency matrix, i.e. the number of common hits of every pair, is built with
+np.unique() on combined (track, particle) keys. Pairs are sorted by track, so per track maxima are
+taken with np.maximum.reduceat(). Used by eval/eval_reco_trkx.py and GNN/Models/tracking_utils.py,
+the former requires purities strictly above the matching fractions (strict=True), the latter at
+least equal to them.
+"""
+
+import numpy as np
+
+
+def above(values, threshold, strict=False):
+    """values > threshold if strict, values >= threshold otherwise."""
+    return values > threshold if strict else values >= threshold
+
+
+def match_pairs(track_idx, pid_idx, n_reco_hits, n_true_hits,
+                frac_reco_matched=0.5, frac_truth_matched=0.5, strict=False):
+    """Contingency matrix of the (track, particle) pairs sharing hits, given the track index and
+    the particle index of every hit, the number of hits of every track and of every particle.
+
+    Returns:
+        A tuple of (pair_track, pair_pid, purity_reco, purity_reco_max, combined_match), one entry
+        per pair sorted by track. combined_match marks pairs that are the best match of the track,
+        for both the reco and the truth purity, with maxima above the matching fractions.
+    """
+    # contingency matrix, number of common hits of every (track, particle) pair
+    n_pids = max(len(n_true_hits), 1)
+    pairs, n_common_hits = np.unique(track_idx * n_pids + pid_idx, return_counts=True)
+    pair_track, pair_pid = pairs // n_pids, pairs % n_pids
+
+    # calculate matching fraction
+    purity_reco = np.true_divide(n_common_hits, n_reco_hits[pair_track])
+    purity_true = np.true_divide(n_common_hits, n_true_hits[pair_pid])
+
+    # select the best match, maxima per track (pairs are sorted by track)
+    starts = np.flatnonzero(np.diff(pair_track, prepend=-1))
+    counts = np.diff(np.append(starts, len(pairs)))
+    if len(pairs) > 0:
+        purity_reco_max = np.repeat(np.maximum.reduceat(purity_reco, starts), counts)
+        purity_true_max = np.repeat(np.maximum.reduceat(purity_true, starts), counts)
+    else:
+        purity_reco_max, purity_true_max = purity_reco, purity_true
+
+    matched_reco_tracks = above(purity_reco_max, frac_reco_matched, strict) & (purity_reco == purity_reco_max)
+    matched_true_particles = above(purity_true_max, frac_truth_matched, strict) & (purity_true == purity_true_max)
+
+    # now, let's combine the two majority criteria, the pair must be in both
+    combined_match = matched_reco_tracks & matched_true_particles
+
+    return pair_track, pair_pid, purity_reco, purity_reco_max, combined_match
+
+
+def match_reco_tracks(
+        truth_hits, truth_pids, reco_hits, reco_track_ids, particle_ids,
+        min_hits_truth=9, min_hits_reco=5,
+        frac_reco_matched=0.5, frac_truth_matched=0.5, strict=False, **kwargs):
+    """Match reconstructed tracks to particles, same counts as the pandas evaluate_reco_tracks().
+
+    Args:
+        truth_hits, truth_pids: hit ids and particle ids of the truth hits
+        reco_hits, reco_track_ids: hit ids and track ids of the reconstructed tracks
+        particle_ids: unique particle ids of the particles
+        strict: best matches need purities above (instead of at least) the matching fractions
+
+    Returns:
+        A tuple of (n_true_tracks, n_reco_tracks, n_matched_particles, n_matched_tracks,
+        n_duplicated_tracks, n_matched_tracks_poi, n_reco_particles, n_matched_reco_particles)
+        and per particle arrays of (n_true_hits, is_matched, is_trackable), where n_true_hits
+        is NaN for particles without a truth hit.
+    """
+    # just in case particle_id == 0 included in truth.
+    truth_mask = truth_pids > 0
+    truth_hits, truth_pids = truth_hits[truth_mask], truth_pids[truth_mask]
+
+    # get number of spacepoints in each reconstructed track, with a minimum number of spacepoints
+    track_ids, track_idx, n_reco_hits = np.unique(reco_track_ids, return_inverse=True, return_counts=True)
+    reco_mask = n_reco_hits[track_idx] >= min_hits_reco
+    reco_hits, track_idx = reco_hits[reco_mask], track_idx[reco_mask]
+
+    # get number of spacepoints in each particle
+    pids, pid_idx, n_true_hits = np.unique(truth_pids, return_inverse=True, return_counts=True)
+
+    # particle of every reconstructed hit, as merge(reconstructed, truth, on='hit_id'), hits without one are dropped
+    order = np.argsort(truth_hits, kind="stable")
+    lo = np.searchsorted(truth_hits[order], reco_hits, side="left")
+    n_found = np.searchsorted(truth_hits[order], reco_hits, side="right") - lo
+    rows = order[np.repeat(lo - np.cumsum(n_found) + n_found, n_found) + np.arange(n_found.sum())]
+    hit_track_idx, hit_pid_idx = np.repeat(track_idx, n_found), pid_idx[rows]
+
+    pair_track, pair_pid, purity_reco, _, combined_match = match_pairs(
+        hit_track_idx, hit_pid_idx, n_reco_hits, n_true_hits,
+        frac_reco_matched, frac_truth_matched, strict
+    )
+
+    n_reco_tracks = int(np.sum(n_reco_hits >= min_hits_reco))
+    n_true_tracks = len(particle_ids)
+
+    # For GNN, there are non-negaliable cases where GNN-based
+    # track candidates are matched to particles not considered as interesting.
+    # which means there are paticles in matched_pids that do not exist in particles.
+    matched_pids = np.unique(pids[pair_pid[combined_match]])
+
+    is_matched = np.isin(particle_ids, matched_pids)
+    n_matched_particles = int(np.sum(is_matched))
+
+    is_reco_matched = purity_reco >= frac_reco_matched
+    n_matched_tracks = int(np.sum(is_reco_matched))
+    n_matched_tracks_poi = int(np.sum(is_reco_matched & np.isin(pids[pair_pid], particle_ids)))
+    n_duplicated_tracks = n_matched_tracks_poi - n_matched_particles
+
+    # number of spacepoints of every particle, NaN for particles without any
+    if len(pids) > 0:
+        pos = np.minimum(np.searchsorted(pids, particle_ids), len(pids) - 1)
+        particle_true_hits = np.where(pids[pos] == particle_ids, n_true_hits[pos], np.nan)
+    else:
+        particle_true_hits = np.full(len(particle_ids), np.nan)
+
+    # only particles leaves at least min_hits_truth spacepoints are considered.
+    is_trackable = particle_true_hits >= min_hits_truth
+
+    # NEW: By Murnane for Tech. Efficiency
+    n_reco_particles = int(np.sum(is_trackable))
+    n_matched_reco_particles = int(np.sum(is_matched & is_trackable))
+
+    return (n_true_tracks, n_reco_tracks, n_matched_particles,
+            n_matched_tracks, n_duplicated_tracks,
+            n_matched_tracks_poi, n_reco_particles, n_matched_reco_particles,
+            particle_true_hits, is_matched, is_trackable)
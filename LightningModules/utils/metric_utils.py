@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for Streaming Edge Metrics:
+
+Instead of keeping every edge score (or distance) and truth of the test set in memory for
+sklearn's roc_curve() and precision_recall_curve(), the scores of each batch are binned into
+fixed-edge histograms, one for true and one for fake edges. Memory is bounded by the number
+of bins, and counts of batches, epochs or processes are merged by adding them. ROC, PR and
+efficiency-purity curves are evaluated at the bin edges, i.e. at a resolution of one bin.
+
+The per-batch AUC of validation logging, roc_auc_score_robust(), is computed from the ranks of
+the scores on their device instead, without a host synchronization or a call to sklearn.
+"""
+
+import numpy as np
+import torch
+from sklearn.metrics import auc
+
+
+def roc_auc_score_robust(y_true, y_pred):
+    """Same as sklearn.metrics.roc_auc_score() on tensors, with the Mann-Whitney U statistic of
+    the scores ranks (ties get their average rank). If y_true holds only one class, returns the
+    accuracy of rint(y_pred) instead, as a tensor on the device of y_pred in both cases."""
+
+    y_true, y_pred = y_true.detach().flatten().bool(), y_pred.detach().flatten()
+    n_true = y_true.sum().double()
+    n_fake = y_true.numel() - n_true
+
+    # average rank (from 1) of every sorted score, over its range of tied scores
+    sorted_pred, order = torch.sort(y_pred)
+    low = torch.searchsorted(sorted_pred, sorted_pred, right=False)
+    high = torch.searchsorted(sorted_pred, sorted_pred, right=True)
+    ranks = (low + high + 1).double() / 2
+
+    u_stat = (ranks * y_true[order]).sum() - n_true * (n_true + 1) / 2
+    roc_auc = u_stat / (n_true * n_fake).clamp(min=1)
+
+    # Handle if y_true holds only one class
+    accuracy = (torch.round(y_pred).bool() == y_true).double().mean()
+    return torch.where((n_true == 0) | (n_fake == 0), accuracy, roc_auc).float()
+
+
+class HistogramMetrics(object):
+    """Histograms of true and fake edges over fixed bin edges (n_bins uniform bins on [0, 1] by default)."""
+
+    def __init__(self, edges=None, n_bins=10000):
+        if edges is None:
+            edges = torch.linspace(0, 1, n_bins + 1)
+        self.edges = torch.as_tensor(edges, dtype=torch.float)
+
+        # bin 0 holds values below edges[0], bin k values in [edges[k-1], edges[k]), the last one values >= edges[-1]
+        self.true_counts = torch.zeros(len(self.edges) + 1, dtype=torch.long)
+        self.fake_counts = torch.zeros(len(self.edges) + 1, dtype=torch.long)
+
+    def to(self, device):
+        self.edges = self.edges.to(device)
+        self.true_counts = self.true_counts.to(device)
+        self.fake_counts = self.fake_counts.to(device)
+        return self
+
+    def update(self, values, truth):
+        """Add the values (e.g. scores) of a batch of edges. Counts are kept on the device of
+        the values, and updated without a host synchronization."""
+        values, truth = values.detach().flatten().float(), truth.detach().flatten().bool()
+        if self.edges.device != values.device:
+            self.to(values.device)
+        bins = torch.bucketize(values, self.edges, right=True)
+
+        self.true_counts.index_add_(0, bins, truth.long())
+        self.fake_counts.index_add_(0, bins, (~truth).long())
+        return self
+
+    def merge(self, other):
+        """Add the counts of another HistogramMetrics with the same bin edges."""
+        if not torch.equal(self.edges, other.edges.to(self.edges.device)):
+            raise ValueError("Cannot merge histograms with different bin edges")
+        self.true_counts += other.true_counts.to(self.true_counts.device)
+        self.fake_counts += other.fake_counts.to(self.fake_counts.device)
+        return self
+
+    @property
+    def n_true(self):
+        return int(self.true_counts.sum())
+
+    @property
+    def n_fake(self):
+        return int(self.fake_counts.sum())
+
+    def above(self):
+        """Number of true and fake edges with value >= each bin edge, returns (edges, tp, fp)."""
+        tp = self.true_counts.flip(0).cumsum(0).flip(0)[1:]
+        fp = self.fake_counts.flip(0).cumsum(0).flip(0)[1:]
+        return self.edges.cpu().numpy(), tp.cpu().numpy(), fp.cpu().numpy()
+
+    def below(self):
+        """Number of true and fake edges with value < each bin edge, returns (edges, tp, fp)."""
+        tp = self.true_counts.cumsum(0)[:-1]
+        fp = self.fake_counts.cumsum(0)[:-1]
+        return self.edges.cpu().numpy(), tp.cpu().numpy(), fp.cpu().numpy()
+
+    def roc_curve(self):
+        """Same outputs as sklearn.metrics.roc_curve(), (fpr, tpr, thresholds) with decreasing thresholds."""
+        thresholds, tp, fp = self.above()
+        fpr = np.concatenate([[0.], fp[::-1] / max(self.n_fake, 1)])
+        tpr = np.concatenate([[0.], tp[::-1] / max(self.n_true, 1)])
+        return fpr, tpr, np.concatenate([[np.inf], thresholds[::-1]])
+
+    def precision_recall_curve(self):
+        """Same outputs as sklearn.metrics.precision_recall_curve(), (precision, recall, thresholds)
+        with increasing thresholds, the last precision and recall being 1 and 0."""
+        thresholds, tp, fp = self.above()
+        positives = (tp + fp) > 0
+        precision = tp[positives] / (tp + fp)[positives]
+        recall = tp[positives] / max(self.n_true, 1)
+        return np.append(precision, 1.), np.append(recall, 0.), thresholds[positives]
+
+    def roc_auc(self):
+        fpr, tpr, _ = self.roc_curve()
+        return auc(fpr, tpr)
+
+    def prc_auc(self):
+        precision, recall, _ = self.precision_recall_curve()
+        return auc(recall, precision)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for Tensor-Native Connected Component Labelling (CCL):
+
+Connected components are found with a union-find on tensors, by hooking the root of the
+larger label onto the root of the smaller label for every edge (scatter_min) followed by
+pointer jumping, until no edge joins two different roots. Every component ends up labelled
+by its smallest node index, the labels are then made consecutive, in the same order as
+scipy.sparse.csgraph.connected_components(). No round trip to scipy is needed, so it runs
+on the device of the graph and over a PyG batch of events at once.
+"""
+
+import torch
+from torch_scatter import scatter_min
+
+
+def connected_components(edge_index, num_nodes):
+    """Label the connected components of an undirected graph, returns (n_components, labels)."""
+
+    parent = torch.arange(num_nodes, device=edge_index.device)
+    if num_nodes == 0:
+        return 0, parent
+
+    src, dst = edge_index
+    while True:
+
+        # Hook, the root of the larger label points to the root of the smaller label
+        src_root, dst_root = parent[src], parent[dst]
+        unmerged = src_root != dst_root
+        if not unmerged.any():
+            break
+        low = torch.min(src_root[unmerged], dst_root[unmerged])
+        high = torch.max(src_root[unmerged], dst_root[unmerged])
+        parent = scatter_min(low, high, dim=0, out=parent.clone())[0]
+
+        # Compress, point every node to its root
+        while True:
+            grandparent = parent[parent]
+            if torch.equal(grandparent, parent):
+                break
+            parent = grandparent
+
+    # Consecutive labels, ordered by the smallest node index of each component
+    roots, labels = torch.unique(parent, return_inverse=True)
+
+    return roots.shape[0], labels
+
+
+def segment_graph(edge_index, scores, num_nodes, edge_cut=0.5, batch=None):
+    """Segment a graph (or a PyG batch of graphs) into track candidates, keeping the edges
+    with scores above edge_cut. If the batch vector is given, labels start at 0 in every event."""
+
+    # half the length, gnn gives scores for bidirected graphs
+    scores = scores[:edge_index.shape[1]]
+
+    # filter passing edges, run connected components
+    passing_edges = edge_index[:, scores > edge_cut]
+    _, labels = connected_components(passing_edges, num_nodes)
+
+    # components never span events, so the first label of an event is its smallest one
+    if batch is not None and num_nodes > 0:
+        labels = labels - scatter_min(labels, batch, dim=0)[0][batch]
+
+    return labels
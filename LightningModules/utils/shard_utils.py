@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Utilities for Sharded Event Outputs:
+
+Instead of one torch.save() file per event, events can be packed into shard files of at most
+`shard_size` events. Every shard 'shard-<host>-<pid>-<n>.pt' comes with a text index file
+'shard-<host>-<pid>-<n>.idx' holding one 'evtid offset length' line per event, which gives O(1)
+random access by event id. Each writing process owns its shards, so multiprocessing workers and
+SLURM tasks can write into the same directory. An event is appended to the shard before its index
+line, hence an interrupted job never leaves an index entry pointing to incomplete data.
+
+With `shard_size` of 0 (default), the one file per event layout is used.
+"""
+
+import io
+import os
+import glob
+import socket
+import torch
+
+SHARD_SUFFIX = ".pt"
+INDEX_SUFFIX = ".idx"
+
+# Writers and readers of the current process, see get_writer() and get_reader()
+_writers = {}
+_readers = {}
+
+
+def is_sharded(input_dir):
+    """Check if a directory holds sharded events."""
+    return len(glob.glob(os.path.join(input_dir, "shard-*" + INDEX_SUFFIX))) > 0
+
+
+class ShardReader(object):
+    """Random access to the events of a sharded directory by event id."""
+
+    def __init__(self, input_dir: str):
+        self.path = input_dir
+        self.index = {}
+        self._files = {}
+
+        # If an event was written more than once, the last entry wins
+        for index_file in sorted(glob.glob(os.path.join(input_dir, "shard-*" + INDEX_SUFFIX))):
+            shard_file = index_file[:-len(INDEX_SUFFIX)] + SHARD_SUFFIX
+            with open(index_file, "r") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 3:
+                        self.index[fields[0]] = (shard_file, int(fields[1]), int(fields[2]))
+
+    @property
+    def event_ids(self):
+        return list(self.index.keys())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, evtid):
+        return str(evtid) in self.index
+
+    def read(self, evtid, map_location="cpu"):
+        """Read an event from its shard."""
+        shard_file, offset, length = self.index[str(evtid)]
+        if shard_file not in self._files:
+            self._files[shard_file] = open(shard_file, "rb")
+        f = self._files[shard_file]
+        f.seek(offset)
+        return torch.load(io.BytesIO(f.read(length)), map_location=map_location)
+
+    def __call__(self, evtid, *args, **kwargs):
+        return self.read(evtid)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class ShardWriter(object):
+    """Append events to shard files of at most `shard_size` events, owned by this process."""
+
+    def __init__(self, output_dir: str, shard_size: int = 1000):
+        self.path = output_dir
+        self.shard_size = shard_size
+        self.prefix = "shard-{}-{}".format(socket.gethostname(), os.getpid())
+        self.n_shards = len(glob.glob(os.path.join(output_dir, self.prefix + "-*" + INDEX_SUFFIX)))
+        self.n_events = shard_size
+        self.written = set(ShardReader(output_dir).event_ids)
+
+    def __contains__(self, evtid):
+        return str(evtid) in self.written
+
+    def _next_shard(self):
+        name = os.path.join(self.path, "{}-{:05d}".format(self.prefix, self.n_shards))
+        self.shard_file, self.index_file = name + SHARD_SUFFIX, name + INDEX_SUFFIX
+        self.n_shards += 1
+        self.n_events = 0
+
+    def write(self, evtid, obj):
+        """Serialize an event and append it to the current shard."""
+        if self.n_events >= self.shard_size:
+            self._next_shard()
+
+        buffer = io.BytesIO()
+        torch.save(obj, buffer)
+        data = buffer.getvalue()
+
+        with open(self.shard_file, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        with open(self.index_file, "a") as f:
+            f.write("{} {} {}\n".format(evtid, offset, len(data)))
+
+        self.n_events += 1
+        self.written.add(str(evtid))
+
+
+def get_writer(output_dir, shard_size):
+    """Get the shard writer of this process for output_dir."""
+    key = (output_dir, os.getpid())
+    if key not in _writers:
+        _writers[key] = ShardWriter(output_dir, shard_size)
+    return _writers[key]
+
+
+def get_reader(input_dir, refresh=False):
+    """Get the shard reader of this process for input_dir. With refresh, the index files are
+    read again, e.g. after other processes wrote to the directory."""
+    key = (input_dir, os.getpid())
+    if key not in _readers or refresh:
+        if key in _readers:
+            _readers[key].close()
+        _readers[key] = ShardReader(input_dir)
+    return _readers[key]
+
+
+def get_event_reader(input_dir, evtid):
+    """Get the shard reader of this process holding an event. The cached reader is used as
+    is, it is only refreshed if the event is missing i.e. written since the index was read."""
+    reader = get_reader(input_dir)
+    if evtid not in reader:
+        reader = get_reader(input_dir, refresh=True)
+    return reader
+
+
+def list_events(input_dir):
+    """List event names of a directory, for both one file per event and sharded layouts."""
+    if is_sharded(input_dir):
+        return get_reader(input_dir, refresh=True).event_ids
+    return os.listdir(input_dir)
+
+
+def event_exists(output_dir, evtid, shard_size=0):
+    """Check if an event has already been written to output_dir."""
+    if shard_size:
+        return evtid in get_writer(output_dir, shard_size)
+    return os.path.exists(os.path.join(output_dir, str(evtid)))
+
+
+def save_event(obj, output_dir, evtid, shard_size=0):
+    """Save an event to output_dir, as one file per event or into shards of shard_size events."""
+    if shard_size:
+        get_writer(output_dir, shard_size).write(evtid, obj)
+    else:
+        with open(os.path.join(output_dir, str(evtid)), "wb") as pickle_file:
+            torch.save(obj, pickle_file)
+
+
+def load_event(event_file, map_location="cpu"):
+    """Load an event given as 'input_dir/evtid', for both one file per event and sharded layouts."""
+    if os.path.isfile(event_file):
+        return torch.load(event_file, map_location=map_location)
+    input_dir, evtid = os.path.split(event_file)
+    return get_event_reader(input_dir, evtid).read(evtid, map_location=map_location)
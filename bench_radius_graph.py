@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmark of the radius graph backends (RadiusIndex) from Embedding/radius_utils.py against
+the former FAISS flat path of build_edges(), over events of clustered points in the embedding
+space (e.g. 10 hits per track). The edges of both are compared as well."""
+
+import time
+import argparse
+import numpy as np
+import torch
+import faiss
+import faiss.contrib.torch_utils
+
+from LightningModules.Embedding.radius_utils import RadiusIndex
+
+
+# Former implementation (new IndexFlatL2 per call, k_max neighbours then cut on r_max**2)
+def build_edges_flat(query, database, r_max=1.0, k_max=10):
+    index = faiss.IndexFlatL2(database.shape[1])
+    index.add(database)
+    Dsq, I = index.search(query, k_max)
+
+    ind = torch.arange(I.shape[0]).unsqueeze(1).expand_as(I).int()
+
+    edge_list = torch.stack([ind[Dsq <= r_max**2], I[Dsq <= r_max**2]])
+    return edge_list[:, edge_list[0] != edge_list[1]]
+
+
+def build_edges_index(query, database, r_max=1.0, k_max=10, backend="auto"):
+    edge_list, _ = RadiusIndex(database, backend).search(query, r_max, k_max)
+    return edge_list[:, edge_list[0] != edge_list[1]]
+
+
+def make_event(n_hits, dim, hits_per_track=10, spread=0.02, rng=None):
+    """Points of n_hits / hits_per_track tracks, each one a cluster around a random center."""
+    rng = rng if rng is not None else np.random.default_rng()
+    centers = rng.uniform(-1, 1, size=(max(n_hits // hits_per_track, 1), dim))
+    points = np.repeat(centers, hits_per_track, axis=0)[:n_hits]
+    return torch.from_numpy((points + spread * rng.normal(size=points.shape)).astype(np.float32))
+
+
+def to_pairs(edge_list):
+    return set(map(tuple, edge_list.long().T.tolist()))
+
+
+def timeit(func, events):
+    start = time.perf_counter()
+    outputs = [func(event) for event in events]
+    return time.perf_counter() - start, outputs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the radius graph backends of the Embedding stage.")
+    add_arg = parser.add_argument
+    add_arg("--n-hits", help="hits per event", type=int, nargs="+", default=[300, 1000, 3000, 10000])
+    add_arg("--n-events", help="number of events per size", type=int, default=5)
+    add_arg("--dim", help="embedding dimension", type=int, default=12)
+    add_arg("--r-max", help="search radius", type=float, default=0.1)
+    add_arg("--k-max", help="maximum number of neighbours", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    print("Dim: {}, r_max: {}, k_max: {}".format(args.dim, args.r_max, args.k_max))
+
+    for n_hits in args.n_hits:
+        events = [make_event(n_hits, args.dim, rng=rng) for _ in range(args.n_events)]
+        k_max = min(args.k_max, n_hits)
+
+        t_flat, flat_edges = timeit(lambda x: build_edges_flat(x, x, args.r_max, k_max), events)
+        results = []
+        for backend in ["faiss", "kdtree", "auto"]:
+            t_new, new_edges = timeit(lambda x: build_edges_index(x, x, args.r_max, k_max, backend), events)
+            same = all(to_pairs(old) == to_pairs(new) for old, new in zip(flat_edges, new_edges))
+            results.append("{} {:8.2f} ms/evt ({:5.1f}x, identical: {})".format(
+                backend, 1e3 * t_new / len(events), t_flat / max(t_new, 1e-12), same))
+
+        print("{:6d} hits: flat {:8.2f} ms/evt, {}".format(n_hits, 1e3 * t_flat / len(events), ", ".join(results)))
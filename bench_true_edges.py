@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Micro-benchmark of the true edge builders (get_layerwise_edges, get_modulewise_edges,
+get_orderwise_edges) from Processing/utils/event_utils.py against their former groupby
+implementations, over a set of synthetic STT-like events. The outputs are compared as well."""
+
+import time
+import itertools
+import argparse
+import numpy as np
+import pandas as pd
+
+from LightningModules.Processing.utils.event_utils import (
+    get_layerwise_edges, get_modulewise_edges, get_orderwise_edges
+)
+
+
+# Former implementations (groupby + lambda + python loops)
+def layerwise_edges_groupby(hits):
+    hits = hits.assign(
+        R=np.sqrt(
+            (hits.x - hits.vx) ** 2 + (hits.y - hits.vy) ** 2 + (hits.z - hits.vz) ** 2
+        )
+    )
+    hits = hits.sort_values("R").reset_index(drop=True).reset_index(drop=False)
+    hits.loc[hits["particle_id"] == 0, "particle_id"] = np.nan
+    hit_list = (
+        hits.groupby(["particle_id", "layer_id"], sort=False)["index"]
+        .agg(lambda x: list(x))
+        .groupby(level=0)
+        .agg(lambda x: list(x))
+    )
+
+    true_edges = []
+    for row in hit_list.values:
+        for i, j in zip(row[0:-1], row[1:]):
+            true_edges.extend(list(itertools.product(i, j)))
+
+    true_edges = np.array(true_edges).T
+    return true_edges, hits
+
+
+def modulewise_edges_groupby(hits):
+    signal = hits[
+        ((~hits.particle_id.isna()) & (hits.particle_id != 0)) & (~hits.vx.isna())
+    ]
+    signal = signal.drop_duplicates(
+        subset=["particle_id", "volume_id", "layer_id", "module_id"]
+    )
+    signal = signal.assign(
+        R=np.sqrt(
+            (signal.x - signal.vx) ** 2
+            + (signal.y - signal.vy) ** 2
+            + (signal.z - signal.vz) ** 2
+        )
+    )
+    signal = signal.sort_values("R").reset_index(drop=False)
+    signal = signal.rename(columns={"index": "unsorted_index"}).reset_index(drop=False)
+    signal.loc[signal["particle_id"] == 0, "particle_id"] = np.nan
+    signal_list = signal.groupby(["particle_id"], sort=False)["index"].agg(
+        lambda x: list(x)
+    )
+
+    true_edges = []
+    for row in signal_list.values:
+        for i, j in zip(row[:-1], row[1:]):
+            true_edges.append([i, j])
+
+    true_edges = np.array(true_edges).T
+    true_edges = signal.unsorted_index.values[true_edges]
+    return true_edges
+
+
+def orderwise_edges_groupby(hits):
+    signal = hits[
+        ((~hits.particle_id.isna()) & (hits.particle_id != 0)) & (~hits.vx.isna())
+    ]
+    signal = signal.drop_duplicates(
+        subset=["particle_id", "volume_id", "layer_id", "module_id"]
+    )
+    signal = signal.reset_index(drop=False)
+    signal.loc[signal["particle_id"] == 0, "particle_id"] = np.nan
+    signal_list = signal.groupby(["particle_id"], sort=False)["index"].agg(
+        lambda x: list(x)
+    )
+
+    true_edges = []
+    for row in signal_list.values:
+        for i, j in zip(row[:-1], row[1:]):
+            true_edges.append([i, j])
+
+    true_edges = np.array(true_edges).T
+    return true_edges
+
+
+def synthetic_event(rng, n_particles=20, n_layers=18, n_noise=50, max_module=150):
+    """Build a synthetic event with helix-like tracks crossing the STT layers."""
+
+    hits = []
+    for pid in range(1, n_particles + 1):
+        n_hits = rng.integers(3, 2 * n_layers)
+        layers = np.sort(rng.integers(0, n_layers, n_hits))
+        r = 16. + layers + rng.random(n_hits)
+        phi = rng.uniform(-np.pi, np.pi) + 0.02 * r
+        hits.append(pd.DataFrame({
+            "x": r * np.cos(phi), "y": r * np.sin(phi), "z": rng.normal(0, 30, n_hits),
+            "vx": 0., "vy": 0., "vz": 0., "particle_id": float(pid),
+            "volume_id": 9, "layer_id": layers, "module_id": rng.integers(0, max_module, n_hits),
+        }))
+
+    r = rng.uniform(16., 16. + n_layers, n_noise)
+    phi = rng.uniform(-np.pi, np.pi, n_noise)
+    hits.append(pd.DataFrame({
+        "x": r * np.cos(phi), "y": r * np.sin(phi), "z": rng.normal(0, 30, n_noise),
+        "vx": np.nan, "vy": np.nan, "vz": np.nan, "particle_id": 0.,
+        "volume_id": 9, "layer_id": (r - 16.).astype(int), "module_id": rng.integers(0, max_module, n_noise),
+    }))
+
+    # shuffle hits, the order of occurence is used by orderwise edges
+    hits = pd.concat(hits).sample(frac=1., random_state=rng.integers(1 << 31))
+    return hits.reset_index(drop=True)
+
+
+def timeit(func, events):
+    start = time.perf_counter()
+    outputs = [func(event) for event in events]
+    return time.perf_counter() - start, outputs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the true edge builders of the Processing stage.")
+    add_arg = parser.add_argument
+    add_arg("--n-events", help="number of synthetic events", type=int, default=200)
+    add_arg("--n-particles", help="number of particles per event", type=int, default=20)
+    add_arg("--n-noise", help="number of noise hits per event", type=int, default=50)
+    add_arg("--seed", help="random seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    events = [synthetic_event(rng, args.n_particles, n_noise=args.n_noise) for _ in range(args.n_events)]
+
+    builders = {
+        "layerwise": (lambda h: get_layerwise_edges(h)[0], lambda h: layerwise_edges_groupby(h)[0]),
+        "modulewise": (get_modulewise_edges, modulewise_edges_groupby),
+        "orderwise": (get_orderwise_edges, orderwise_edges_groupby),
+    }
+
+    print("Events: {}, Particles/Event: {}, Noise/Event: {}".format(
+        args.n_events, args.n_particles, args.n_noise))
+
+    for name, (new_func, old_func) in builders.items():
+        t_new, new_edges = timeit(new_func, events)
+        t_old, old_edges = timeit(old_func, events)
+
+        same = all(
+            (old.size == 0 and new.size == 0) or (old.shape == new.shape and (old == new).all())
+            for old, new in zip(old_edges, new_edges)
+        )
+
+        print("{:>10}: groupby {:8.2f} ms/evt, array {:8.2f} ms/evt, speedup {:6.1f}x, identical: {}".format(
+            name, 1e3 * t_old / args.n_events, 1e3 * t_new / args.n_events, t_old / max(t_new, 1e-12), same))
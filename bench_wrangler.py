@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmark of the wrangler track finder (get_tracks) from Segmenting/utils/wrangler.py
+against its former networkx implementation, over saved gnn_processed events (e.g.
+gnn_processed/test). The track candidates of both implementations are compared as well."""
+
+import os
+import time
+import argparse
+import numpy as np
+import networkx as nx
+from functools import partial
+
+from LightningModules.Segmenting.utils.wrangler import build_adjacency, get_tracks
+from LightningModules.Segmenting.utils.utils_fit import pairwise, poly_fit_phi
+from LightningModules.utils.shard_utils import list_events, load_event
+
+
+# Former implementation (networkx graph, python sets and np.unique per step)
+def find_next_hits_nx(G, pp, used_hits, th=0.1, th_re=0.8, feature_name='solution'):
+    nbrs = list(set(G.neighbors(pp)).difference(set(used_hits)))
+    if len(nbrs) < 1:
+        return None
+
+    weights = [G.edges[(pp, i)][feature_name] for i in nbrs]
+    if max(weights) < th:
+        return None
+
+    sorted_idx = list(reversed(np.argsort(weights)))
+    next_hits = [nbrs[sorted_idx[0]]]
+    if len(sorted_idx) > 1:
+        for ii in range(1, len(sorted_idx)):
+            idx = sorted_idx[ii]
+            w = weights[idx]
+            if w > th_re:
+                next_hits.append(nbrs[idx])
+            else:
+                break
+
+    return next_hits
+
+
+def build_roads_nx(G, ss, next_hit_fn, used_hits):
+    next_hits = next_hit_fn(G, ss, used_hits)
+    if next_hits is None:
+        return [(ss, None)]
+    path = []
+    for hit in next_hits:
+        path.append((ss, hit))
+
+    while True:
+        new_path = []
+        is_all_none = True
+        for pp in path:
+            if pp[-1] is not None:
+                is_all_none = False
+                break
+        if is_all_none:
+            break
+
+        for pp in path:
+            start = pp[-1]
+            if start is None:
+                new_path.append(pp)
+                continue
+
+            used_hits_cc = np.unique(used_hits + list(pp))
+            next_hits = next_hit_fn(G, pp[-1], used_hits_cc)
+            if next_hits is None:
+                new_path.append(pp + (None,))
+            else:
+                for hit in next_hits:
+                    new_path.append(pp + (hit,))
+
+        path = new_path
+    return path
+
+
+def fit_road_nx(G, road):
+    road_chi2 = []
+    for path in road:
+        z = np.array([G.nodes[i]['x'][2] for i in path[:-1]])
+        phi = np.array([G.nodes[i]['x'][1] for i in path[:-1]])
+        if len(z) > 1:
+            _, _, diff = poly_fit_phi(z, phi)
+            road_chi2.append(np.sum(diff) / len(z))
+        else:
+            road_chi2.append(1)
+
+    return road_chi2
+
+
+def chose_a_road_nx(road, diff):
+    res = road[0]
+    for i in range(1, len(road)):
+        if diff[i] <= diff[0] and len(road[i]) > len(res):
+            res = road[i]
+
+    return res
+
+
+def get_tracks_nx(G, th=0.1, th_re=0.8, feature_name='scores', with_fit=True):
+    used_nodes = []
+    sub_graphs = []
+    next_hit_fn = partial(find_next_hits_nx, th=th, th_re=th_re, feature_name=feature_name)
+    for node in G.nodes():
+        if node in used_nodes:
+            continue
+        road = build_roads_nx(G, node, next_hit_fn, used_nodes)
+        diff = fit_road_nx(G, road) if with_fit else [0.] * len(road)
+        a_road = chose_a_road_nx(road, diff)
+
+        if len(a_road) < 3:
+            used_nodes.append(node)
+            sub_graphs.append(G.subgraph([node]))
+            continue
+
+        a_track = list(pairwise(a_road[:-1]))
+        sub = G.edge_subgraph(a_track)
+        sub_graphs.append(sub)
+        used_nodes += list(sub.nodes())
+
+    return sub_graphs
+
+
+def to_graph(x, edge_index, scores):
+    """Same DiGraph as to_networkx(data, node_attrs=['x'], edge_attrs=['scores'])."""
+    G = nx.DiGraph()
+    G.add_nodes_from((i, {"x": x[i].tolist()}) for i in range(len(x)))
+    G.add_edges_from((int(s), int(r), {"scores": float(w)}) for (s, r), w in zip(edge_index.T, scores))
+    return G
+
+
+def timeit(func, events):
+    start = time.perf_counter()
+    outputs = [func(*event) for event in events]
+    return time.perf_counter() - start, outputs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the wrangler track finder of the Segmenting stage.")
+    add_arg = parser.add_argument
+    add_arg("input_dir", help="directory of gnn_processed events (e.g. gnn_processed/test)")
+    add_arg("--n-events", help="number of events", type=int, default=20)
+    add_arg("--edge-cut", help="edge score cut", type=float, default=0.5)
+    add_arg("--with-fit", help="choose roads with the phi-z fit", action="store_true")
+    args = parser.parse_args()
+
+    events = []
+    for evtid in sorted(list_events(args.input_dir))[:args.n_events]:
+        graph = load_event(os.path.join(args.input_dir, evtid), map_location="cpu")
+        scores = graph.scores[:graph.edge_index.shape[1]]
+        edge_mask = scores > args.edge_cut
+        events.append((graph.x.numpy(), graph.edge_index[:, edge_mask].numpy(), scores[edge_mask].numpy()))
+
+    def new_func(x, edge_index, scores):
+        adjacency = build_adjacency(edge_index, scores, len(x))
+        return get_tracks(adjacency, x, with_fit=args.with_fit)
+
+    def old_func(x, edge_index, scores):
+        return get_tracks_nx(to_graph(x, edge_index, scores), with_fit=args.with_fit)
+
+    print("Events: {}, Edge Cut: {}, With Fit: {}".format(len(events), args.edge_cut, args.with_fit))
+
+    t_new, new_tracks = timeit(new_func, events)
+    t_old, old_tracks = timeit(old_func, events)
+
+    same = all(
+        len(old) == len(new) and all(sorted(o.nodes()) == n.tolist() for o, n in zip(old, new))
+        for old, new in zip(old_tracks, new_tracks)
+    )
+
+    print("wrangler: networkx {:8.2f} ms/evt, csr {:8.2f} ms/evt, speedup {:6.1f}x, identical: {}".format(
+        1e3 * t_old / max(len(events), 1), 1e3 * t_new / max(len(events), 1), t_old / max(t_new, 1e-12), same))
@@ -5,12 +5,18 @@
 gnn4itk repo. The code breakdown of the script is given in 'stt6_eval.ipynb' notebook."""
 
 import os
+import sys
 import glob
 import torch
 import numpy as np
 import pandas as pd
 from typing import Any
 
+# Repository root, for the utilities shared with the pipeline stages
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from LightningModules.utils.shard_utils import list_events, load_event
+from LightningModules.utils.matching_utils import match_reco_tracks
+
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
@@ -21,14 +27,14 @@ class SttTorchDataReader(object):
         """Initialize Instance Variables in Constructor"""
 
         self.path = input_dir
-        all_files = sorted(glob.glob(os.path.join(input_dir, "*")))
+        all_files = sorted(list_events(input_dir))
         self.nevts = len(all_files)
         self.all_evtids = [os.path.basename(x) for x in all_files]
 
     def read(self, evtid: int = None):
         """Read an Event from the Input Directory."""
         event_fname = os.path.join(self.path, "{}".format(evtid))
-        event = torch.load(event_fname, map_location=device)
+        event = load_event(event_fname, map_location=device)
         return event
 
     def __call__(self, evtid: int, *args: Any, **kwds: Any) -> Any:
@@ -61,154 +67,41 @@ def evaluate_reco_tracks(
             matched_pids: np.narray, a list of particle IDs matched by reconstructed tracks
         )
     """
-    # just in case particle_id == 0 included in truth.
-    if 'particle_id' in truth.columns:
-        truth = truth[truth.particle_id > 0]
-
-    # get number of spacepoints in each reconstructed tracks
-    n_reco_hits = reconstructed.track_id.value_counts(sort=False)\
-        .reset_index().rename(
-            columns={"index":"track_id", "track_id": "n_reco_hits"})
-
-    # only tracks with a minimum number of spacepoints are considered
-    n_reco_hits = n_reco_hits[n_reco_hits.n_reco_hits >= min_hits_reco]
-    
-    # FIXME: Check
-    # print("shape:", n_reco_hits.shape)
-    
-    reconstructed = reconstructed[reconstructed.track_id.isin(n_reco_hits.track_id.values)]
-
-    # get number of spacepoints in each particle
-    hits = truth.merge(particles, on='particle_id', how='left')
-    n_true_hits = hits.particle_id.value_counts(sort=False).reset_index().rename(
-        columns={"index":"particle_id", "particle_id": "n_true_hits"})
-    
-    # only particles leaves at least min_hits_truth spacepoints 
-    # and with pT >= min_pt are considered.
-    particles = particles.merge(n_true_hits, on=['particle_id'], how='left')
-
-    is_trackable = particles.n_true_hits >= min_hits_truth
-
-
-    # event has 3 columnes [track_id, particle_id, hit_id]
-    event = pd.merge(reconstructed, truth, on=['hit_id'], how='left')
-
-    # n_common_hits and n_shared should be exactly the same 
-    # for a specific track id and particle id
-
-    # Each track_id will be assigned to multiple particles.
-    # To determine which particle the track candidate is matched to, 
-    # we use the particle id that yields a maximum value of n_common_hits / n_reco_hits,
-    # which means the majority of the spacepoints associated with the reconstructed
-    # track candidate comes from that true track.
-    # However, the other way may not be true.
-    reco_matching = event.groupby(['track_id', 'particle_id']).size()\
-        .reset_index().rename(columns={0:"n_common_hits"})
-
-    # Each particle will be assigned to multiple reconstructed tracks
-    truth_matching = event.groupby(['particle_id', 'track_id']).size()\
-        .reset_index().rename(columns={0:"n_shared"})
-
-    # add number of hits to each of the maching dataframe
-    reco_matching = reco_matching.merge(n_reco_hits, on=['track_id'], how='left')
-    truth_matching = truth_matching.merge(n_true_hits, on=['particle_id'], how='left')
-
-    # calculate matching fraction
-    reco_matching = reco_matching.assign(
-        purity_reco=np.true_divide(reco_matching.n_common_hits, reco_matching.n_reco_hits))
-    truth_matching = truth_matching.assign(
-        purity_true = np.true_divide(truth_matching.n_shared, truth_matching.n_true_hits))
-
-    # select the best match
-    reco_matching['purity_reco_max'] = reco_matching.groupby(
-        "track_id")['purity_reco'].transform(max)
-    truth_matching['purity_true_max'] = truth_matching.groupby(
-        "track_id")['purity_true'].transform(max)
-    
-    # FIXME: For 0.5, we should reguire that purity_reco_max > frac_reco_matched
-    matched_reco_tracks = reco_matching[
-        (reco_matching.purity_reco_max > frac_reco_matched) \
-      & (reco_matching.purity_reco == reco_matching.purity_reco_max)]
-    
-    # FIXME: Check
-    if matched_reco_tracks.shape[0] > n_reco_hits.shape[0]:
-        print("More True Matched:", matched_reco_tracks.shape[0], n_reco_hits.shape[0])
-    
-    # FIXME: For 0.5, we should reguire that purity_true_max > frac_truth_matched
-    matched_true_particles = truth_matching[
-        (truth_matching.purity_true_max > frac_truth_matched) \
-      & (truth_matching.purity_true == truth_matching.purity_true_max)]
-    
-    # FIXME: Check
-    if matched_true_particles.shape[0] > n_true_hits.shape[0]:
-        print("More True Matched:", matched_true_particles.shape[0], n_true_hits.shape[0])
-    
-    # now, let's combine the two majority criteria
-    # reconstructed tracks must be in both matched dataframe
-    # and the so matched particle should be the same
-    # in this way, each track should be only assigned 
-    combined_match = matched_true_particles.merge(
-        matched_reco_tracks, on=['track_id', 'particle_id'], how='inner')
-
-    n_reco_tracks = n_reco_hits.shape[0]
-    n_true_tracks = particles.shape[0]
-
-    # For GNN, there are non-negaliable cases where GNN-based
-    # track candidates are matched to particles not considered as interesting.
-    # which means there are paticles in matched_pids that do not exist in particles.
-    matched_pids = np.unique(combined_match.particle_id)
-
-    is_matched = particles.particle_id.isin(matched_pids).values
-    n_matched_particles = np.sum(is_matched)
-
-    n_matched_tracks = reco_matching[
-        reco_matching.purity_reco >= frac_reco_matched].shape[0]
-    n_matched_tracks_poi = reco_matching[
-        (reco_matching.purity_reco >= frac_reco_matched) \
-        & (reco_matching.particle_id.isin(particles.particle_id.values))
-        ].shape[0]
-    # print(n_matched_tracks_poi, n_matched_tracks)
-
-    # num_particles_matched_to = reco_matched.groupby("particle_id")['track_id']\
-    #     .count().reset_index().rename(columns={"track_id": "n_tracks_matched"})
-    # n_duplicated_tracks = num_particles_matched_to.shape[0]
-    n_duplicated_tracks = n_matched_tracks_poi - n_matched_particles
-
-    particles = particles.assign(
+    results = match_reco_tracks(
+        truth.hit_id.values, truth.particle_id.values,
+        reconstructed.hit_id.values, reconstructed.track_id.values,
+        particles.particle_id.values,
+        min_hits_truth=min_hits_truth, min_hits_reco=min_hits_reco,
+        frac_reco_matched=frac_reco_matched, frac_truth_matched=frac_truth_matched, strict=True)
+
+    n_true_hits, is_matched, is_trackable = results[-3:]
+    particles = particles.reset_index(drop=True).assign(
+        n_true_hits=n_true_hits if np.isnan(n_true_hits).any() else n_true_hits.astype(np.int64),
         is_matched=is_matched,
         is_trackable=is_trackable)
-    
-    # NEW: By Murnane for Tech. Efficiency
-    n_reco_particles = particles[particles.is_trackable].shape[0]
-    n_matched_reco_particles = particles[particles.is_matched & particles.is_trackable].shape[0]
-    
-    return (n_true_tracks, n_reco_tracks, n_matched_particles,
-            n_matched_tracks, n_duplicated_tracks, 
-            n_matched_tracks_poi, n_reco_particles, n_matched_reco_particles,  # NEW
-            particles)
+
+    return results[:-3] + (particles, )
 
 
 def run_one_evt(evtid, csv_reader, recotrkx_reader, **kwargs):
     # print("Running {}".format(evtid))
     
-    # Load Raw CSV/Torch Events to Get Truth Information
+    # Load Raw CSV/Torch Events to Get Truth Information, first hit of every particle
     raw_data = csv_reader(evtid)
-    truth = pd.DataFrame({'hit_id': raw_data.hid.numpy(), 'particle_id': raw_data.pid.int().numpy()},
-                          columns=['hit_id', 'particle_id'])
-                          
-    particles = pd.DataFrame({'particle_id': raw_data.pid.int().numpy(),
-                               'pt': raw_data.pt.numpy(),
-                               'vx': raw_data.vertex[:,0].numpy(),
-                               'vy': raw_data.vertex[:,1].numpy(),
-                               'vz': raw_data.vertex[:,2].numpy(),
-                               'q': raw_data.charge.numpy(),
-                               'pdgcode': raw_data.pdgcode.numpy(),
-                               'ptheta': raw_data.ptheta.numpy(),
-                               'peta': raw_data.peta.numpy(),
-                               'pphi': raw_data.pphi.numpy()
-                               },
-                              columns=['particle_id', 'pt', 'vx', 'vy', 'vz', 'q', 'pdgcode', 'ptheta', 'peta', 'pphi']
-                              ).drop_duplicates(subset=['particle_id'])
+    hit_pids = raw_data.pid.int().cpu().numpy()
+    _, first = np.unique(hit_pids, return_index=True)
+    first = np.sort(first)
+
+    particles = {'particle_id': hit_pids[first],
+                 'pt': raw_data.pt.cpu().numpy()[first],
+                 'vx': raw_data.vertex[:, 0].cpu().numpy()[first],
+                 'vy': raw_data.vertex[:, 1].cpu().numpy()[first],
+                 'vz': raw_data.vertex[:, 2].cpu().numpy()[first],
+                 'q': raw_data.charge.cpu().numpy()[first],
+                 'pdgcode': raw_data.pdgcode.cpu().numpy()[first],
+                 'ptheta': raw_data.ptheta.cpu().numpy()[first],
+                 'peta': raw_data.peta.cpu().numpy()[first],
+                 'pphi': raw_data.pphi.cpu().numpy()[first]}
     
     # Load Track Candidates
     submission = recotrkx_reader(evtid)
@@ -216,8 +109,44 @@ def run_one_evt(evtid, csv_reader, recotrkx_reader, **kwargs):
     # Handle -ve track_id from track_from_gnn.py, We have them to hold unused hits
     # submission = submission[submission['track_id'] > -1]
     
-    results = evaluate_reco_tracks(truth, submission, particles, **kwargs)
-    return results[:-1] + (results[-1].assign(evtid=evtid), )
+    results = match_reco_tracks(
+        raw_data.hid.cpu().numpy(), hit_pids,
+        submission.hit_id.values, submission.track_id.values,
+        particles['particle_id'], strict=True, **kwargs)
+
+    # per particle columns, the DataFrame of all events is built once in the end
+    n_true_hits, is_matched, is_trackable = results[-3:]
+    particles.update(
+        n_true_hits=n_true_hits if np.isnan(n_true_hits).any() else n_true_hits.astype(np.int64),
+        is_matched=is_matched,
+        is_trackable=is_trackable,
+        evtid=np.full(len(is_matched), evtid))
+
+    return results[:-3] + (particles, )
+
+
+# Readers of the current worker process, see init_worker()
+_readers = {}
+
+
+def init_worker(csv_path, reco_track_path):
+    """Open the readers once per worker, instead of pickling them with every event."""
+    _readers["csv"] = SttTorchDataReader(csv_path)
+    _readers["reco"] = SttTorchDataReader(reco_track_path)
+
+
+def run_chunk(evtids, **kwargs):
+    """Evaluate a chunk of events with the readers of this process. Counters are summed
+    and the per particle columns concatenated, so only one result per chunk is returned."""
+    counters = np.zeros(8, dtype=np.int64)
+    columns = {}
+    for evtid in evtids:
+        results = run_one_evt(evtid, _readers["csv"], _readers["reco"], **kwargs)
+        counters += results[:-1]
+        for key, value in results[-1].items():
+            columns.setdefault(key, []).append(value)
+
+    return counters, {key: np.concatenate(values) for key, values in columns.items()}
 
 # %%
 if __name__ == '__main__':
@@ -235,6 +164,7 @@ if __name__ == '__main__':
     add_arg('-e', '--event-id', help='evaluate a particular event', type=int, default=None)
     add_arg('-f', '--force', help='force to over write existing file', action='store_true')
     add_arg("--num-workers", help='number of workers', default=1, type=int)
+    add_arg("--chunk-size", help='number of events evaluated per worker task', default=100, type=int)
 
     add_arg("--min-hits-truth", help='minimum number of hits in a truth track',
             default=7, type=int)
@@ -275,27 +205,24 @@ if __name__ == '__main__':
         exit(1)
 
     if not args.event_id:
+        # chunks of consecutive events, each worker opens its own readers (sequential reads within shards)
+        evtids = all_evtids[:max_evts]
+        chunks = [evtids[i:i + args.chunk_size] for i in range(0, len(evtids), args.chunk_size)]
+        fnc = partial(run_chunk, **vars(args))
+
         if num_workers > 1:
-            with Pool(num_workers) as p:
-                fnc = partial(run_one_evt,
-                    csv_reader=csv_reader,
-                    recotrkx_reader=reco_trkx_reader,
-                    **vars(args))
-                res = p.map(fnc, all_evtids[:max_evts])
+            with Pool(num_workers, initializer=init_worker, initargs=(args.csv_path, reco_track_path)) as p:
+                res = list(p.imap(fnc, chunks))
         else:
-            res = [run_one_evt(evtid, csv_reader, reco_trkx_reader, **vars(args)) \
-                for evtid in all_evtids[:max_evts]]
-
-        # merge results from each process
-        n_sel_particles = sum([x[0] for x in res])
-        n_reco_tracks = sum([x[1] for x in res])
-        n_matched_sel_particles = sum([x[2] for x in res])
-        n_matched_reco_tracks = sum([x[3] for x in res])
-        n_duplicated_reco_tracks = sum([x[4] for x in res])
-        n_matched_reco_tracks_poi = sum([x[5] for x in res])
-        n_reco_particles = sum([x[6] for x in res])              # NEW
-        n_matched_reco_particles = sum([x[7] for x in res])      # NEW
-        particles = pd.concat([x[-1] for x in res], axis=0)
+            _readers.update(csv=csv_reader, reco=reco_trkx_reader)
+            res = [fnc(chunk) for chunk in chunks]
+
+        # merge counters from each chunk, the particles table is only built here
+        (n_sel_particles, n_reco_tracks,
+        n_matched_sel_particles, n_matched_reco_tracks,
+        n_duplicated_reco_tracks, n_matched_reco_tracks_poi,
+        n_reco_particles, n_matched_reco_particles) = sum([x[0] for x in res]).tolist()
+        particles = pd.DataFrame({key: np.concatenate([x[-1][key] for x in res]) for key in res[0][-1]})
     else:
         (n_sel_particles, n_reco_tracks, 
         n_matched_sel_particles, n_matched_reco_tracks,
@@ -303,6 +230,7 @@ if __name__ == '__main__':
         n_reco_particles, n_matched_reco_particles,              # NEW
         particles) = \
                 run_one_evt(args.event_id, csv_reader, reco_trkx_reader, **vars(args))
+        particles = pd.DataFrame(particles)
 
     print("Finihed evaluation and saving output to {}_particles.h5".format(os.path.split(outname)[1]))
     
@@ -6,6 +6,7 @@
 exatrkx-iml2020. The code breakdown of the script is given in 'stt4_seg.ipynb' notebook."""
 
 import os
+import sys
 import glob
 import torch
 import numpy as np
@@ -16,34 +17,18 @@ from multiprocessing import Pool
 from functools import partial
 from sklearn.cluster import DBSCAN
 
+# Repository root, for the utilities shared with the pipeline stages
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from LightningModules.utils.shard_utils import list_events, load_event
+from LightningModules.Segmenting.utils.dbscan import build_affinity_matrix, get_connected_nodes
+
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
 # Sparse Matrix
 def GetCooMatrix(scores, senders, receivers, n_nodes):
-    """Prepare Sparse Matrix in COO format for DBSCAN"""
-    
-    # adjancy matrix with its value being the edge socre.
-    e_csr = sps.csr_matrix((scores, (senders, receivers)),
-                           shape=(n_nodes, n_nodes),
-                           dtype=np.float32)
-    
-    # rescale the duplicated edges
-    e_csr.data[e_csr.data > 1] = e_csr.data[e_csr.data > 1]/2.
-    
-    # invert to treat score as an inverse distance
-    e_csr.data = 1 - e_csr.data
-    
-    # make it symmetric
-    e_csr_bi = sps.coo_matrix(
-        (np.hstack([e_csr.tocoo().data, e_csr.tocoo().data]),
-         np.hstack([np.vstack([e_csr.tocoo().row, e_csr.tocoo().col]),
-                    np.vstack([e_csr.tocoo().col, e_csr.tocoo().row])]
-                   )
-         )
-    )
-    
-    return e_csr_bi
+    """Prepare Sparse Matrix for DBSCAN, see build_affinity_matrix()"""
+    return build_affinity_matrix(senders, receivers, scores, n_nodes)
 
 
 # DBSCAN Clustering
@@ -55,20 +40,12 @@ def DBSCANClustering(hit_id, e_csr_bi, epsilon=0.25, min_samples=2):
         eps=epsilon, metric='precomputed',
         min_samples=min_samples).fit_predict(e_csr_bi)
     
-    # Track Lables
-    track_labels = np.vstack(
-        [np.unique(e_csr_bi.tocoo().row),
-         clusters[np.unique(e_csr_bi.tocoo().row)]])
-    
-    # Convert to DataFrame
-    track_labels = pd.DataFrame(track_labels.T)
-    track_labels.columns = ["hit_id", "track_id"]
-    
-    new_hit_id = np.apply_along_axis(
-        lambda x: hit_id[x], 0, track_labels.hit_id.values)
+    # Track Lables of connected nodes, mapped to hit ids
+    nodes = get_connected_nodes(e_csr_bi)
+    hit_id = hit_id.cpu().numpy() if torch.is_tensor(hit_id) else np.asarray(hit_id)
     
     tracks = pd.DataFrame.from_dict(
-        {"hit_id": new_hit_id, "track_id": track_labels.track_id})
+        {"hit_id": hit_id[nodes], "track_id": clusters[nodes]})
     
     return tracks
 
@@ -83,7 +60,7 @@ def process(filename, output_dir, edge_score_cut, epsilon=0.25, min_samples=2, *
     evtid = int(os.path.basename(filename))
 
     # load weighted graph
-    graph = torch.load(filename, map_location=device)
+    graph = load_event(filename, map_location=device)
     
     # get necessary data
     hit_id = graph.hid
@@ -148,7 +125,7 @@ if __name__ == "__main__":
     outputdir = args.output_dir                # gnn_segmenting or seg_processed 
     os.makedirs(outputdir, exist_ok=True)      # create outputdir if it doesn't exist
         
-    all_files = glob.glob(os.path.join(inputdir, "*"))
+    all_files = [os.path.join(inputdir, event) for event in list_events(inputdir)]
     all_files = sorted(all_files)
     
     n_tot_files = len(all_files)
@@ -5,6 +5,7 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.patches import Circle
+from LightningModules.utils.geometry_utils import get_tubes
 
 try:
     output_base = os.path.dirname(os.path.abspath(__file__))
@@ -26,20 +27,20 @@ def detector_layout(figsize=(10, 10)):
     # init subplots
     fig, ax = plt.subplots(nrows=1, ncols=1, figsize=figsize)
 
-    # detector layout    
-    data = pd.read_csv(detector_path)
-    data['sign'] = np.sign(data['angle'])
+    # detector layout, geometry table loaded once
+    data = get_tubes(detector_path)
+    sign = np.sign(data['angle'])
     
     # filter tubes
-    parallel_tubes = data.query('sign == 0')      # Parallel tubes
-    pos_skewed_tubes = data.query('sign == 1')    # Positively skewed tubes
-    neg_skewed_tubes = data.query('sign == -1')   # Negatively skewed tubes
+    parallel_tubes = data[sign == 0]      # Parallel tubes
+    pos_skewed_tubes = data[sign == 1]    # Positively skewed tubes
+    neg_skewed_tubes = data[sign == -1]   # Negatively skewed tubes
     
     # draw tubes
-    # ax.scatter(data.x.values, data.y.values, s=0.5, facecolors='none', edgecolors='lightgrey')
-    ax.scatter(parallel_tubes.x.values, parallel_tubes.y.values, s=50, facecolors='none', edgecolors='lightgreen')  # parallel
-    ax.scatter(pos_skewed_tubes.x.values, pos_skewed_tubes.y.values, s=50, facecolors='none', edgecolors='royalblue')  # positive skewed
-    ax.scatter(neg_skewed_tubes.x.values, neg_skewed_tubes.y.values, s=50, facecolors='none', edgecolors='lightcoral')  # negative skewed
+    # ax.scatter(data['x'], data['y'], s=0.5, facecolors='none', edgecolors='lightgrey')
+    ax.scatter(parallel_tubes['x'], parallel_tubes['y'], s=50, facecolors='none', edgecolors='lightgreen')  # parallel
+    ax.scatter(pos_skewed_tubes['x'], pos_skewed_tubes['y'], s=50, facecolors='none', edgecolors='royalblue')  # positive skewed
+    ax.scatter(neg_skewed_tubes['x'], neg_skewed_tubes['y'], s=50, facecolors='none', edgecolors='lightcoral')  # negative skewed
     
     # plotting params
     ax.set_xlabel('x [cm]', fontsize=15)
@@ -60,23 +61,22 @@ def detector_layout_new(figsize=(10, 10)):
     # init subplots
     fig, ax = plt.subplots(nrows=1, ncols=1, figsize=figsize)
 
-    # detector layout    
-    data = pd.read_csv(detector_path)
-    data['sign'] = np.sign(data['angle'])
+    # detector layout, geometry table loaded once
+    data = get_tubes(detector_path)
     
     # draw tubes
-    for index, row in data.iterrows():
-        if row['sign'] == 0:  # Parallel tubes
+    for row, sign in zip(data, np.sign(data['angle'])):
+        if sign == 0:  # Parallel tubes
 	        straightOuterTube = Circle((row['x'], row['y']), row['outer_radius'], fc='None', ec='lightgreen')
 	        ax.add_patch(straightOuterTube)
 	        straightInnerTube = Circle((row['x'], row['y']), row['inner_radius'], fc='None', ec='lightgreen')
 	        ax.add_patch(straightInnerTube)
-        elif row['sign'] == 1:  # Positively skewed tubes
+        elif sign == 1:  # Positively skewed tubes
 	        posSkewedOuterTube = Circle((row['x'], row['y']), row['outer_radius'], fc='None', ec='royalblue')
 	        ax.add_patch(posSkewedOuterTube)
 	        posSkewedInnerTube = Circle((row['x'], row['y']), row['inner_radius'], fc='None', ec='royalblue')
 	        ax.add_patch(posSkewedInnerTube)
-        elif row['sign'] == -1:  # Negatively skewed tubes
+        elif sign == -1:  # Negatively skewed tubes
 	        negSkewedOuterTube = Circle((row['x'], row['y']), row['outer_radius'], fc='None', ec='lightcoral')
 	        ax.add_patch(negSkewedOuterTube)
 	        negSkewedInnerTube = Circle((row['x'], row['y']), row['inner_radius'], fc='None', ec='lightcoral')
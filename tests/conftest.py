@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the stages as the pipeline does, e.g. LightningModules.GNN.utils.data_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,45 @@
+import io
+
+import numpy as np
+import pytest
+import torch
+from torch_geometric.data import Data
+
+from LightningModules.GNN.utils import data_utils as gnn_data_utils
+from LightningModules.DNN.utils import data_utils as dnn_data_utils
+
+
+def flat_event(tmp_path, n_total=1000000, start=100, end=110):
+    """Event of FlatEventDataset.get(), its tensors being slices of large memory-mapped arrays."""
+    x = np.memmap(tmp_path / "x.bin", dtype=np.float32, mode="w+", shape=(n_total, 3))
+    x[:] = np.arange(n_total * 3, dtype=np.float32).reshape(n_total, 3)
+    edges = np.memmap(tmp_path / "edge_index.bin", dtype=np.int64, mode="w+", shape=(n_total, 2))
+    edges[:] = np.arange(n_total * 2).reshape(n_total, 2)
+
+    return Data(
+        x=torch.from_numpy(x)[start:end],
+        edge_index=torch.from_numpy(edges)[start:end].t(),
+        event_file="path/to/0000000001",
+    )
+
+
+def saved_size(event):
+    buffer = io.BytesIO()
+    torch.save(event, buffer)
+    return len(buffer.getvalue())
+
+
+@pytest.mark.parametrize("data_utils", [gnn_data_utils, dnn_data_utils])
+def test_compact_event_saves_only_its_tensors(tmp_path, data_utils):
+    event = flat_event(tmp_path)
+    compact = data_utils.compact_event(event)
+
+    # Same values, a shallow copy otherwise
+    assert torch.equal(compact.x, event.x)
+    assert torch.equal(compact.edge_index, event.edge_index)
+    assert compact.event_file == event.event_file
+    assert compact is not event
+
+    # A view saves the storage of all events (12 MB for x), the compact copy only its own
+    assert saved_size(event) > 10 * 1000000
+    assert saved_size(compact) < 10000
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from LightningModules.Processing.utils.graph_utils import construct_edges, construct_edges_csr
+
+
+def synthetic_hits(n_hits=400, n_layers=8, seed=0):
+    """Hits of one event in random layers and sectors, with a shuffled, non-contiguous index."""
+    rng = np.random.default_rng(seed)
+    phi = rng.uniform(-np.pi, np.pi, n_hits)
+    layer = rng.integers(0, n_layers, n_hits)
+
+    # No hits on the last layer but one, its layer pairs are skipped
+    layer[layer == n_layers - 2] = n_layers - 1
+
+    hits = pd.DataFrame({
+        "event_id": 1,
+        "layer": layer,
+        "r": 16.0 + layer,
+        "phi": phi,
+        "isochrone": rng.uniform(0, 0.5, n_hits),
+        "sector_id": ((phi + np.pi) // (np.pi / 3)).astype(int) % 6,
+    })
+    hits.index = rng.permutation(np.arange(n_hits) * 3 + 7)
+    return hits
+
+
+@pytest.mark.parametrize("filtering", [True, False])
+def test_construct_edges_csr_matches_construct_edges(filtering):
+    hits = synthetic_hits()
+    layers = np.arange(hits.layer.max() + 1)
+    layer_pairs = np.stack([layers[:-1], layers[1:]], axis=1)
+
+    expected = construct_edges(hits, layer_pairs, filtering).to_numpy().T
+    edges = construct_edges_csr(hits, layer_pairs, filtering)
+
+    # Same edges, in the same order
+    assert edges.shape == expected.shape
+    assert expected.shape[1] > 0
+    np.testing.assert_array_equal(edges, expected)
+
+
+def test_construct_edges_csr_without_edges():
+    hits = synthetic_hits()
+    edges = construct_edges_csr(hits, [(100, 101)])
+    assert edges.shape == (2, 0)
@@ -0,0 +1,28 @@
+import os
+from functools import partial
+
+from LightningModules.Processing.utils.manifest_utils import Manifest, process_events
+
+
+def crash_once(event_file, marker_dir):
+    """Kill the worker on the first attempt of event 2, as the OOM killer would."""
+    marker = os.path.join(marker_dir, "crashed")
+    if event_file.endswith("0000000002") and not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return {"n_hits": 1, "n_edges": 0}
+
+
+def test_process_events_survives_a_dead_worker(tmp_path):
+    event_files = [str(tmp_path / "event{:010d}".format(evtid)) for evtid in range(1, 5)]
+    manifest_dir = str(tmp_path / "manifest")
+
+    process_func = partial(crash_once, marker_dir=str(tmp_path))
+    manifest = process_events(
+        process_func, event_files, manifest_dir, n_workers=2, max_retries=1, show_progress=False
+    )
+
+    # The broken pool is recorded as failed, then the retry round runs in a new pool
+    assert all(manifest.is_done(evtid) for evtid in range(1, 5))
+    assert Manifest(manifest_dir).attempts(2) == 2
+
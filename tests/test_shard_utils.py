@@ -0,0 +1,17 @@
+import torch
+
+from LightningModules.utils.shard_utils import list_events, load_event, save_event
+
+
+def test_reader_sees_events_written_after_first_read(tmp_path):
+    output_dir = str(tmp_path)
+    save_event({"x": torch.zeros(3)}, output_dir, "0000000001", shard_size=10)
+    assert list_events(output_dir) == ["0000000001"]
+    assert torch.equal(load_event(str(tmp_path / "0000000001"))["x"], torch.zeros(3))
+
+    # Once the reader is cached, a new event is found on a miss, an event written again by list_events()
+    save_event({"x": torch.ones(3)}, output_dir, "0000000002", shard_size=10)
+    assert torch.equal(load_event(str(tmp_path / "0000000002"))["x"], torch.ones(3))
+    save_event({"x": torch.ones(3)}, output_dir, "0000000001", shard_size=10)
+    assert sorted(list_events(output_dir)) == ["0000000001", "0000000002"]
+    assert torch.equal(load_event(str(tmp_path / "0000000001"))["x"], torch.ones(3))
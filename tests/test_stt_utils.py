@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from LightningModules.Processing.utils.stt_utils import STT_SECTORS, SttHitIndex, wrap_phi
+
+
+def random_hits(n_hits=500, n_layers=6, seed=0):
+    rng = np.random.default_rng(seed)
+    layer = rng.integers(0, n_layers, n_hits)
+    phi = rng.uniform(-np.pi, np.pi, n_hits)
+    sector = ((phi + np.pi) // (2 * np.pi / STT_SECTORS)).astype(int) % STT_SECTORS
+    return layer, sector, phi
+
+
+def test_neighbour_hits_matches_brute_force():
+    layer, sector, phi = random_hits()
+    index = SttHitIndex(layer, sector, phi)
+
+    for query_layer in range(-1, layer.max() + 2):
+        for query_sector in range(STT_SECTORS):
+            dSector = np.abs(sector - query_sector)
+            mask = (layer == query_layer) & ((dSector < 2) | (dSector == STT_SECTORS - 1))
+            hits = index.neighbour_hits(query_layer, query_sector)
+
+            np.testing.assert_array_equal(np.sort(hits), np.flatnonzero(mask))
+
+            # sorted by (sector, phi)
+            keys = sector[hits] * 10 + phi[hits]
+            assert (np.diff(keys) >= 0).all()
+
+
+@pytest.mark.parametrize("with_sectors", [True, False])
+@pytest.mark.parametrize("phi0, dphi", [
+    (0.3, 0.2), (3.0, 0.5), (-3.0, 0.5), (np.pi, 0.1), (-np.pi, 0.1), (1.0, 2.5), (0.0, np.pi),
+])
+def test_phi_window_matches_brute_force(with_sectors, phi0, dphi):
+    layer, sector, phi = random_hits()
+    index = SttHitIndex(layer, sector if with_sectors else None, phi)
+
+    for query_layer in range(-1, layer.max() + 2):
+        mask = (layer == query_layer) & (np.abs(wrap_phi(phi - phi0)) <= dphi)
+        hits = index.phi_window(query_layer, phi0, dphi)
+
+        # every hit once, windows crossing -pi or pi included
+        assert len(np.unique(hits)) == len(hits)
+        np.testing.assert_array_equal(np.sort(hits), np.flatnonzero(mask))
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import scipy.sparse as sps
+from scipy.sparse.csgraph import connected_components
+
+from LightningModules.GNN.Models.tracking_utils import count_track_matches, scan_edge_cuts
+
+
+def random_event(seed, n_hits=120, n_edges=300):
+    """Hits of a few particles (and noise, pid 0), edges with scores on a coarse grid, so that
+    several edges share a score and every cut is equal to some scores."""
+    rng = np.random.default_rng(seed)
+    hit_pids = rng.integers(0, 8, n_hits)
+    edge_index = rng.integers(0, n_hits, (2, n_edges))
+    scores = rng.integers(0, 10, n_edges) / 10
+    return edge_index, scores, hit_pids
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_scan_edge_cuts_matches_ccl_per_cut(seed):
+    edge_index, scores, hit_pids = random_event(seed)
+    edge_cut_range = np.array([0.7, 0.1, 0.4, 0.0, 0.9, 0.5])
+    track_length_range = np.arange(1, 12)
+    kwargs = dict(min_hits_truth=5, frac_reco_matched=0.5, frac_truth_matched=0.5)
+
+    counts = scan_edge_cuts(edge_index, scores, hit_pids, edge_cut_range, track_length_range, **kwargs)
+
+    for i, edge_cut in enumerate(edge_cut_range):
+        passing = scores > edge_cut
+        graph = sps.coo_matrix(
+            (np.ones(passing.sum()), (edge_index[0][passing], edge_index[1][passing])),
+            shape=(len(hit_pids), len(hit_pids)),
+        )
+        _, labels = connected_components(graph, directed=False)
+        expected = count_track_matches(labels, hit_pids, track_length_range, **kwargs)
+        np.testing.assert_array_equal(counts[i], expected)
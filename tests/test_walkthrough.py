@@ -0,0 +1,33 @@
+import numpy as np
+
+from LightningModules.Segmenting.utils.walkthrough import walkthrough
+
+
+def branching_dag():
+    """Two starting nodes (0 and 10). Track 0 branches at node 1 towards the ending nodes 3
+    and 5, track 1 joins it at node 2. Node 6 has no edge."""
+    edges = [(0, 1), (1, 2), (2, 3), (1, 4), (4, 5), (10, 11), (11, 2)]
+    return np.array(edges).T, 12
+
+
+def test_walkthrough_labels_shortest_paths_to_all_ending_nodes():
+    edge_index, num_nodes = branching_dag()
+    labels = walkthrough(edge_index, num_nodes)
+
+    # Both branches of track 0, shared nodes stay with the first track
+    expected = np.full(num_nodes, -1)
+    expected[[0, 1, 2, 3, 4, 5]] = 0
+    expected[[10, 11]] = 1
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_walkthrough_score_weighted_takes_the_best_path():
+    edge_index, num_nodes = branching_dag()
+    scores = np.array([0.9, 0.9, 0.9, 0.6, 0.6, 0.9, 0.9])
+    labels = walkthrough(edge_index, num_nodes, scores)
+
+    # A single path per starting node, the branch 1 -> 4 -> 5 is left out
+    expected = np.full(num_nodes, -1)
+    expected[[0, 1, 2, 3]] = 0
+    expected[[10, 11]] = 1
+    np.testing.assert_array_equal(labels, expected)